@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+结构化日志 - 替代各处的 print() 调试输出
+
+- 级别控制: LOG_LEVEL 以下的日志在调用处直接返回, 不格式化消息 (logging 的 %s 延迟格式化);
+  生产环境默认 INFO, DEBUG 日志几乎没有开销, 需要时设置 LOG_LEVEL=DEBUG
+- 非阻塞: 请求线程只把日志放入内存队列, 由后台线程写入 stdout (QueueHandler + QueueListener);
+  队列满时丢弃并计数, 不阻塞请求
+- 请求 ID: 每个请求分配一个 ID (或使用请求头 X-Request-ID), 写入该请求的每条日志和响应头 X-Request-ID,
+  gunicorn 多 worker、多线程交错的日志可以按 ID 找到同一请求
+- 结构化字段: log.info('记录已更新', extra={'record_id': 5}) 的 extra 字段
+  在 text 格式中以 key=value 附在末尾, json 格式中为独立的键
+
+用法:
+    from app_logging import get_logger
+    log = get_logger(__name__)
+    log.debug('接收到的数据: %s', data)
+
+环境变量:
+- LOG_LEVEL        DEBUG / INFO / WARNING / ERROR (默认 INFO)
+- LOG_FORMAT       text / json (默认 text)
+- LOG_QUEUE_SIZE   日志队列长度 (默认 10000)
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# 所有应用日志都在该名称之下, 不影响 werkzeug / gunicorn 自己的日志
+ROOT_LOGGER_NAME = 'inbound'
+REQUEST_ID_HEADER = 'X-Request-ID'
+# 客户端传入的请求 ID 只接受字母、数字、- 和 _, 最长 64 个字符
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# LogRecord 自带的属性, 其余属性视为 extra 结构化字段
+_STANDARD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'request_id'}
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def _extra_fields(record):
+    return {key: value for key, value in record.__dict__.items()
+            if key not in _STANDARD_ATTRS and not key.startswith('_')}
+
+
+def current_request_id():
+    """当前请求的 ID; 不在请求中 (后台线程、启动过程) 时为 '-'"""
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return '-'
+    if has_request_context():
+        return getattr(g, 'request_id', '-')
+    return '-'
+
+
+class RequestIdFilter(logging.Filter):
+    """在调用日志的线程中取得请求 ID (后台写入线程没有请求上下文)"""
+
+    def filter(self, record):
+        record.request_id = current_request_id()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    放入有界队列, 队列满时丢弃; 第一次写日志时 (以及 fork 之后的子进程中) 启动后台写入线程
+    消息在放入队列前格式化 (prepare), 只对通过级别检查的日志执行
+    """
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue)
+        self.target = target
+        self.dropped = 0
+        self._listener = None
+        self._listener_pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._listener_pid == os.getpid():
+                return
+            # fork 之后父进程的写入线程不存在, 子进程重新启动一个
+            self._listener = QueueListener(self.queue, self.target)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        self._ensure_listener()
+        super().emit(record)
+
+    def stop(self):
+        """刷新队列并停止后台线程 (进程退出时调用)"""
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._listener_pid = None
+
+
+_queue_handler = None
+
+
+def configure(level=None, fmt=None):
+    """配置应用日志 (只执行一次); get_logger() 会自动调用"""
+    global _configured, _queue_handler
+    if _configured:
+        return
+    with _configure_lock:
+        if _configured:
+            return
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter() if (fmt or LOG_FORMAT) == 'json' else TextFormatter())
+
+        _queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE), stream_handler)
+        _queue_handler.addFilter(RequestIdFilter())
+
+        root = logging.getLogger(ROOT_LOGGER_NAME)
+        root.setLevel(level or LOG_LEVEL)
+        root.addHandler(_queue_handler)
+        root.propagate = False
+        atexit.register(_queue_handler.stop)
+        _configured = True
+
+
+def get_logger(name):
+    """返回应用日志记录器; name 一般为 __name__ (single_app 等模块名)"""
+    configure()
+    if name == '__main__':
+        name = os.path.splitext(os.path.basename(sys.argv[0] or 'main'))[0]
+    return logging.getLogger(f'{ROOT_LOGGER_NAME}.{name}')
+
+
+def get_stats():
+    return {
+        'level': logging.getLevelName(logging.getLogger(ROOT_LOGGER_NAME).level),
+        'format': LOG_FORMAT,
+        'queued': _queue_handler.queue.qsize() if _queue_handler else 0,
+        'dropped': _queue_handler.dropped if _queue_handler else 0,
+    }
+
+
+def init_request_logging(app):
+    """为每个请求分配请求 ID (写入日志和响应头 X-Request-ID)"""
+    from flask import g, request
+    log = get_logger('request')
+
+    @app.before_request
+    def assign_request_id():
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        g.request_id = request_id if _REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex[:16]
+
+    @app.after_request
+    def add_request_id_header(response):
+        request_id = getattr(g, 'request_id', None)
+        if request_id:
+            response.headers[REQUEST_ID_HEADER] = request_id
+        log.debug('%s %s -> %s', request.method, request.full_path.rstrip('?'), response.status_code)
+        return response
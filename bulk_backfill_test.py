@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量补录测试: 乱序补录、批内重复的客户端请求 ID、补录后的道口状态
+
+在临时 SQLite 数据库上, 同一组车辆分别:
+- 道口 11: 按到达时间顺序逐条调用 /api/record (参照结果)
+- 道口 21: 先逐条录入其中两台, 再把其余车辆乱序放进一次 /api/records/bulk,
+  其中有插在已有两台车之间的补录、批内重复和与已录入记录重复的请求 ID
+比较两个道口每台车的占用时长和 dock_state, 并检查批量录入返回的每条结果
+
+用法: python bulk_backfill_test.py (不需要启动服务器)
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+temp_dir = tempfile.mkdtemp(prefix='inbound_bulk_test_')
+os.environ['DATABASE_PATH'] = os.path.join(temp_dir, 'inbound.db')
+os.environ['EVENT_BACKEND'] = 'memory'
+os.environ.setdefault('METRICS_DIR', os.path.join(temp_dir, 'metrics'))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import single_app  # noqa: E402
+from database import get_db_connection  # noqa: E402
+
+
+class FrozenDatetime(datetime):
+    """record() 使用 datetime.now() 作为到达时间, 测试中由 current 指定"""
+    current = None
+
+    @classmethod
+    def now(cls, tz=None):
+        if tz is not None or cls.current is None:
+            return datetime.now(tz)
+        return cls.current
+
+
+single_app.datetime = FrozenDatetime
+
+BASE = (datetime.now() - timedelta(days=1)).replace(hour=8, minute=0, second=0, microsecond=0)
+
+# (名称, 距 BASE 的分钟数, 车型, 客户端请求 ID)
+VEHICLES = [
+    ('Z', -60, '26英尺', 'z'),    # 早于已有的所有车辆
+    ('A', 0, '53英尺', 'a'),      # 已有
+    ('X', 30, '26英尺', 'x'),     # 插在 A 和 B 之间, 拆分已有的占用区间
+    ('V', 45, 'Van', 'v'),        # 不占用道口
+    ('B', 60, '26英尺', 'b'),     # 已有
+    ('Y', 135, '53英尺', 'y'),    # 晚于已有的所有车辆, 成为道口当前车辆
+]
+EXISTING = ('A', 'B')
+
+failures = []
+
+
+def check(name, actual, expected):
+    ok = actual == expected
+    print(f"[{'通过' if ok else '失败'}] {name}")
+    if not ok:
+        print(f"    实际: {actual}")
+        print(f"    期望: {expected}")
+        failures.append(name)
+
+
+def post_record(client, dock_no, name, minutes, vehicle_type, request_id):
+    FrozenDatetime.current = BASE + timedelta(minutes=minutes)
+    response = client.post('/api/record', json={
+        'dock_no': dock_no, 'vehicle_type': vehicle_type, 'vehicle_no': name,
+        'client_request_id': f'{dock_no}-{request_id}'})
+    return response.get_json()['record_id']
+
+
+def dock_timeline(dock_no):
+    """道口的所有车辆 (按到达时间): [(车牌, 到达时间, 时长)]"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT vehicle_no, created_at, duration FROM inbound_records
+            WHERE dock_no = ? ORDER BY created_at, id""", (dock_no,))
+        return [(row[0], str(row[1]), row[2]) for row in cursor.fetchall()]
+
+
+def dock_state(dock_no):
+    """dock_state 中道口的当前车辆: (车牌, 到达时间, 车型)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT vehicle_no, arrived_at, vehicle_type FROM dock_state WHERE dock_no = ?", (dock_no,))
+        row = cursor.fetchone()
+        return (row[0], str(row[1]), row[2]) if row else None
+
+
+def main():
+    print("批量补录测试")
+    print("=" * 50)
+    print(f"临时数据库: {os.environ['DATABASE_PATH']}")
+    client = single_app.app.test_client()
+    client.post('/api/login', json={'username': 'admin', 'password': 'admin123'})
+
+    # 参照: 按到达时间逐条录入
+    for name, minutes, vehicle_type, request_id in sorted(VEHICLES, key=lambda v: v[1]):
+        post_record(client, 11, name, minutes, vehicle_type, request_id)
+
+    # 已有的两台车逐条录入, 其余乱序批量补录
+    existing_ids = {}
+    for name, minutes, vehicle_type, request_id in VEHICLES:
+        if name in EXISTING:
+            existing_ids[name] = post_record(client, 21, name, minutes, vehicle_type, request_id)
+
+    def bulk_item(name):
+        _, minutes, vehicle_type, request_id = next(v for v in VEHICLES if v[0] == name)
+        return {'dock_no': 21, 'vehicle_type': vehicle_type, 'vehicle_no': name,
+                'client_request_id': f'21-{request_id}',
+                'created_at': (BASE + timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')}
+
+    batch = [bulk_item('Y'), bulk_item('X'), bulk_item('A'), bulk_item('Z'), bulk_item('X'), bulk_item('V')]
+    # 客户端带了 id 字段, 不能影响结果
+    batch[3]['id'] = 999999
+    FrozenDatetime.current = BASE + timedelta(hours=6)
+    response = client.post('/api/records/bulk', json={'records': batch})
+    result = response.get_json()
+
+    check("批量录入返回 200", response.status_code, 200)
+    check("新建 4 条, 重复 2 条", (result.get('created'), result.get('duplicates')), (4, 2))
+    statuses = [(r['client_request_id'], r['status']) for r in result.get('results', [])]
+    check("每条结果的状态按提交顺序返回", statuses, [
+        ('21-y', 'created'), ('21-x', 'created'), ('21-a', 'duplicate'),
+        ('21-z', 'created'), ('21-x', 'duplicate'), ('21-v', 'created')])
+    results = result.get('results', [])
+    if len(results) == 6:
+        check("与已录入记录重复时返回已有记录的 ID", results[2]['id'], existing_ids['A'])
+        check("批内重复时返回本批第一次出现的记录的 ID", results[4]['id'], results[1]['id'])
+        check("客户端的 id 字段不作为记录 ID", results[3]['id'] != 999999, True)
+
+    check("各车辆的到达时间和占用时长与逐条录入一致", dock_timeline(21), dock_timeline(11))
+    check("道口当前车辆 (dock_state) 与逐条录入一致", dock_state(21), dock_state(11))
+    check("道口当前车辆为最晚到达的 Y", (dock_state(21) or (None,))[0], 'Y')
+
+    # 重放整批: 全部识别为重复, 不改变任何数据
+    timeline_before = dock_timeline(21)
+    result = client.post('/api/records/bulk', json={'records': batch}).get_json()
+    check("重放整批全部为重复", (result.get('created'), result.get('duplicates')), (0, 6))
+    check("重放后占用时长不变", dock_timeline(21), timeline_before)
+
+    print("=" * 50)
+    if failures:
+        print(f"{len(failures)} 项失败")
+        return 1
+    print("全部通过")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+业务日与小时列 - 写入时计算一次, 查询直接按列过滤和分组
+
+业务日: 洛杉矶时间 05:00 至次日 05:00 (与 rollups.py 一致)
+inbound_records / sorting_records 增加两列 (migrations.py 版本 11):
+- business_date  业务日 (YYYY-MM-DD)
+- hour_bucket    洛杉矶时间的小时 (0-23)
+
+两张表 created_at 的含义不同:
+- inbound_records.created_at 为系统本地时间, 先转换为洛杉矶时间
+- sorting_records.created_at 写入时已经是洛杉矶时间
+
+写接口在插入时填写这两列; 其他途径写入 (旧版本、导入脚本等) 留空的记录由回填补齐,
+init_db() 启动时自动回填, 也可以手动执行:
+    python business_days.py backfill   # 补齐为空的记录
+    python business_days.py rebuild    # 全部重新计算 (服务器时区变更后)
+    python business_days.py status     # 各表未回填的记录数
+"""
+import sys
+from datetime import datetime, timedelta
+
+from rollups import LA_TZ, BUSINESS_DAY_START_HOUR, parse_created_at
+from database import get_db_connection, table_exists, USE_POSTGRES
+from migrations import get_columns
+
+# 回填时每批处理的记录数
+BACKFILL_BATCH_SIZE = 5000
+# PostgreSQL 回填时使用的咨询锁, 避免多个 worker 同时回填
+BUSINESS_DAY_ADVISORY_LOCK_ID = 7302020
+
+# 表名 -> created_at 是否已经是洛杉矶时间
+BUSINESS_DAY_TABLES = {
+    'inbound_records': False,
+    'sorting_records': True,
+}
+
+
+def _la_time(created_at, is_la_time):
+    created_at = parse_created_at(created_at)
+    if is_la_time:
+        return created_at
+    # naive datetime 的 astimezone() 按系统本地时区解释
+    return created_at.astimezone(LA_TZ).replace(tzinfo=None)
+
+
+def business_fields(created_at, is_la_time=False):
+    """
+    返回 (business_date 'YYYY-MM-DD', hour_bucket)
+    is_la_time: created_at 已经是洛杉矶时间 (sorting_records)
+    """
+    la_time = _la_time(created_at, is_la_time)
+    business_date = (la_time - timedelta(hours=BUSINESS_DAY_START_HOUR)).date()
+    return business_date.strftime('%Y-%m-%d'), la_time.hour
+
+
+def current_business_date():
+    """当前所属的业务日 (洛杉矶时间 05:00 之前属于前一天)"""
+    return (datetime.now(LA_TZ) - timedelta(hours=BUSINESS_DAY_START_HOUR)).date()
+
+
+def backfill_table(cursor, table_name, rebuild=False, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    计算 table_name 中 business_date 为空 (rebuild=True 时为全部) 的记录, 返回处理的记录数
+    只更新派生列, 不修改 updated_at, 也不写入 outbox (远程数据库启动时自行回填)
+    """
+    is_la_time = BUSINESS_DAY_TABLES[table_name]
+    condition = "created_at IS NOT NULL"
+    if not rebuild:
+        condition += " AND business_date IS NULL"
+    total = 0
+    last_id = 0
+    while True:
+        # 按 ID 分批, 已处理的记录不会再被选中
+        cursor.execute(f"""
+            SELECT id, created_at FROM {table_name}
+            WHERE {condition} AND id > ?
+            ORDER BY id LIMIT ?
+        """, (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return total
+        cursor.executemany(
+            f"UPDATE {table_name} SET business_date = ?, hour_bucket = ? WHERE id = ?",
+            [business_fields(created_at, is_la_time) + (record_id,) for record_id, created_at in rows])
+        total += len(rows)
+        last_id = rows[-1][0]
+
+
+def backfill_all(cursor, rebuild=False):
+    """回填所有表, 返回 {表名: 记录数}; 表或列还不存在时跳过"""
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_xact_lock(?)", (BUSINESS_DAY_ADVISORY_LOCK_ID,))
+    counts = {}
+    for table_name in BUSINESS_DAY_TABLES:
+        if table_exists(cursor, table_name) and _has_columns(cursor, table_name):
+            counts[table_name] = backfill_table(cursor, table_name, rebuild)
+    return counts
+
+
+def count_missing(cursor):
+    """各表 business_date 为空的记录数"""
+    counts = {}
+    for table_name in BUSINESS_DAY_TABLES:
+        if table_exists(cursor, table_name) and _has_columns(cursor, table_name):
+            cursor.execute(f"SELECT COUNT(*) FROM {table_name} WHERE business_date IS NULL AND created_at IS NOT NULL")
+            counts[table_name] = cursor.fetchone()[0]
+    return counts
+
+
+def _has_columns(cursor, table_name):
+    return {'business_date', 'hour_bucket'} <= get_columns(cursor, table_name)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ('backfill', 'rebuild', 'status'):
+        print("用法: python business_days.py backfill   # 补齐业务日为空的记录")
+        print("      python business_days.py rebuild    # 全部重新计算")
+        print("      python business_days.py status     # 查看未回填的记录数")
+        return 1
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if argv[1] == 'status':
+            for table_name, count in count_missing(cursor).items():
+                print(f"  {table_name}: {count} 条记录未回填")
+        else:
+            for table_name, count in backfill_all(cursor, rebuild=argv[1] == 'rebuild').items():
+                print(f"[业务日] {table_name}: 已计算 {count} 条记录")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
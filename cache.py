@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+接口响应缓存 - 进程内 TTL + LRU
+
+统计页面轮询的只读接口 (/api/stats, /api/daily_trend 等) 结果只在入库记录
+增删改时变化. 这里按 接口路径 + 查询参数 缓存响应内容:
+- 数据版本号 data_version 在 broadcast_update() 时递增, 版本变化的缓存立即失效
+- TTL 兜底: 多 worker 部署时其他进程收不到广播, 最多延迟 TTL 秒
+- 响应带 ETag, 内容未变化时返回 304, 浏览器不必重新下载
+
+环境变量:
+- RESPONSE_CACHE_TTL   缓存有效期 (秒, 默认 30, 0 表示关闭缓存)
+- RESPONSE_CACHE_SIZE  最多缓存的条目数 (默认 256)
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '30'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '256'))
+
+# 数据版本号：每次数据变更时递增，用于判断缓存是否过期
+_data_version = 0
+_data_version_lock = threading.Lock()
+
+
+def bump_data_version():
+    """数据变更后调用，使所有已缓存的响应失效"""
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+        return _data_version
+
+
+def get_data_version():
+    return _data_version
+
+
+class CacheEntry:
+    __slots__ = ('version', 'expires_at', 'body', 'mimetype', 'etag')
+
+    def __init__(self, version, expires_at, body, mimetype, etag):
+        self.version = version
+        self.expires_at = expires_at
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+
+
+class ResponseCache:
+    """线程安全的 TTL + LRU 缓存"""
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """返回仍然有效的缓存条目，过期或版本不一致时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version or entry.expires_at <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, version, body, mimetype, ttl=None):
+        entry = CacheEntry(
+            version,
+            time.monotonic() + (self.ttl if ttl is None else ttl),
+            body,
+            mimetype,
+            hashlib.md5(body).hexdigest(),
+        )
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'data_version': _data_version,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def cached_response(ttl=None):
+    """
+    只读接口的缓存装饰器 (放在 @app.route 下面)
+    只缓存 200 响应; 错误响应每次重新计算
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache_ttl = response_cache.ttl if ttl is None else ttl
+            if request.method not in ('GET', 'HEAD') or cache_ttl <= 0:
+                return view(*args, **kwargs)
+
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            # 先读版本号再计算: 计算期间有写入时, 结果按旧版本缓存, 下次请求即失效
+            version = get_data_version()
+            entry = response_cache.get(key, version)
+            if entry is None:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                entry = response_cache.set(key, version, response.get_data(), response.mimetype, cache_ttl)
+
+            response = current_app.response_class(entry.body, mimetype=entry.mimetype)
+            response.set_etag(entry.etag)
+            # 浏览器可以保存，但每次使用前必须用 ETag 验证
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+响应压缩 - 按 Accept-Encoding 对 JSON / CSV / HTML 等文本响应做 gzip 或 brotli 压缩
+
+/api/list、/api/history、/api/logs 等接口返回的 JSON 每一行都重复相同的键和车型字符串,
+压缩后通常只有原来的 10%~20%. init_compression(app) 注册 after_request:
+- 只压缩文本类型 (COMPRESSIBLE_MIMETYPES), 已有 Content-Encoding 的响应
+  (预压缩的静态页面、gzip 导出) 和 Cache-Control: no-transform 的响应不处理
+- text/event-stream (SSE) 不压缩: 压缩器会缓冲数据, 事件无法及时送达
+- 普通响应小于 COMPRESSION_MIN_SIZE 字节时不压缩; 带 ETag 的响应 (cached_response)
+  按 ETag 缓存压缩结果, 同一内容只压缩一次, ETag 改为弱 ETag (W/), 304 判断不受影响
+- 生成器响应 (流式导出) 边生成边压缩, 每个分块 flush 一次, 不等全部生成
+
+brotli 为可选依赖 (Brotli 包), 未安装时只使用 gzip.
+
+环境变量:
+- RESPONSE_COMPRESSION    是否启用 (1/0, 默认 1)
+- COMPRESSION_MIN_SIZE    压缩的最小响应大小 (字节, 默认 1024)
+- COMPRESSION_LEVEL       gzip 压缩级别 (1-9, 默认 6)
+"""
+import gzip
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    # 可选依赖: 未安装时只提供 gzip
+    brotli = None
+
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', '1') == '1'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '6'))
+# 动态响应的 brotli 质量 (0-11), 与 gzip 6 的速度相近而压缩率更高
+BROTLI_QUALITY = 5
+# 按 ETag 缓存的压缩结果条数
+COMPRESSED_CACHE_SIZE = 64
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'application/xml',
+    'image/svg+xml',
+}
+AVAILABLE_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(available=AVAILABLE_ENCODINGS):
+    """在 available 中选择客户端接受且质量值最高的编码, 同等时按 available 的顺序; 都不接受时返回 identity"""
+    best, best_quality = 'identity', 0
+    for encoding in available:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_LEVEL, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    """逐块压缩生成器响应; 每块 flush 一次, 客户端可以边下载边解压"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)  # wbits=31: gzip 格式
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # 原生成器的清理 (释放数据库连接等) 仍然执行
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def is_compressible(mimetype):
+    if not mimetype:
+        return False
+    if mimetype == 'text/event-stream':
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+class ResponseCompressor:
+    """after_request 压缩处理, 以及按 ETag 缓存的压缩结果"""
+
+    def __init__(self, min_size=COMPRESSION_MIN_SIZE, cache_size=COMPRESSED_CACHE_SIZE):
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.streamed = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _compressed_body(self, body, encoding, etag):
+        if not etag:
+            return compress(body, encoding)
+        key = (etag, encoding)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return cached
+        cached = compress(body, encoding)
+        with self._lock:
+            self._cache[key] = cached
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return cached
+
+    def process_response(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or not is_compressible(response.mimetype)
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding()
+        if encoding == 'identity':
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+            with self._lock:
+                self.streamed += 1
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            etag, weak = response.get_etag()
+            compressed = self._compressed_body(body, encoding, None if weak else etag)
+            response.set_data(compressed)
+            if etag:
+                # 压缩后与原文字节不同, 只能作为弱 ETag; If-None-Match 按弱比较, 仍然返回 304
+                response.set_etag(etag, weak=True)
+            with self._lock:
+                self.compressed += 1
+                self.bytes_in += len(body)
+                self.bytes_out += len(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'enabled': RESPONSE_COMPRESSION,
+                'encodings': list(AVAILABLE_ENCODINGS),
+                'min_size': self.min_size,
+                'compressed': self.compressed,
+                'streamed': self.streamed,
+                'cache_hits': self.cache_hits,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+
+response_compressor = ResponseCompressor()
+
+
+def init_compression(app):
+    """注册压缩处理 (RESPONSE_COMPRESSION=0 时不注册)"""
+    if RESPONSE_COMPRESSION:
+        app.after_request(response_compressor.process_response)
@@ -9,8 +9,15 @@
 """
 import os
 import sys
+import threading
+import time
+import weakref
 from contextlib import contextmanager
 
+from app_logging import get_logger
+
+log = get_logger(__name__)
+
 # 检测数据库类型
 DATABASE_URL = os.environ.get('DATABASE_URL') or os.environ.get('POSTGRES_URL')
 USE_POSTGRES = DATABASE_URL is not None
@@ -18,18 +25,26 @@ USE_POSTGRES = DATABASE_URL is not None
 if USE_POSTGRES:
     try:
         import psycopg2
-        from psycopg2.extras import RealDictCursor
-        print(f"[数据库] 使用 PostgreSQL: {DATABASE_URL[:30]}...")
+        from psycopg2.extras import RealDictCursor, DictCursor
+        log.info("使用 PostgreSQL: %s...", DATABASE_URL[:30])
+        try:
+            from gevent import monkey
+            if monkey.is_module_patched('socket'):
+                # gevent worker: 查询等待网络时让出协程, 否则一条慢查询会阻塞整个 worker
+                from psycogreen.gevent import patch_psycopg
+                patch_psycopg()
+        except ImportError as e:
+            if 'gevent' in sys.modules:
+                log.warning("gevent 下未安装 psycogreen, 数据库查询会阻塞 worker: %s", e)
     except ImportError:
-        print("[错误] PostgreSQL 驱动未安装!")
-        print("生产环境部署请使用: pip install -r requirements-prod.txt")
-        print("本地开发会自动使用 SQLite")
+        log.error("PostgreSQL 驱动未安装! 生产环境部署请使用: pip install -r requirements-prod.txt, "
+                  "本地开发会自动使用 SQLite")
         USE_POSTGRES = False
         import sqlite3
-        print("[数据库] 回退到 SQLite (本地模式)")
+        log.warning("回退到 SQLite (本地模式)")
 else:
     import sqlite3
-    print("[数据库] 使用 SQLite (本地模式)")
+    log.info("使用 SQLite (本地模式)")
 
 # 获取 SQLite 数据库路径
 def get_sqlite_db_path():
@@ -41,36 +56,493 @@ def get_sqlite_db_path():
         # 开发环境
         return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inbound.db')
 
-@contextmanager
-def get_db_connection():
+# ============================================================================
+# 连接池 - PostgreSQL 使用线程安全连接池, SQLite 使用按线程缓存的 WAL 连接
+# ============================================================================
+
+# 连接池配置 (可通过环境变量调整)
+POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN', 1))
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX', 10))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# 连接空闲超过该秒数后, 借出前先执行 SELECT 1 探活 (Neon 会回收空闲连接)
+POOL_RECYCLE_SECONDS = float(os.environ.get('DB_POOL_RECYCLE', 60))
+
+
+class PoolTimeout(Exception):
+    """等待可用连接超时"""
+
+
+if USE_POSTGRES:
+    class QmarkDictCursor(DictCursor):
+        """
+        自动将 SQLite 风格的 ? 占位符转换为 %s 的游标
+        DictCursor 返回的行同时支持 row[0] 和 row['id'] 两种访问方式
+        """
+        def execute(self, query, vars=None):
+            return super().execute(query.replace('?', '%s'), vars)
+
+        def executemany(self, query, vars_list):
+            return super().executemany(query.replace('?', '%s'), vars_list)
+
+
+class _PoolStats:
+    """连接池指标 (借出次数、等待时间、超时次数)"""
+
+    def __init__(self):
+        self.acquires = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.discards = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, waited):
+        self.acquires += 1
+        self.wait_total += waited
+        if waited > self.wait_max:
+            self.wait_max = waited
+
+    def as_dict(self):
+        return {
+            'acquires': self.acquires,
+            'timeouts': self.timeouts,
+            'connects': self.connects,
+            'discards': self.discards,
+            'wait_total_ms': round(self.wait_total * 1000, 3),
+            'wait_avg_ms': round(self.wait_total * 1000 / self.acquires, 3) if self.acquires else 0,
+            'wait_max_ms': round(self.wait_max * 1000, 3),
+        }
+
+
+class PostgresPool:
     """
-    获取数据库连接的上下文管理器
-    自动适配 SQLite 或 PostgreSQL
+    线程安全的 PostgreSQL 连接池
+
+    - 最多保持 max_size 个连接, 用尽时阻塞等待直到 timeout
+    - 空闲连接按后进先出复用, 保持热连接
+    - 空闲过久的连接借出前先探活, 失效则重建
     """
-    if USE_POSTGRES:
-        # PostgreSQL 连接
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+
+    def __init__(self, dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 timeout=POOL_TIMEOUT, recycle=POOL_RECYCLE_SECONDS):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self._idle = []  # [(conn, last_used)]
+        self._created = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self.stats = _PoolStats()
+        for _ in range(min_size):
+            self._created += 1
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        self.stats.connects += 1
+        return psycopg2.connect(self.dsn, cursor_factory=QmarkDictCursor)
+
+    def _is_alive(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.recycle:
+            return True
         try:
-            yield conn
-            conn.commit()
-        except Exception as e:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
             conn.rollback()
-            raise e
-        finally:
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        entry = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._created < self.max_size:
+                    self._created += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats.timeouts += 1
+                    raise PoolTimeout(f"等待数据库连接超时 ({self.timeout}s, 池大小 {self.max_size})")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+
+        try:
+            if entry is not None:
+                conn, last_used = entry
+                if not self._is_alive(conn, last_used):
+                    self.stats.discards += 1
+                    self._close_quietly(conn)
+                    conn = self._connect()
+            else:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self.stats.record_wait(time.monotonic() - started)
+        return conn
+
+    def release(self, conn):
+        broken = conn.closed
+        if not broken:
+            try:
+                # 结束未提交的事务 (psycopg2 在 SELECT 时也会隐式开启事务)
+                conn.rollback()
+            except Exception:
+                broken = True
+        with self._cond:
+            self._in_use -= 1
+            if broken:
+                self._created -= 1
+                self.stats.discards += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if broken:
+            self._close_quietly(conn)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
             conn.close()
-    else:
-        # SQLite 连接
-        db_path = os.environ.get('DATABASE_PATH') or get_sqlite_db_path()
-        conn = sqlite3.connect(db_path)
+        except Exception:
+            pass
+
+    def get_stats(self):
+        with self._cond:
+            data = {
+                'backend': 'PostgreSQL',
+                'max_size': self.max_size,
+                'size': self._created,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+            }
+        data.update(self.stats.as_dict())
+        return data
+
+
+class _ThreadSlot:
+    """线程本地连接槽位, 线程退出时随 threading.local 一起回收"""
+    __slots__ = ('conn', 'depth', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+
+
+class SQLitePool:
+    """
+    SQLite 按线程缓存连接
+
+    - 每个线程复用同一个连接, 开启 WAL 以允许读写并发
+    - 同一线程内嵌套借用共享同一连接 (引用计数), 避免同线程两个连接互相锁等待
+    - 引用计数归零时回滚未提交的事务, 与原先 close() 丢弃未提交修改的语义一致
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open = 0
+        self._in_use = 0
+        self.stats = _PoolStats()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=POOL_TIMEOUT)
         conn.row_factory = sqlite3.Row  # 返回字典式结果
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        slot = _ThreadSlot(conn)
+        # 线程结束时关闭该线程的连接并更新计数
+        weakref.finalize(slot, self._close_slot_conn, conn)
+        with self._lock:
+            self._open += 1
+            self.stats.connects += 1
+        return slot
+
+    def _close_slot_conn(self, conn):
+        with self._lock:
+            self._open -= 1
         try:
-            yield conn
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
             conn.close()
+        except Exception:
+            pass
+
+    def _discard_slot(self):
+        slot = self._local.slot
+        self._local.slot = None
+        with self._lock:
+            self.stats.discards += 1
+        # 触发 finalize 关闭连接
+        del slot
+
+    def acquire(self):
+        started = time.monotonic()
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            slot = self._local.slot = self._connect()
+        slot.depth += 1
+        if slot.depth == 1:
+            with self._lock:
+                self._in_use += 1
+                self.stats.record_wait(time.monotonic() - started)
+        return slot.conn
+
+    def release(self, conn):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None or slot.conn is not conn:
+            # 在其他线程中被回收 (不应发生), 不能跨线程操作 SQLite 连接
+            return
+        slot.depth -= 1
+        if slot.depth > 0:
+            return
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 连接已损坏, 丢弃后下次重建
+            self._discard_slot()
+
+    def close_all(self):
+        slot = getattr(self._local, 'slot', None)
+        if slot is not None and not slot.depth:
+            self._local.slot = None
+
+    def get_stats(self):
+        with self._lock:
+            data = {
+                'backend': 'SQLite',
+                'max_size': None,
+                'size': self._open,
+                'in_use': self._in_use,
+                'idle': self._open - self._in_use,
+                'waiting': 0,
+            }
+        data.update(self.stats.as_dict())
+        return data
+
+
+# ============================================================================
+# 查询统计 - 请求期间 (metrics.py 开启) 借出的游标记录查询次数、耗时和读取的行数
+# ============================================================================
+
+class QueryStats:
+    """一个请求的查询次数、数据库耗时 (秒) 与读取的行数"""
+    __slots__ = ('queries', 'seconds', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+
+_query_stats = threading.local()
+
+
+def begin_query_stats(stats=None):
+    """开始统计当前线程的查询 (请求开始时调用), 返回统计对象; 传入 stats 时继续计入该对象 (流式响应输出期间)"""
+    stats = _query_stats.current = stats or QueryStats()
+    return stats
+
+
+def end_query_stats():
+    """结束当前线程的统计, 之后借出的游标不再计数; 已借出的游标 (流式响应) 继续计入原统计对象"""
+    stats = getattr(_query_stats, 'current', None)
+    _query_stats.current = None
+    return stats
+
+
+class MeteredCursor:
+    """
+    记录执行与读取耗时的游标代理; 其他属性 (description、rowcount、itersize 等) 直接转发
+    只在统计开启的线程中使用, 后台线程 (同步、事件监听) 拿到的仍是原始游标
+    """
+    __slots__ = ('_cursor', '_stats')
+
+    def __init__(self, cursor, stats):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_stats', stats)
+
+    def _timed(self, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._stats.seconds += time.perf_counter() - started
+
+    def execute(self, *args, **kwargs):
+        self._stats.queries += 1
+        result = self._timed(self._cursor.execute, *args, **kwargs)
+        # sqlite3 的 execute 返回游标本身, 保持链式调用
+        return self if result is self._cursor else result
+
+    def executemany(self, *args, **kwargs):
+        self._stats.queries += 1
+        result = self._timed(self._cursor.executemany, *args, **kwargs)
+        return self if result is self._cursor else result
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        if row is not None:
+            self._stats.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._timed(self._cursor.fetchmany, *args, **kwargs)
+        self._stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._stats.rows += 1
+            yield row
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._cursor.__exit__(*exc)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class PooledConnection:
+    """
+    从连接池借出的连接
+
+    接口与原始连接一致 (cursor/commit/rollback/close), close() 将连接归还连接池,
+    可重复调用; 也可作为上下文管理器使用 (正常退出提交, 异常回滚)
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._raw.cursor(*args, **kwargs)
+        stats = getattr(_query_stats, 'current', None)
+        return cursor if stats is None else MeteredCursor(cursor, stats)
+
+    def commit(self):
+        return self._raw.commit()
+
+    def rollback(self):
+        return self._raw.rollback()
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type:
+                self._raw.rollback()
+            else:
+                self._raw.commit()
+        finally:
+            self.close()
+
+    def __del__(self):
+        # 防止调用方遗漏 close() 导致连接泄漏
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """获取当前进程的连接池 (gunicorn fork 后在子进程中重新创建)"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                if USE_POSTGRES:
+                    _pool = PostgresPool(DATABASE_URL)
+                else:
+                    _pool = SQLitePool(os.environ.get('DATABASE_PATH') or get_sqlite_db_path())
+                _pool_pid = pid
+    return _pool
+
+
+def acquire_connection():
+    """从连接池借出一个连接, 使用完毕后调用 close() 归还"""
+    pool = get_pool()
+    return PooledConnection(pool, pool.acquire())
+
+
+def get_pool_stats():
+    """返回连接池大小与等待时间指标"""
+    return get_pool().get_stats()
+
+
+@contextmanager
+def get_db_connection():
+    """
+    获取数据库连接的上下文管理器
+    自动适配 SQLite 或 PostgreSQL, 连接来自连接池
+    """
+    conn = acquire_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 def convert_sql(sql):
     """
@@ -136,6 +608,25 @@ def execute_query(query, params=None, fetch_one=False, fetch_all=False):
         else:
             return cursor.rowcount
 
+def table_exists(cursor, table_name):
+    """检查数据表是否存在"""
+    if USE_POSTGRES:
+        cursor.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = %s)", (table_name,))
+        return bool(cursor.fetchone()[0])
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+    return cursor.fetchone() is not None
+
+def insert_returning_id(cursor, sql, params=()):
+    """
+    执行 INSERT 并返回新记录的 id
+    PostgreSQL 的 cursor.lastrowid 不是主键, 改用 RETURNING id
+    """
+    if USE_POSTGRES:
+        cursor.execute(sql + " RETURNING id", params)
+        return cursor.fetchone()[0]
+    cursor.execute(sql, params)
+    return cursor.lastrowid
+
 def get_db_type():
     """返回当前使用的数据库类型"""
     return 'PostgreSQL' if USE_POSTGRES else 'SQLite'
@@ -143,10 +634,15 @@ def get_db_type():
 # 导出常用函数
 __all__ = [
     'get_db_connection',
+    'acquire_connection',
+    'get_pool_stats',
+    'PoolTimeout',
     'convert_sql',
     'get_placeholder',
     'convert_placeholders',
     'execute_query',
+    'table_exists',
+    'insert_returning_id',
     'get_db_type',
     'USE_POSTGRES'
 ]
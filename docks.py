@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+道口占用状态 (dock_state) - 每个道口当前停靠的车辆
+
+每个道口一行: 道口号 -> 最后到达的一台车 (不含 Car/Van) 的记录 ID、到达时间、车型、车牌号.
+record() 计算上一台车的占用时长、check_duplicate() 判断重复录入时按主键读取, 不再对
+inbound_records 排序查找 "道口最后一条记录"; /api/docks 直接返回整张表作为实时道口看板.
+
+维护方式 (与对 inbound_records 的修改在同一事务中):
+- record(): 新车到达, set_current() 直接替换为新记录
+- update_record() / delete_record() / 批量录入: refresh_docks() 按 (dock_no, created_at) 索引重新取每个受影响道口的最后一条记录
+- init_db() 在状态表为空时自动回填
+- 手动重建: python docks.py rebuild
+
+表结构由 migrations.py 创建 (版本 10).
+"""
+import sys
+from datetime import datetime
+
+from app_logging import get_logger
+from database import get_db_connection, table_exists, USE_POSTGRES
+
+log = get_logger(__name__)
+
+DOCK_STATE_TABLE = 'dock_state'
+# 不占用道口、不计算时长的车型
+NON_DOCK_VEHICLE_TYPES = ('Car', 'Van')
+# PostgreSQL 回填时使用的咨询锁, 避免多个 worker 同时回填
+DOCK_STATE_ADVISORY_LOCK_ID = 7302018
+
+
+def occupies_dock(dock_no, vehicle_type):
+    """该记录是否占用道口 (有道口号且不是 Car/Van)"""
+    return bool(dock_no) and vehicle_type not in NON_DOCK_VEHICLE_TYPES
+
+
+def _row_value(record, key):
+    try:
+        return record[key]
+    except (KeyError, IndexError):
+        return None
+
+
+def parse_arrived_at(value):
+    """到达时间解析为 datetime (SQLite 为字符串, PostgreSQL 为 datetime)"""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def get_current(cursor, dock_no, for_update=False):
+    """
+    道口当前的车辆 (record_id, arrived_at, vehicle_type, vehicle_no), 空闲时为 None
+    for_update=True 时 PostgreSQL 锁定该行到事务结束, 同一道口的并发录入依次计算时长
+    """
+    query = f"""
+        SELECT record_id, arrived_at, vehicle_type, vehicle_no
+        FROM {DOCK_STATE_TABLE} WHERE dock_no = ?"""
+    if for_update and USE_POSTGRES:
+        query += " FOR UPDATE"
+    cursor.execute(query, (dock_no,))
+    return cursor.fetchone()
+
+
+def set_current(cursor, dock_no, record_id, arrived_at, vehicle_type, vehicle_no=None):
+    """道口换成新到达的车辆"""
+    if isinstance(arrived_at, datetime):
+        arrived_at = arrived_at.strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute(f"""
+        INSERT INTO {DOCK_STATE_TABLE} (dock_no, record_id, arrived_at, vehicle_type, vehicle_no, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (dock_no) DO UPDATE SET
+            record_id = excluded.record_id,
+            arrived_at = excluded.arrived_at,
+            vehicle_type = excluded.vehicle_type,
+            vehicle_no = excluded.vehicle_no,
+            updated_at = excluded.updated_at
+    """, (dock_no, record_id, arrived_at, vehicle_type, vehicle_no,
+          datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def refresh_dock(cursor, dock_no):
+    """按 inbound_records 重新确定道口当前的车辆 (走 dock_no + created_at 索引); 没有记录时删除该道口"""
+    cursor.execute("""
+        SELECT id, created_at, vehicle_type, vehicle_no FROM inbound_records
+        WHERE dock_no = ? AND vehicle_type NOT IN ('Car', 'Van')
+        ORDER BY created_at DESC, id DESC
+        LIMIT 1
+    """, (dock_no,))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute(f"DELETE FROM {DOCK_STATE_TABLE} WHERE dock_no = ?", (dock_no,))
+    else:
+        set_current(cursor, dock_no, row[0], row[1], row[2], row[3])
+
+
+def refresh_docks(cursor, *records):
+    """
+    修改或删除入库记录后, 重新确定这些记录 (修改前和修改后) 所在的道口
+    records: 记录行或字典, None 忽略
+    """
+    dock_numbers = set()
+    for record in records:
+        if record:
+            dock_no = _row_value(record, 'dock_no')
+            if dock_no:
+                dock_numbers.add(dock_no)
+    for dock_no in sorted(dock_numbers, key=str):
+        refresh_dock(cursor, dock_no)
+
+
+def list_docks(cursor):
+    """所有道口的当前车辆, 按道口号排序"""
+    cursor.execute(f"""
+        SELECT dock_no, record_id, arrived_at, vehicle_type, vehicle_no
+        FROM {DOCK_STATE_TABLE} ORDER BY dock_no
+    """)
+    return cursor.fetchall()
+
+
+def rebuild_dock_state(cursor):
+    """根据 inbound_records 全量重建道口状态, 返回道口数"""
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_xact_lock(?)", (DOCK_STATE_ADVISORY_LOCK_ID,))
+    cursor.execute(f"DELETE FROM {DOCK_STATE_TABLE}")
+    cursor.execute("""
+        SELECT DISTINCT dock_no FROM inbound_records
+        WHERE dock_no IS NOT NULL AND vehicle_type NOT IN ('Car', 'Van')
+    """)
+    dock_numbers = [row[0] for row in cursor.fetchall()]
+    for dock_no in dock_numbers:
+        refresh_dock(cursor, dock_no)
+    return len(dock_numbers)
+
+
+def backfill_if_empty(cursor):
+    """状态表为空而入库记录不为空时自动回填 (首次部署)"""
+    if not table_exists(cursor, DOCK_STATE_TABLE) or not table_exists(cursor, 'inbound_records'):
+        return False
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_xact_lock(?)", (DOCK_STATE_ADVISORY_LOCK_ID,))
+    cursor.execute(f"SELECT 1 FROM {DOCK_STATE_TABLE} LIMIT 1")
+    if cursor.fetchone():
+        return False
+    cursor.execute("SELECT 1 FROM inbound_records LIMIT 1")
+    if not cursor.fetchone():
+        return False
+    log.info("已回填 %s 个道口", rebuild_dock_state(cursor))
+    return True
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ('rebuild', 'status'):
+        print("用法: python docks.py rebuild   # 根据入库记录重建道口状态")
+        print("      python docks.py status    # 查看各道口当前车辆")
+        return 1
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if argv[1] == 'rebuild':
+            print(f"[道口状态] 重建完成: {rebuild_dock_state(cursor)} 个道口")
+        else:
+            for dock_no, record_id, arrived_at, vehicle_type, vehicle_no in list_docks(cursor):
+                print(f"  道口 {dock_no}: 记录 {record_id} {vehicle_type} {vehicle_no or ''} 到达于 {arrived_at}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+道口占用时长 - 用窗口函数一次性重新计算 (替代 migrate_duration.py)
+
+规则与 record() 相同: 同一道口的车辆 (不含 Car/Van) 按到达时间 (created_at, id) 排列,
+每台车的时长为到下一台车到达的分钟数 (向下取整), 道口上最后一台车为 NULL.
+
+recompute_durations() 用 LEAD(created_at) OVER (PARTITION BY dock_no ...) 算出每台车的时长,
+在一条 UPDATE ... FROM 中只写入与现有值不同的行 (SQLite 3.35+ 与 PostgreSQL 通用),
+不再逐道口读取记录、逐行解析时间和 UPDATE. 可以限定道口和时间范围:
+- dock_numbers: 只计算这些道口
+- since: 从该时间之前道口上的最后一台车开始 (它的下一台车可能变化)
+- until: 只写入不晚于该时间的记录 (之后的记录下一台车不变, 保留手工修改的时长)
+
+update_record() 修改道口号或车型、delete_record() 删除占用道口的记录后, 调用
+recompute_for_records() 只重新计算受影响道口在该记录前后的时长.
+
+命令行:
+    python durations.py rebuild    重新计算所有记录的时长 (Car/Van 及没有道口号的记录清空)
+    python durations.py check      只统计与重新计算结果不一致的记录数, 不写入
+"""
+import sqlite3
+import sys
+from datetime import datetime
+
+import outbox
+from database import get_db_connection, USE_POSTGRES
+
+# 不占用道口、不计算时长的车型 (与 docks.NON_DOCK_VEHICLE_TYPES 一致)
+OCCUPYING_FILTER = "dock_no IS NOT NULL AND vehicle_type NOT IN ('Car', 'Van')"
+
+# 时长 (分钟): 两次到达的间隔向下取整; 按时间排序后 next_at 不会早于 created_at
+if USE_POSTGRES:
+    MINUTES_EXPR = "CAST(FLOOR(EXTRACT(EPOCH FROM (next_at - created_at)) / 60) AS INTEGER)"
+    DISTINCT_EXPR = "inbound_records.duration IS DISTINCT FROM computed.new_duration"
+else:
+    MINUTES_EXPR = ("(CAST(strftime('%s', next_at) AS INTEGER)"
+                    " - CAST(strftime('%s', created_at) AS INTEGER)) / 60")
+    DISTINCT_EXPR = "inbound_records.duration IS NOT computed.new_duration"
+
+# UPDATE ... FROM 需要 SQLite 3.33, RETURNING 需要 3.35; 更早的版本先查询差异再按 ID 更新
+SUPPORTS_UPDATE_RETURNING = USE_POSTGRES or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def _time_str(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value)[:19]
+
+
+def _row_value(record, key):
+    try:
+        return record[key]
+    except (KeyError, IndexError):
+        return None
+
+
+def _computed_cte(dock_numbers=None, since=None):
+    """返回 (WITH 子句, 参数): computed(id, created_at, new_duration) 为范围内每台车重新计算的时长"""
+    conditions = ["r.dock_no IS NOT NULL AND r.vehicle_type NOT IN ('Car', 'Van')"]
+    params = []
+    if dock_numbers is not None:
+        conditions.append(f"r.dock_no IN ({', '.join('?' * len(dock_numbers))})")
+        params.extend(dock_numbers)
+    if since is not None:
+        # 从 since 之前该道口的最后一台车开始, 窗口内的 LEAD 与全表计算结果相同
+        conditions.append(f"""r.created_at >= COALESCE((
+                SELECT MAX(p.created_at) FROM inbound_records p
+                WHERE p.dock_no = r.dock_no AND p.vehicle_type NOT IN ('Car', 'Van') AND p.created_at < ?
+            ), ?)""")
+        params.extend([_time_str(since), _time_str(since)])
+    cte = f"""
+        WITH ordered AS (
+            SELECT r.id, r.created_at,
+                   LEAD(r.created_at) OVER (PARTITION BY r.dock_no ORDER BY r.created_at, r.id) AS next_at
+            FROM inbound_records r
+            WHERE {' AND '.join(conditions)}
+        ),
+        computed AS (
+            SELECT id, created_at,
+                   CASE WHEN next_at IS NULL THEN NULL ELSE {MINUTES_EXPR} END AS new_duration
+            FROM ordered
+        )"""
+    return cte, params
+
+
+def recompute_durations(cursor, dock_numbers=None, since=None, until=None):
+    """
+    重新计算道口占用时长, 只写入有变化的记录 (同时更新 updated_at 并写入 outbox)
+    调用方负责提交; 返回有变化的记录 [{'id', 'duration'}]
+    """
+    if dock_numbers is not None:
+        dock_numbers = sorted(set(dock_numbers), key=str)
+        if not dock_numbers:
+            return []
+    cte, cte_params = _computed_cte(dock_numbers, since)
+    condition = f"inbound_records.id = computed.id AND {DISTINCT_EXPR}"
+    condition_params = []
+    if until is not None:
+        condition += " AND computed.created_at <= ?"
+        condition_params.append(_time_str(until))
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    if SUPPORTS_UPDATE_RETURNING:
+        cursor.execute(f"""{cte}
+            UPDATE inbound_records SET duration = computed.new_duration, updated_at = ?
+            FROM computed
+            WHERE {condition}
+            RETURNING inbound_records.id, inbound_records.duration
+        """, cte_params + [now_str] + condition_params)
+        changed = [{'id': row[0], 'duration': row[1]} for row in cursor.fetchall()]
+    else:
+        cursor.execute(f"""{cte}
+            SELECT computed.id, computed.new_duration
+            FROM computed JOIN inbound_records ON {condition}
+        """, cte_params + condition_params)
+        changed = [{'id': row[0], 'duration': row[1]} for row in cursor.fetchall()]
+        cursor.executemany("UPDATE inbound_records SET duration = ?, updated_at = ? WHERE id = ?",
+                           [(item['duration'], now_str, item['id']) for item in changed])
+
+    for item in changed:
+        outbox.record_row_change(cursor, 'inbound_records', item['id'])
+    return changed
+
+
+def count_stale_durations(cursor):
+    """与重新计算结果不一致的占用道口记录数"""
+    cte, params = _computed_cte()
+    cursor.execute(f"""{cte}
+        SELECT COUNT(*) FROM computed JOIN inbound_records
+            ON inbound_records.id = computed.id AND {DISTINCT_EXPR}
+    """, params)
+    return cursor.fetchone()[0]
+
+
+def _placement(record):
+    """记录占用的道口号, 不占用道口时为 None"""
+    if not record:
+        return None
+    dock_no = _row_value(record, 'dock_no')
+    if not dock_no or _row_value(record, 'vehicle_type') in ('Car', 'Van'):
+        return None
+    return dock_no
+
+
+def placement_changed(old_record, new_record):
+    """修改是否改变了记录占用的道口 (道口号变化, 或在占用/不占用道口的车型之间切换)"""
+    return _placement(old_record) != _placement(new_record)
+
+
+def recompute_for_records(cursor, *records):
+    """
+    记录被修改 (修改前、修改后) 或删除后, 重新计算所在道口在这些记录前后的时长:
+    前一台车的下一台车变了, 记录本身 (修改后) 的下一台车也可能变了; 之后的记录不受影响
+    """
+    dock_numbers = set()
+    times = []
+    for record in records:
+        dock_no = _placement(record)
+        if dock_no is None or _row_value(record, 'created_at') is None:
+            continue
+        dock_numbers.add(dock_no)
+        times.append(_time_str(_row_value(record, 'created_at')))
+    if not dock_numbers:
+        return []
+    return recompute_durations(cursor, dock_numbers, since=min(times), until=max(times))
+
+
+def rebuild_durations(cursor):
+    """重新计算所有记录的时长, 返回 (重新计算后有变化的记录数, 清空时长的 Car/Van 等记录数)"""
+    outbox.begin_write(cursor)
+    changed = recompute_durations(cursor)
+    cursor.execute(f"""
+        SELECT id FROM inbound_records
+        WHERE duration IS NOT NULL AND NOT ({OCCUPYING_FILTER})
+    """)
+    cleared_ids = [row[0] for row in cursor.fetchall()]
+    if cleared_ids:
+        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cursor.executemany("UPDATE inbound_records SET duration = NULL, updated_at = ? WHERE id = ?",
+                           [(now_str, record_id) for record_id in cleared_ids])
+        for record_id in cleared_ids:
+            outbox.record_row_change(cursor, 'inbound_records', record_id)
+    return len(changed), len(cleared_ids)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ('rebuild', 'check'):
+        print("用法: python durations.py rebuild   # 重新计算所有记录的道口占用时长")
+        print("      python durations.py check     # 统计时长与重新计算结果不一致的记录数")
+        return 1
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if argv[1] == 'rebuild':
+            changed, cleared = rebuild_durations(cursor)
+            print(f"[时长] 重新计算完成: 更新 {changed} 条记录, 清空 {cleared} 条不占用道口的记录")
+        else:
+            print(f"[时长] 与重新计算结果不一致的记录: {count_stale_durations(cursor)} 条")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
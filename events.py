@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+跨进程事件总线 - SSE 推送与响应缓存失效
+
+gunicorn 多个 worker 时, SSE 客户端和响应缓存都在各自进程内存中.
+broadcast_update() 先在本进程内推送并使缓存失效, 再通过事件总线发布,
+其他 worker 的监听线程收到后执行同样的本地处理.
+
+后端 (环境变量 EVENT_BACKEND):
+- memory    仅本进程, 适合单进程运行 (python single_app.py)
+- sqlite    同一主机多进程: 共享 SQLite 事件文件, 监听线程轮询新事件
+- postgres  PostgreSQL LISTEN/NOTIFY (设置了 DATABASE_URL 时默认使用)
+未设置时: PostgreSQL 部署使用 postgres, 否则使用 sqlite
+
+其他环境变量:
+- EVENT_POLL_INTERVAL   sqlite 后端轮询间隔 (秒, 默认 0.5)
+- EVENT_DB_PATH         sqlite 后端事件文件 (默认与数据库同目录的 events.db)
+- EVENT_DATABASE_URL    postgres 后端 LISTEN 使用的连接串;
+                        连接池模式 (如 Neon -pooler 地址) 不支持 LISTEN, 需要直连地址
+"""
+import json
+import os
+import select
+import socket
+import threading
+import time
+
+from app_logging import get_logger
+from database import DATABASE_URL, USE_POSTGRES, get_db_connection, get_sqlite_db_path
+
+log = get_logger(__name__)
+
+EVENT_BACKEND = os.environ.get('EVENT_BACKEND') or ('postgres' if USE_POSTGRES else 'sqlite')
+EVENT_POLL_INTERVAL = float(os.environ.get('EVENT_POLL_INTERVAL', 0.5))
+EVENT_CHANNEL = 'inbound_events'
+# sqlite 后端保留事件的时间 (秒), 之后清理
+EVENT_RETENTION_SECONDS = 600
+# postgres 监听连接断开后的重连间隔 (秒)
+EVENT_RECONNECT_SECONDS = 5
+
+
+def _process_origin():
+    """事件来源标识: 主机名 + 进程号, 用于忽略本进程自己发布的事件"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class EventBus:
+    """
+    事件总线基类
+    - publish(message): 发布给其他 worker (本进程的处理由调用方直接完成)
+    - subscribe(callback): 注册回调, 在监听线程中以 message 调用
+    - start(): 启动监听线程, 每个进程只启动一次 (fork 之后需要重新启动)
+    """
+    name = 'base'
+
+    def __init__(self):
+        self._subscribers = []
+        self._started_pid = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def start(self):
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._start_listener()
+
+    def publish(self, message):
+        payload = json.dumps({'origin': _process_origin(), 'message': message}, ensure_ascii=False, default=str)
+        try:
+            self._publish(payload)
+        except Exception as e:
+            # 发布失败不影响写入本身, 其他 worker 的缓存由 TTL 兜底
+            log.warning("发布失败 (%s): %s", self.name, e)
+
+    def _dispatch(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if event.get('origin') == _process_origin():
+            return
+        for callback in self._subscribers:
+            try:
+                callback(event.get('message') or {})
+            except Exception as e:
+                log.exception("处理事件出错: %s", e)
+
+    def _start_listener(self):
+        pass
+
+    def _publish(self, payload):
+        pass
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target, name=f"event-listener-{self.name}", daemon=True)
+        thread.start()
+
+
+class MemoryEventBus(EventBus):
+    """仅本进程: 本地推送已由 broadcast_update 完成, 无需转发"""
+    name = 'memory'
+
+
+class SQLiteEventBus(EventBus):
+    """同一主机多进程: 事件写入共享的 SQLite 文件, 各进程轮询新事件"""
+    name = 'sqlite'
+
+    def __init__(self, path, poll_interval=EVENT_POLL_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self._last_cleanup = 0.0
+
+    def _connect(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        return conn
+
+    def _publish(self, payload):
+        conn = self._connect()
+        try:
+            now = time.time()
+            conn.execute("INSERT INTO events (payload, created_at) VALUES (?, ?)", (payload, now))
+            if now - self._last_cleanup > EVENT_RETENTION_SECONDS:
+                conn.execute("DELETE FROM events WHERE created_at < ?", (now - EVENT_RETENTION_SECONDS,))
+                self._last_cleanup = now
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _start_listener(self):
+        self._spawn(self._listen)
+
+    def _listen(self):
+        conn = self._connect()
+        # 只处理启动之后的新事件
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                rows = conn.execute(
+                    "SELECT id, payload FROM events WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+            except Exception as e:
+                log.warning("读取事件出错: %s", e)
+                continue
+            for event_id, payload in rows:
+                last_id = event_id
+                self._dispatch(payload)
+
+
+class PostgresEventBus(EventBus):
+    """PostgreSQL LISTEN/NOTIFY: 发布使用连接池, 监听使用一个独立的长连接"""
+    name = 'postgres'
+
+    def __init__(self, dsn, channel=EVENT_CHANNEL):
+        super().__init__()
+        self.dsn = dsn
+        self.channel = channel
+
+    def _publish(self, payload):
+        with get_db_connection() as conn:
+            conn.cursor().execute("SELECT pg_notify(?, ?)", (self.channel, payload))
+
+    def _start_listener(self):
+        self._spawn(self._listen)
+
+    def _listen(self):
+        import psycopg2
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {self.channel}")
+                log.info("已监听 PostgreSQL 通道 %s", self.channel)
+                if connected_before:
+                    # 断线期间可能漏掉事件, 通知本进程整体刷新
+                    self._dispatch(json.dumps({'origin': 'resync', 'message': {
+                        'type': 'refresh_stats', 'data': {'action': 'resync'}}}))
+                connected_before = True
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                log.warning("监听连接断开: %s, %s 秒后重连", e, EVENT_RECONNECT_SECONDS)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(EVENT_RECONNECT_SECONDS)
+
+
+def create_event_bus(backend=EVENT_BACKEND):
+    """按名称创建事件总线"""
+    if backend == 'postgres':
+        if not USE_POSTGRES:
+            log.warning("未使用 PostgreSQL, 事件总线改用 sqlite")
+            backend = 'sqlite'
+        else:
+            return PostgresEventBus(os.environ.get('EVENT_DATABASE_URL') or DATABASE_URL)
+    if backend == 'sqlite':
+        db_path = os.environ.get('DATABASE_PATH') or get_sqlite_db_path()
+        default_path = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'events.db')
+        return SQLiteEventBus(os.environ.get('EVENT_DB_PATH') or default_path)
+    if backend != 'memory':
+        log.warning("未知的 EVENT_BACKEND=%s, 使用 memory", backend)
+    return MemoryEventBus()
+
+
+event_bus = create_event_bus()
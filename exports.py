@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+导出工具 - 流式生成 Excel / CSV / JSON Lines, 不在程序目录下写临时文件
+
+- 查询结果按批读取 (fetchmany), 不一次性载入内存;
+  PostgreSQL 使用服务端游标 (命名游标), 结果集留在数据库端按批取回
+- 读取时一次计算列宽, 行数据暂存在 SpooledTemporaryFile 中 (小数据在内存, 大数据自动落盘)
+- openpyxl write-only 模式逐行写入, 工作簿保存到内存/临时缓冲区后分块返回给客户端
+- CSV / JSON Lines 边查询边输出, 可选 gzip 压缩
+"""
+import csv
+import io
+import json
+import marshal
+import tempfile
+import uuid
+import zlib
+from datetime import date, datetime
+
+from flask import Response
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
+
+from app_logging import get_logger
+from database import USE_POSTGRES
+
+log = get_logger(__name__)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+CSV_MIMETYPE = 'text/csv'
+JSONL_MIMETYPE = 'application/x-ndjson'
+GZIP_MIMETYPE = 'application/gzip'
+EXPORT_FORMATS = ('csv', 'xlsx', 'jsonl')
+
+# 每次从数据库读取的行数
+FETCH_BATCH_SIZE = 1000
+# 缓冲区超过该大小后写入磁盘临时文件 (字节)
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+# 响应分块大小 (字节)
+STREAM_CHUNK_SIZE = 64 * 1024
+# 列宽上限 (与原导出保持一致)
+MAX_COLUMN_WIDTH = 50
+
+
+def iter_cursor(cursor, batch_size=FETCH_BATCH_SIZE):
+    """按批读取查询结果, 逐行返回"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def open_stream_cursor(conn, query, params=()):
+    """
+    打开用于大批量导出的游标
+    PostgreSQL 使用命名游标 (服务端游标), 每次 fetchmany 才从数据库取回一批;
+    SQLite 游标本身就是逐行读取
+    """
+    if USE_POSTGRES:
+        cursor = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+        cursor.itersize = FETCH_BATCH_SIZE
+    else:
+        cursor = conn.cursor()
+    cursor.execute(query, params)
+    return cursor
+
+
+def _cell_value(value):
+    # PostgreSQL 返回 datetime/date 对象, 统一为 marshal 可以保存的值
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+class SpooledRows:
+    """
+    暂存一个工作表的数据行并计算列宽 (每个单元格只转换一次字符串)
+    写入 Excel 时按顺序读回
+    """
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.widths = [len(str(h)) for h in headers]
+        self.count = 0
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    def extend(self, rows):
+        widths = self.widths
+        for row in rows:
+            values = [_cell_value(v) for v in row]
+            for i, value in enumerate(values):
+                if value is not None:
+                    length = len(str(value))
+                    if length > widths[i]:
+                        widths[i] = length
+            marshal.dump(values, self._buffer)
+            self.count += 1
+        return self
+
+    def __iter__(self):
+        self._buffer.seek(0)
+        for _ in range(self.count):
+            yield marshal.load(self._buffer)
+
+    def close(self):
+        self._buffer.close()
+
+
+def _header_row(ws, headers):
+    header_font = Font(bold=True)
+    header_fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+    cells = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = Alignment(horizontal="center")
+        cells.append(cell)
+    return cells
+
+
+def build_workbook(sheets):
+    """
+    生成 xlsx 文件, 返回已定位到开头的缓冲区
+    sheets: [(工作表名, SpooledRows), ...]
+    """
+    wb = Workbook(write_only=True)
+    for title, spooled in sheets:
+        ws = wb.create_sheet(title)
+        # write-only 模式下列宽必须在写入第一行之前设置
+        for index, width in enumerate(spooled.widths, 1):
+            ws.column_dimensions[get_column_letter(index)].width = min(width + 2, MAX_COLUMN_WIDTH)
+        ws.append(_header_row(ws, spooled.headers))
+        for values in spooled:
+            ws.append(values)
+        spooled.close()
+
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    wb.save(output)
+    output.seek(0, 2)
+    size = output.tell()
+    output.seek(0)
+    return output, size
+
+
+def stream_file_response(output, size, filename, mimetype=XLSX_MIMETYPE):
+    """分块返回缓冲区内容, 结束后关闭缓冲区"""
+    def generate():
+        try:
+            while True:
+                chunk = output.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            output.close()
+
+    return Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Content-Length': str(size),
+    })
+
+
+# 区间导出支持的数据表: 名称 -> (表名, [(列名, 表头), ...])
+EXPORT_TABLES = {
+    'inbound': ('inbound_records', [
+        ('id', 'ID'), ('dock_no', '码头号'), ('vehicle_type', '车辆类型'), ('vehicle_no', '车牌号'),
+        ('unit', '单位'), ('load_amount', '装载量'), ('pieces', '件数'), ('time_slot', '时间段'),
+        ('shift_type', '班次类型'), ('remark', '备注'), ('created_at', '创建时间'), ('duration', '时长(分钟)'),
+    ]),
+    'sorting': ('sorting_records', [
+        ('id', 'ID'), ('sorting_time', '分拣日期'), ('pieces', '件数'), ('time_slot', '时间段'),
+        ('remark', '备注'), ('created_at', '创建时间'),
+    ]),
+}
+
+
+def resolve_export_columns(table, columns=None):
+    """
+    校验导出列, 返回 [(列名, 表头), ...]
+    columns 为逗号分隔的列名, 为空时导出全部列; 未知的表或列抛出 ValueError
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"table 参数无效，可选: {', '.join(EXPORT_TABLES)}")
+    available = EXPORT_TABLES[table][1]
+    if not columns:
+        return list(available)
+    labels = dict(available)
+    selected = []
+    for name in columns.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name not in labels:
+            raise ValueError(f"未知的列: {name}，可选: {', '.join(labels)}")
+        if name not in (c for c, _ in selected):
+            selected.append((name, labels[name]))
+    if not selected:
+        raise ValueError("columns 参数不能为空")
+    return selected
+
+
+def _csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_MINIMAL)
+    # 写入BOM以支持UTF-8编码的Excel打开
+    buffer.write('\ufeff')
+    writer.writerow([label for _, label in columns])
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([_cell_value(v) for v in row])
+        yield buffer.getvalue()
+
+
+def _jsonl_lines(columns, rows):
+    names = [name for name, _ in columns]
+    for row in rows:
+        yield json.dumps(dict(zip(names, (_cell_value(v) for v in row))), ensure_ascii=False) + '\n'
+
+
+def _chunked(lines, chunk_size=STREAM_CHUNK_SIZE):
+    """把逐行文本合并成约 chunk_size 字节的块, 避免每行一次写出"""
+    parts = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        parts.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield b''.join(parts)
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_rows_response(conn, cursor, columns, fmt, filename, gzip=False):
+    """
+    边读取边输出 CSV / JSON Lines, 输出结束 (或客户端断开) 时归还连接
+    conn, cursor 的生命周期交给响应, 调用方不要再关闭
+    """
+    def release():
+        try:
+            cursor.close()
+        except Exception:
+            pass
+        conn.close()
+
+    def generate():
+        try:
+            rows = iter_cursor(cursor)
+            lines = _csv_lines(columns, rows) if fmt == 'csv' else _jsonl_lines(columns, rows)
+            chunks = _chunked(lines)
+            if gzip:
+                chunks = _gzipped(chunks)
+            for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            # 响应头已经发出, 只能记录日志并截断输出
+            log.exception("输出过程中出错: %s", e)
+            raise
+        finally:
+            release()
+
+    mimetype = CSV_MIMETYPE if fmt == 'csv' else JSONL_MIMETYPE
+    if gzip:
+        filename += '.gz'
+        mimetype = GZIP_MIMETYPE
+    response = Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+    })
+    # 生成器未开始迭代就被丢弃 (HEAD 请求等) 时也要归还连接; close() 可重复调用
+    response.call_on_close(release)
+    return response
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+请求指标 - 每个路由的耗时分布、查询次数、数据库耗时、读取行数和响应字节数, /metrics 输出 Prometheus 文本格式
+
+init_metrics(app) 注册请求钩子:
+- before_request: 记录开始时间, 开启当前线程的查询统计 (database.begin_query_stats)
+- after_request: 按 (路由规则, 方法) 累加; 路由使用规则 (/api/record/<int:record_id>) 而不是实际路径, 避免标签数量膨胀
+  在压缩之后执行, 响应字节数为实际发送的字节数
+- 流式响应 (导出、SSE): 耗时记到响应头发出为止; 之后输出的字节与查询在响应结束时补记
+
+多 worker: 每个 gunicorn worker 的指标在各自进程内存中. 各 worker 每隔 METRICS_FLUSH_INTERVAL 秒
+把自己的快照写入 METRICS_DIR (同一 gunicorn 主进程下的 worker 共享), /metrics 合并所有 worker:
+路由指标相加, 连接池、SSE 等瞬时值按 worker 标签分别输出. 退出的 worker 的快照超过 METRICS_STALE_SECONDS 后忽略.
+
+开销: 每个请求几次计时和一次加锁累加; 每次查询多一层游标代理调用. 可以在生产环境常开.
+
+环境变量:
+- METRICS_ENABLED          是否启用 (1/0, 默认 1)
+- METRICS_DIR              各 worker 快照目录 (默认系统临时目录下的 inbound_metrics; 设为空只输出本进程)
+- METRICS_FLUSH_INTERVAL   写入快照的间隔 (秒, 默认 5)
+- METRICS_TOKEN            设置后 /metrics 需要 Authorization: Bearer <token>
+"""
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, request
+
+from database import begin_query_stats, end_query_stats, get_pool_stats
+from sse_hub import sse_hub
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'inbound_metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_STALE_SECONDS = 60
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRIC_PREFIX = 'inbound'
+
+# 请求耗时分桶上限 (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 路由累计值: 字段 -> (指标名, 说明)
+ROUTE_COUNTERS = {
+    'queries': ('http_db_queries_total', '请求执行的 SQL 次数'),
+    'db_seconds': ('http_db_seconds_total', '请求中执行 SQL 与读取结果的耗时 (秒)'),
+    'rows': ('http_db_rows_total', '请求从数据库读取的行数'),
+    'bytes': ('http_response_bytes_total', '响应体字节数 (压缩后)'),
+}
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+class RouteStats:
+    """一个 (路由, 方法) 的累计值; buckets 为各分桶 (不累积) 的请求数, 最后一个为超过最大分桶的请求"""
+    __slots__ = ('statuses', 'buckets', 'latency_sum', 'count', 'queries', 'db_seconds', 'rows', 'bytes')
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.count = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class RequestMetrics:
+    """本进程的请求指标, 以及各 worker 快照的写入与合并"""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._routes = {}
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._flusher_pid = None
+
+    # ---------------------------------------------------------------- 记录
+
+    def _route(self, route, method):
+        key = (route, method)
+        stats = self._routes.get(key)
+        if stats is None:
+            stats = self._routes[key] = RouteStats()
+        return stats
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def observe(self, route, method, status, latency, queries, db_seconds, rows, size):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+        with self._lock:
+            stats = self._route(route, method)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.buckets[bucket] += 1
+            stats.latency_sum += latency
+            stats.count += 1
+            stats.queries += queries
+            stats.db_seconds += db_seconds
+            stats.rows += rows
+            stats.bytes += size
+
+    def add(self, route, method, queries=0, db_seconds=0.0, rows=0, size=0):
+        """流式响应结束时补记输出期间的查询与字节数"""
+        with self._lock:
+            stats = self._route(route, method)
+            stats.queries += queries
+            stats.db_seconds += db_seconds
+            stats.rows += rows
+            stats.bytes += size
+
+    # ---------------------------------------------------------------- 快照
+
+    def snapshot(self):
+        """本进程的快照 (可 JSON 序列化)"""
+        with self._lock:
+            routes = [{'route': route, 'method': method, **stats.to_dict()}
+                      for (route, method), stats in self._routes.items()]
+            in_flight = self._in_flight
+        pool = get_pool_stats()
+        sse = sse_hub.get_stats()
+        return {
+            'pid': os.getpid(),
+            'ppid': os.getppid(),
+            'time': time.time(),
+            'routes': routes,
+            'gauges': {
+                'in_flight': in_flight,
+                'sse_clients': sse['clients'],
+                'sse_published': sse['published'],
+                'sse_dropped': sse['dropped'],
+                'pool_size': pool['size'],
+                'pool_in_use': pool['in_use'],
+                'pool_idle': pool['idle'],
+                'pool_waiting': pool['waiting'],
+                'pool_acquires': pool['acquires'],
+                'pool_timeouts': pool['timeouts'],
+                'pool_wait_seconds': pool['wait_total_ms'] / 1000,
+            },
+        }
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.directory, f'worker_{pid}.json')
+
+    def flush(self, snapshot=None):
+        """写入本进程的快照 (先写临时文件再替换, 读取方不会读到一半)"""
+        if not self.directory:
+            return
+        snapshot = snapshot or self.snapshot()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._snapshot_path(snapshot['pid'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+    def ensure_flusher(self):
+        """启动定时写入快照的线程 (每个进程一次, gunicorn fork 之后在 worker 中启动)"""
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            try:
+                self.flush()
+            except Exception:
+                # 写不了快照时只影响其他 worker 读取到的数据, 本进程的指标不受影响
+                pass
+            time.sleep(self.flush_interval)
+
+    def collect(self):
+        """本进程的最新快照与同一主进程下其他 worker 的快照"""
+        own = self.snapshot()
+        snapshots = [own]
+        if not self.directory:
+            return snapshots
+        try:
+            self.flush(own)
+            names = os.listdir(self.directory)
+        except OSError:
+            return snapshots
+        now = time.time()
+        for name in names:
+            if not name.startswith('worker_') or not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > METRICS_STALE_SECONDS:
+                    # 已退出的 worker 或上一次运行留下的快照
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if snapshot.get('pid') != own['pid'] and snapshot.get('ppid') == own['ppid']:
+                snapshots.append(snapshot)
+        return snapshots
+
+
+request_metrics = RequestMetrics()
+
+
+# -------------------------------------------------------------------- Prometheus 文本格式
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def render_prometheus(snapshots):
+    """合并各 worker 的快照, 输出 Prometheus 文本格式"""
+    routes = {}
+    for snapshot in snapshots:
+        for item in snapshot['routes']:
+            key = (item['route'], item['method'])
+            merged = routes.get(key)
+            if merged is None:
+                merged = routes[key] = RouteStats()
+            for status, count in item['statuses'].items():
+                merged.statuses[str(status)] = merged.statuses.get(str(status), 0) + count
+            merged.buckets = [a + b for a, b in zip(merged.buckets, item['buckets'])]
+            for name in ('latency_sum', 'count', 'queries', 'db_seconds', 'rows', 'bytes'):
+                setattr(merged, name, getattr(merged, name) + item[name])
+
+    lines = []
+
+    def metric(name, metric_type, help_text):
+        lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_{name} {metric_type}')
+
+    def sample(name, labels, value):
+        lines.append(f'{METRIC_PREFIX}_{name}{labels} {_format_value(value)}')
+
+    ordered = sorted(routes.items())
+    metric('http_requests_total', 'counter', '请求数')
+    for (route, method), stats in ordered:
+        for status, count in sorted(stats.statuses.items()):
+            sample('http_requests_total', _labels(route=route, method=method, status=status), count)
+
+    metric('http_request_duration_seconds', 'histogram', '请求处理耗时 (秒, 流式响应到响应头发出为止)')
+    for (route, method), stats in ordered:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+            cumulative += count
+            sample('http_request_duration_seconds_bucket', _labels(route=route, method=method, le=bound), cumulative)
+        sample('http_request_duration_seconds_bucket', _labels(route=route, method=method, le='+Inf'), stats.count)
+        sample('http_request_duration_seconds_sum', _labels(route=route, method=method), stats.latency_sum)
+        sample('http_request_duration_seconds_count', _labels(route=route, method=method), stats.count)
+
+    for field, (name, help_text) in ROUTE_COUNTERS.items():
+        metric(name, 'counter', help_text)
+        for (route, method), stats in ordered:
+            sample(name, _labels(route=route, method=method), getattr(stats, field))
+
+    gauges = (
+        ('in_flight', 'http_requests_in_flight', 'gauge', '正在处理的请求数'),
+        ('sse_clients', 'sse_clients', 'gauge', 'SSE 连接数'),
+        ('sse_published', 'sse_events_published_total', 'counter', '推送的 SSE 事件数'),
+        ('sse_dropped', 'sse_events_dropped_total', 'counter', '客户端缓冲区满而丢弃的 SSE 事件数'),
+        ('pool_size', 'db_pool_connections', 'gauge', '连接池中的连接数'),
+        ('pool_in_use', 'db_pool_connections_in_use', 'gauge', '借出中的连接数'),
+        ('pool_idle', 'db_pool_connections_idle', 'gauge', '空闲连接数'),
+        ('pool_waiting', 'db_pool_waiting', 'gauge', '等待连接的线程数'),
+        ('pool_acquires', 'db_pool_acquires_total', 'counter', '借出连接次数'),
+        ('pool_timeouts', 'db_pool_timeouts_total', 'counter', '等待连接超时次数'),
+        ('pool_wait_seconds', 'db_pool_wait_seconds_total', 'counter', '等待连接的总耗时 (秒)'),
+    )
+    for key, name, metric_type, help_text in gauges:
+        metric(name, metric_type, help_text)
+        for snapshot in snapshots:
+            sample(name, _labels(worker=snapshot['pid']), snapshot['gauges'][key])
+
+    metric('metrics_workers', 'gauge', '本次合并的 worker 数')
+    sample('metrics_workers', '', len(snapshots))
+    return '\n'.join(lines) + '\n'
+
+
+# -------------------------------------------------------------------- Flask 钩子
+
+def _route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else UNMATCHED_ROUTE
+
+
+def _count_stream(chunks, route, method, stats):
+    """流式响应: 统计实际输出的字节数, 以及生成过程中 (响应头发出之后) 的查询, 结束时补记"""
+    baseline = (stats.queries, stats.seconds, stats.rows)
+    size = 0
+    begin_query_stats(stats)
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        end_query_stats()
+        request_metrics.add(route, method, stats.queries - baseline[0], stats.seconds - baseline[1],
+                            stats.rows - baseline[2], size)
+
+
+def _before_request():
+    request_metrics.ensure_flusher()
+    request_metrics.request_started()
+    g.metrics_started = time.perf_counter()
+    g.metrics_query_stats = begin_query_stats()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    request_metrics.request_finished()
+    latency = time.perf_counter() - started
+    stats = g.pop('metrics_query_stats', None)
+    end_query_stats()
+
+    route, method = _route_label(), request.method
+    if response.is_streamed and not response.direct_passthrough:
+        size = 0
+        response.response = _count_stream(response.response, route, method, stats)
+    else:
+        # send_file 的文件响应保留 direct_passthrough (wsgi.file_wrapper), 按 Content-Length 计
+        size = response.content_length or 0
+    request_metrics.observe(route, method, str(response.status_code), latency,
+                            stats.queries, stats.seconds, stats.rows, size)
+    return response
+
+
+def _teardown_request(exc):
+    # after_request 没有执行 (处理异常时出错) 的请求也要结束计数
+    if g.pop('metrics_started', None) is not None:
+        request_metrics.request_finished()
+        end_query_stats()
+
+
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return 'Unauthorized', 401
+    body = render_prometheus(request_metrics.collect())
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def init_metrics(app):
+    """
+    注册请求指标钩子与 /metrics (METRICS_ENABLED=0 时不注册)
+    需要在 init_compression() 之前调用: after_request 按注册的相反顺序执行, 这样统计的是压缩后的字节数
+    """
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+数据库迁移 - 版本化管理热点查询所需的复合索引及后续新增的表和列
+
+init_db() 启动时调用 run_migrations(), SQLite 和 PostgreSQL 通用:
+- schema_migrations 表记录已完成的迁移版本
+- 索引或新增列依赖的表不存在时 (旧数据库), 该版本暂不记录, 下次启动重试
+- verify_indexes() 检查所有索引是否存在
+
+手动执行:
+    python migrations.py migrate   # 执行未完成的迁移
+    python migrations.py status    # 查看迁移版本和缺失的索引
+    python migrations.py explain   # 输出各接口查询的执行计划, 标记全表扫描
+"""
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from app_logging import get_logger
+from database import get_db_connection, convert_sql, table_exists, USE_POSTGRES
+
+log = get_logger(__name__)
+
+# PostgreSQL 多个 worker 同时启动时使用的咨询锁
+MIGRATION_ADVISORY_LOCK_ID = 7302002
+
+CREATE_MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# 迁移步骤
+# - 索引:   (索引名, 表名, (列, ...))
+# - 新增表: CreateTable(表名, 建表 SQL)
+# - 新增列: AddColumn(表名, 列名, 类型)
+# - 唯一索引: UniqueIndex(索引名, 表名, (列, ...))
+CreateTable = namedtuple('CreateTable', 'table_name sql')
+AddColumn = namedtuple('AddColumn', 'table_name column_name column_type')
+UniqueIndex = namedtuple('UniqueIndex', 'index_name table_name columns')
+
+# (版本号, 说明, [步骤, ...])
+# 已发布的版本不要修改, 新的表结构变更追加新版本
+MIGRATIONS = [
+    (1, 'inbound_records 热点查询索引', [
+        # 按时间范围查询: /api/stats, /api/list, /api/history, 导出
+        ('idx_inbound_records_created_at', 'inbound_records', ('created_at',)),
+        # 同一道口最后一条记录: check_duplicate(), record() 计算占用时长
+        ('idx_inbound_records_dock_created', 'inbound_records', ('dock_no', 'created_at')),
+        # 按车型 + 时间范围: 托盘统计
+        ('idx_inbound_records_type_created', 'inbound_records', ('vehicle_type', 'created_at')),
+        # 按车型 + 时间段: pallet_hourly_data() 历史平均
+        ('idx_inbound_records_type_slot', 'inbound_records', ('vehicle_type', 'time_slot')),
+    ]),
+    (2, 'sorting_records 热点查询索引', [
+        ('idx_sorting_records_time_slot', 'sorting_records', ('sorting_time', 'time_slot')),
+        ('idx_sorting_records_created_at', 'sorting_records', ('created_at',)),
+    ]),
+    (3, '日志、权限、预估表索引', [
+        ('idx_operation_logs_created_at', 'operation_logs', ('created_at',)),
+        ('idx_operation_logs_record', 'operation_logs', ('table_name', 'record_id')),
+        ('idx_user_permissions_user_page', 'user_permissions', ('user_id', 'page_name')),
+        ('idx_pickup_forecast_date', 'pickup_forecast', ('forecast_date',)),
+    ]),
+    (4, '同步状态索引 (替代 add_sync_index.py)', [
+        ('idx_inbound_records_is_synced', 'inbound_records', ('is_synced',)),
+    ]),
+    (5, '增量列表: 记录修改时间与删除记录', [
+        # /api/list?updated_since= 按修改时间增量返回
+        AddColumn('inbound_records', 'updated_at', 'DATETIME'),
+        ('idx_inbound_records_updated_at', 'inbound_records', ('updated_at',)),
+        # 已删除记录的 ID, 增量列表据此返回删除列表
+        CreateTable('deleted_records', """
+            CREATE TABLE IF NOT EXISTS deleted_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                record_id INTEGER NOT NULL,
+                deleted_at DATETIME NOT NULL
+            )
+        """),
+        ('idx_deleted_records_table_deleted', 'deleted_records', ('table_name', 'deleted_at')),
+    ]),
+    (6, '操作日志游标分页与筛选', [
+        # /api/logs?operation_type= / ?table_name= 按 ID 倒序分页
+        ('idx_operation_logs_type_id', 'operation_logs', ('operation_type', 'id')),
+        ('idx_operation_logs_table_id', 'operation_logs', ('table_name', 'id')),
+        # /api/logs?record_id= 单条记录的修改历史
+        ('idx_operation_logs_record_id', 'operation_logs', ('record_id', 'id')),
+    ]),
+    (7, '变更日志 (outbox) 与消费进度', [
+        # 每次写入追加一行, 下游按 seq 顺序增量读取 (outbox.py)
+        CreateTable('change_outbox', """
+            CREATE TABLE IF NOT EXISTS change_outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                pk INTEGER,
+                op TEXT NOT NULL,
+                row_data TEXT,
+                created_at DATETIME NOT NULL
+            )
+        """),
+        # 各消费者已处理到的 seq
+        CreateTable('outbox_offsets', """
+            CREATE TABLE IF NOT EXISTS outbox_offsets (
+                consumer TEXT PRIMARY KEY,
+                last_seq INTEGER NOT NULL DEFAULT 0,
+                updated_at DATETIME
+            )
+        """),
+    ]),
+    (8, '入库记录客户端请求 ID (幂等写入)', [
+        # 离线队列为每条记录生成的 UUID, 重复提交时返回已有记录
+        AddColumn('inbound_records', 'client_request_id', 'TEXT'),
+        UniqueIndex('idx_inbound_records_client_request_id', 'inbound_records', ('client_request_id',)),
+    ]),
+    (9, '分拣记录客户端请求 ID (幂等写入)', [
+        AddColumn('sorting_records', 'client_request_id', 'TEXT'),
+        UniqueIndex('idx_sorting_records_client_request_id', 'sorting_records', ('client_request_id',)),
+    ]),
+    (10, '道口占用状态表', [
+        # 每个道口当前停靠的车辆, 由写接口在同一事务中维护 (docks.py), init_db() 首次回填
+        CreateTable('dock_state', """
+            CREATE TABLE IF NOT EXISTS dock_state (
+                dock_no INTEGER PRIMARY KEY,
+                record_id INTEGER NOT NULL,
+                arrived_at DATETIME NOT NULL,
+                vehicle_type TEXT,
+                vehicle_no TEXT,
+                updated_at DATETIME
+            )
+        """),
+    ]),
+    (11, '业务日与小时列', [
+        # 写入时计算 (business_days.py), 统计按业务日过滤和分组, 不再换算时区范围
+        AddColumn('inbound_records', 'business_date', 'DATE'),
+        AddColumn('inbound_records', 'hour_bucket', 'INTEGER'),
+        ('idx_inbound_records_business_date', 'inbound_records', ('business_date', 'vehicle_type')),
+        AddColumn('sorting_records', 'business_date', 'DATE'),
+        AddColumn('sorting_records', 'hour_bucket', 'INTEGER'),
+        ('idx_sorting_records_business_date', 'sorting_records', ('business_date',)),
+    ]),
+    (12, '用户权限版本号', [
+        # 修改权限、角色或删除用户时递增, 各 worker 的权限缓存据此失效 (permissions.py)
+        AddColumn('users', 'permissions_version', 'INTEGER DEFAULT 0'),
+    ]),
+    (13, '变更日志修改前数据', [
+        # 修改时同时记录修改前的整行, SSE 推送据此计算统计增量 (sse_hub.py)
+        AddColumn('change_outbox', 'old_row_data', 'TEXT'),
+    ]),
+]
+
+
+def get_columns(cursor, table_name):
+    """返回表的列名集合 (表不存在时为空)"""
+    if USE_POSTGRES:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ?",
+            (table_name,))
+        return {row[0] for row in cursor.fetchall()}
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+def index_exists(cursor, index_name):
+    if USE_POSTGRES:
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = ?", (index_name,))
+    else:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (index_name,))
+    return cursor.fetchone() is not None
+
+
+def get_applied_versions(cursor):
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def apply_migration(cursor, version, name, steps):
+    """
+    执行一个版本中的所有步骤
+    全部成功时记录版本并返回 True; 有表或列缺失时跳过相应步骤并返回 False
+    """
+    complete = True
+    for step in steps:
+        if isinstance(step, CreateTable):
+            cursor.execute(convert_sql(step.sql))
+            continue
+        if isinstance(step, AddColumn):
+            existing = get_columns(cursor, step.table_name)
+            if not existing:
+                log.warning("跳过新增列 %s.%s: 表不存在", step.table_name, step.column_name)
+                complete = False
+            elif step.column_name not in existing:
+                cursor.execute(convert_sql(
+                    f"ALTER TABLE {step.table_name} ADD COLUMN {step.column_name} {step.column_type}"))
+            continue
+
+        index_name, table_name, columns = step
+        missing = set(columns) - get_columns(cursor, table_name)
+        if missing:
+            log.warning("跳过索引 %s: %s 缺少列 %s", index_name, table_name, ', '.join(sorted(missing)))
+            complete = False
+            continue
+        unique = 'UNIQUE ' if isinstance(step, UniqueIndex) else ''
+        cursor.execute(
+            f"CREATE {unique}INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(columns)})")
+
+    if complete:
+        cursor.execute("""
+            INSERT INTO schema_migrations (version, name) VALUES (?, ?)
+            ON CONFLICT (version) DO NOTHING
+        """, (version, name))
+        log.info("已完成版本 %s: %s", version, name)
+    return complete
+
+
+def run_migrations(cursor):
+    """执行所有未完成的迁移, 返回本次完成的版本号列表"""
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_xact_lock(?)", (MIGRATION_ADVISORY_LOCK_ID,))
+    cursor.execute(convert_sql(CREATE_MIGRATIONS_TABLE))
+
+    applied = get_applied_versions(cursor)
+    completed = []
+    for version, name, steps in MIGRATIONS:
+        if version in applied:
+            continue
+        if apply_migration(cursor, version, name, steps):
+            completed.append(version)
+    return completed
+
+
+def verify_indexes(cursor):
+    """返回缺失的索引列表 [(索引名, 表名)]"""
+    missing = []
+    for _, _, steps in MIGRATIONS:
+        for step in steps:
+            if isinstance(step, (CreateTable, AddColumn)):
+                continue
+            index_name, table_name, _ = step
+            if not index_exists(cursor, index_name):
+                missing.append((index_name, table_name))
+    return missing
+
+
+def _hot_queries():
+    """
+    各接口热点查询 (SQL 与参数形式照抄 single_app.py / docks.py, 修改那边的查询时同步修改这里)
+    返回 [(名称, SQL, 参数)]
+    """
+    now = datetime.now()
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = day_start.strftime('%Y-%m-%d %H:%M:%S')
+    end = (day_start + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    yesterday_start = (day_start - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    day = day_start.strftime('%Y-%m-%d')
+    prev_day = (day_start - timedelta(days=1)).strftime('%Y-%m-%d')
+    next_day = (day_start + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    return [
+        ('check_duplicate / record 道口当前车辆', """
+            SELECT record_id, arrived_at, vehicle_type, vehicle_no
+            FROM dock_state WHERE dock_no = ?
+        """, (1,)),
+        ('docks.refresh_dock 道口最后一条记录', """
+            SELECT id, created_at, vehicle_type, vehicle_no
+            FROM inbound_records
+            WHERE dock_no = ? AND vehicle_type NOT IN ('Car', 'Van')
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        """, (1,)),
+        ('/api/list 昨天和今天的记录', """
+            SELECT ir.id, ir.dock_no, ir.vehicle_type, ir.vehicle_no, ir.unit, ir.load_amount,
+                   ir.pieces, ir.time_slot, ir.shift_type, ir.remark, ir.created_at, ir.created_by,
+                   u.username as created_by_username, ir.duration
+            FROM inbound_records ir
+            LEFT JOIN users u ON ir.created_by = u.id
+            WHERE ir.created_at >= ? AND ir.created_at < ?
+            ORDER BY ir.created_at DESC
+        """, (yesterday_start, end)),
+        ('/api/stats 分组统计 (当天与前一业务日, 与变更日志最大序号同一快照)', """
+            SELECT o.seq, s.*
+            FROM (SELECT MAX(seq) AS seq FROM change_outbox) o
+            LEFT JOIN (
+            SELECT
+                CASE WHEN business_date = ? THEN 1 ELSE 0 END AS is_current,
+                vehicle_type,
+                time_slot,
+                CASE WHEN time_slot IS NULL OR time_slot = '' THEN created_at END AS fallback_at,
+                COUNT(*) AS vehicles,
+                SUM(CASE
+                    WHEN vehicle_type = '53英尺' AND vehicle_no = 'G' THEN 0
+                    ELSE pieces
+                END) AS pieces,
+                SUM(CASE
+                    WHEN (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
+                         AND NOT (vehicle_type = '53英尺' AND vehicle_no = 'G') THEN load_amount
+                END) AS pallets
+            FROM inbound_records
+            WHERE business_date IN (?, ?)
+            GROUP BY 1, 2, 3, 4
+            ) s ON 1 = 1
+        """, (day, prev_day, day)),
+        ('/api/inbound_hourly 按时间段', """
+            SELECT
+                ir.time_slot,
+                SUM(ir.pieces) as total_pieces,
+                SUM(CASE
+                    WHEN ir.vehicle_type IN ('26英尺', '53英尺') THEN ir.load_amount
+                    ELSE 0
+                END) as total_load_amount
+            FROM inbound_records ir
+            WHERE
+                ir.business_date = ? AND ir.time_slot IS NOT NULL
+            GROUP BY ir.time_slot
+            ORDER BY ir.time_slot
+        """, (day,)),
+        ('/api/pallet_hourly 当天托盘', """
+            SELECT time_slot, SUM(load_amount) as total_load_amount, COUNT(*) as count
+            FROM inbound_records
+            WHERE
+                business_date = ? AND (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
+            GROUP BY time_slot
+            ORDER BY time_slot
+        """, (day,)),
+        ('/api/pallet_hourly 历史平均', """
+            SELECT
+                time_slot,
+                SUM(load_amount) as total_load_amount,
+                COUNT(*) as total_count,
+                COUNT(DISTINCT business_date) as days_count
+            FROM inbound_records
+            WHERE vehicle_type IN ('26英尺', '53英尺')
+                AND time_slot IS NOT NULL
+                AND time_slot != ''
+            GROUP BY time_slot
+            ORDER BY CAST(time_slot AS INTEGER)
+        """, ()),
+        ('/api/sorting_hourly 按分拣日期', """
+            SELECT time_slot, SUM(pieces) as total_pieces
+            FROM sorting_records
+            WHERE
+                sorting_time >= ? AND sorting_time < ? AND time_slot IS NOT NULL
+            GROUP BY time_slot
+            ORDER BY time_slot
+        """, (day, next_day)),
+        ('/api/history 入库记录', """
+            SELECT id, dock_no, vehicle_type, vehicle_no, unit, load_amount,
+                   pieces, time_slot, shift_type, remark, created_at, duration, is_synced
+            FROM inbound_records
+            WHERE
+                business_date = ?
+            ORDER BY created_at DESC
+        """, (day,)),
+        ('/api/history 分拣记录', """
+            SELECT id, sorting_time, pieces, remark, created_at, time_slot
+            FROM sorting_records
+            WHERE
+                sorting_time >= ? AND sorting_time < ?
+            ORDER BY created_at DESC
+        """, (day, next_day)),
+        ('/api/logs 最新日志', """
+            SELECT id, operation_type, table_name, record_id, old_data, new_data, created_at
+            FROM operation_logs
+            WHERE id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (1000000, 51)),
+        ('/api/logs 按操作类型', """
+            SELECT id, operation_type, table_name, record_id, old_data, new_data, created_at
+            FROM operation_logs
+            WHERE operation_type = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, ('edit', 1000000, 51)),
+        ('/api/logs 按记录', """
+            SELECT id, operation_type, table_name, record_id, old_data, new_data, created_at
+            FROM operation_logs
+            WHERE record_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (1, 51)),
+        ('/api/logs 按日期', """
+            SELECT id, operation_type, table_name, record_id, old_data, new_data, created_at
+            FROM operation_logs
+            WHERE created_at >= ? AND created_at < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (start, end, 51)),
+        ('delete_record 清理日志', """
+            SELECT id FROM operation_logs
+            WHERE table_name = 'inbound_records' AND record_id = ?
+        """, (1,)),
+        ('permissions.load_entry 用户全部权限 (登录、缓存失效后)', """
+            SELECT page_name, can_view, can_edit, can_delete
+            FROM user_permissions
+            WHERE user_id = ?
+        """, (1,)),
+        ('/api/pickup_forecast 按日期', """
+            SELECT forecast_amount FROM pickup_forecast WHERE forecast_date = ?
+        """, (day,)),
+    ]
+
+
+def explain_query(cursor, sql, params):
+    """返回 (执行计划文本行, 是否存在全表扫描)"""
+    if USE_POSTGRES:
+        cursor.execute("EXPLAIN " + sql, params)
+        lines = [row[0] for row in cursor.fetchall()]
+        full_scan = any('Seq Scan' in line for line in lines)
+    else:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        lines = [row[3] for row in cursor.fetchall()]
+        # "SCAN t" 为全表扫描; "SCAN t USING INDEX" 为按索引顺序扫描; 扫描子查询结果不算
+        subqueries = {line.split()[-1] for line in lines if line.startswith(('CO-ROUTINE', 'MATERIALIZE'))}
+        full_scan = any(line.startswith('SCAN') and 'USING' not in line and line.split()[1] not in subqueries
+                        for line in lines)
+    return lines, full_scan
+
+
+def explain_report(cursor):
+    """输出所有热点查询的执行计划, 返回存在全表扫描的查询名称列表"""
+    full_scans = []
+    for name, sql, params in _hot_queries():
+        try:
+            lines, full_scan = explain_query(cursor, sql, params)
+        except Exception as e:
+            print(f"[执行计划] {name}: 无法分析 ({e})")
+            if USE_POSTGRES:
+                cursor.connection.rollback()
+            continue
+        print(f"[执行计划] {name}{'  <-- 全表扫描' if full_scan else ''}")
+        for line in lines:
+            print(f"    {line}")
+        if full_scan:
+            full_scans.append(name)
+    if USE_POSTGRES and full_scans:
+        print("[执行计划] 注意: PostgreSQL 在小表上即使有索引也可能选择 Seq Scan, 请先执行 ANALYZE")
+    return full_scans
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ('migrate', 'status', 'explain'):
+        print("用法: python migrations.py migrate   # 执行未完成的迁移")
+        print("      python migrations.py status    # 查看迁移版本和缺失的索引")
+        print("      python migrations.py explain   # 输出热点查询执行计划")
+        return 1
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if argv[1] == 'migrate':
+            completed = run_migrations(cursor)
+            print(f"[迁移] 本次完成 {len(completed)} 个版本")
+            return 0
+
+        if argv[1] == 'status':
+            applied = get_applied_versions(cursor) if table_exists(cursor, 'schema_migrations') else set()
+            for version, name, _ in MIGRATIONS:
+                print(f"  [{'x' if version in applied else ' '}] {version}: {name}")
+            missing = verify_indexes(cursor)
+            for index_name, table_name in missing:
+                print(f"[迁移] 缺少索引: {index_name} ({table_name})")
+            return 1 if missing else 0
+
+        full_scans = explain_report(cursor)
+        print(f"[执行计划] 共 {len(_hot_queries())} 个查询, {len(full_scans)} 个存在全表扫描")
+        return 1 if full_scans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+变更日志 (outbox) - 记录每一次数据写入
+
+写接口在同一事务中向 change_outbox 追加一行: 序号 seq (单调递增)、表名、主键、
+操作类型 (insert/update/delete) 以及写入后的整行快照 (删除时为删除前的数据);
+修改时可同时记录修改前的整行 (old_row).
+下游 (同步到远程 PostgreSQL、/api/changes 等) 按 seq 顺序读取, 各自在 outbox_offsets
+中记录已处理到的序号, 不必重新扫描业务表.
+
+seq 的顺序与提交顺序一致: SQLite 只有一个写事务; PostgreSQL 的写事务第一条语句调用
+begin_write() 取事务级 advisory 锁, 持有到提交, 因此读到 seq=N 时所有小于 N 的变更都已提交,
+消费者按 "seq > 上次位置" 读取不会漏掉迟提交的事务. 锁必须在事务中其他行锁 (dock_state、
+daily_rollups) 之前取得, 所有写事务按同一顺序加锁, 不会互相死锁.
+
+已被所有消费者处理、且超过 OUTBOX_RETENTION_DAYS 的变更由后台线程每隔 OUTBOX_PRUNE_INTERVAL
+秒清理一次 (OutboxPruner); 没有登记消费者时只按保留天数清理. 超过保留天数没有确认过位置的消费者
+视为已失效, 不再阻止清理 (可用 drop 命令删除).
+
+表结构由 migrations.py 创建 (版本 7, old_row_data 列为版本 13).
+
+环境变量:
+- OUTBOX_RETENTION_DAYS   变更保留天数 (默认 7)
+- OUTBOX_PRUNE_INTERVAL   后台清理间隔 (秒, 默认 3600, 0 表示不在应用中清理)
+
+命令行:
+    python outbox.py status              各消费者的位置与积压
+    python outbox.py prune [保留天数]     删除所有消费者都已处理、且超过保留天数的变更 (默认 7 天)
+    python outbox.py drop 消费者          删除消费者的位置记录
+"""
+import json
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from app_logging import get_logger
+from database import USE_POSTGRES, get_db_connection
+
+log = get_logger(__name__)
+
+OUTBOX_TABLE = 'change_outbox'
+OFFSETS_TABLE = 'outbox_offsets'
+OPERATIONS = ('insert', 'update', 'delete')
+# PostgreSQL: 串行化 outbox 写入, 使 seq 顺序与提交顺序一致
+OUTBOX_ADVISORY_LOCK_ID = 7302015
+OUTBOX_RETENTION_DAYS = float(os.environ.get('OUTBOX_RETENTION_DAYS', '7'))
+OUTBOX_PRUNE_INTERVAL = float(os.environ.get('OUTBOX_PRUNE_INTERVAL', '3600'))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return str(value)
+
+
+def row_to_dict(row):
+    """数据库行 (sqlite3.Row / DictRow / dict) 转为普通字典"""
+    if row is None:
+        return None
+    return dict(row)
+
+
+def begin_write(cursor):
+    """
+    写事务的第一条语句: PostgreSQL 取 outbox 锁到提交 (SQLite 本身只有一个写事务, 无需处理)
+    之后同一事务中的 record_change() 按提交顺序分配 seq
+    """
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_xact_lock(?)", (OUTBOX_ADVISORY_LOCK_ID,))
+
+
+def _dump_row(row):
+    return json.dumps(row_to_dict(row), ensure_ascii=False, default=_json_default) if row else None
+
+
+def record_change(cursor, table_name, pk, op, row=None, old_row=None):
+    """
+    追加一条变更 (调用方负责提交, 与业务写入在同一事务中; 事务开始时已调用 begin_write)
+    row: 写入后的整行数据; 删除时为删除前的数据
+    old_row: 修改前的整行数据 (可选, 只用于 update)
+    """
+    if op not in OPERATIONS:
+        raise ValueError(f"未知的操作类型: {op}")
+    cursor.execute(f"""
+        INSERT INTO {OUTBOX_TABLE} (table_name, pk, op, row_data, old_row_data, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (table_name, pk, op, _dump_row(row), _dump_row(old_row),
+          datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def record_row_change(cursor, table_name, pk, op='update'):
+    """按主键读取当前整行, 追加一条变更"""
+    cursor.execute(f"SELECT * FROM {table_name} WHERE id = ?", (pk,))
+    row = cursor.fetchone()
+    if row is not None:
+        record_change(cursor, table_name, pk, op, row)
+
+
+def fetch_changes(cursor, after_seq, limit, table_name=None, raw=False):
+    """
+    读取 seq 大于 after_seq 的变更 (按 seq 升序)
+    table_name: 只返回该表的变更; raw=True 时 row/old_row 保持 JSON 字符串不解析
+    """
+    query = f"""
+        SELECT seq, table_name, pk, op, row_data, old_row_data, created_at
+        FROM {OUTBOX_TABLE}
+        WHERE seq > ?"""
+    params = [after_seq]
+    if table_name:
+        query += " AND table_name = ?"
+        params.append(table_name)
+    query += " ORDER BY seq LIMIT ?"
+    params.append(limit)
+    cursor.execute(query, params)
+    changes = []
+    for seq, table, pk, op, row_data, old_row_data, created_at in cursor.fetchall():
+        if isinstance(created_at, datetime):
+            created_at = created_at.strftime('%Y-%m-%d %H:%M:%S')
+        changes.append({
+            'seq': seq,
+            'table_name': table,
+            'pk': pk,
+            'op': op,
+            'row': row_data if raw or not row_data else json.loads(row_data),
+            'old_row': old_row_data if raw or not old_row_data else json.loads(old_row_data),
+            'created_at': created_at,
+        })
+    return changes
+
+
+def get_seq_range(cursor):
+    """当前保留的变更的 (最小 seq, 最大 seq); 没有变更时为 (None, None)"""
+    # 分成两个子查询, 各自只读主键索引的一端
+    cursor.execute(f"SELECT (SELECT MIN(seq) FROM {OUTBOX_TABLE}), (SELECT MAX(seq) FROM {OUTBOX_TABLE})")
+    min_seq, max_seq = cursor.fetchone()
+    return min_seq, max_seq
+
+
+def get_offset(cursor, consumer):
+    cursor.execute(f"SELECT last_seq FROM {OFFSETS_TABLE} WHERE consumer = ?", (consumer,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def set_offset(cursor, consumer, last_seq):
+    cursor.execute(f"""
+        INSERT INTO {OFFSETS_TABLE} (consumer, last_seq, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT (consumer) DO UPDATE SET last_seq = excluded.last_seq, updated_at = excluded.updated_at
+    """, (consumer, last_seq, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def get_lag(cursor, consumer):
+    """
+    消费者的积压情况: (已处理到的 seq, 待处理条数, 最早一条待处理变更的创建时间)
+    没有积压时创建时间为 None
+    """
+    last_seq = get_offset(cursor, consumer)
+    cursor.execute(f"SELECT COUNT(*), MIN(created_at) FROM {OUTBOX_TABLE} WHERE seq > ?", (last_seq,))
+    pending, oldest = cursor.fetchone()
+    return last_seq, pending or 0, oldest
+
+
+def drop_offset(cursor, consumer):
+    """删除消费者的位置记录, 返回是否存在"""
+    cursor.execute(f"DELETE FROM {OFFSETS_TABLE} WHERE consumer = ?", (consumer,))
+    return cursor.rowcount > 0
+
+
+def get_offsets(cursor):
+    cursor.execute(f"SELECT consumer, last_seq, updated_at FROM {OFFSETS_TABLE} ORDER BY consumer")
+    return [(consumer, last_seq, updated_at) for consumer, last_seq, updated_at in cursor.fetchall()]
+
+
+def prune(cursor, retention_days=OUTBOX_RETENTION_DAYS):
+    """
+    删除所有消费者都已处理、且超过保留天数的变更, 返回删除的行数
+    超过保留天数没有确认过位置的消费者不计入 (否则一个废弃的消费者会让变更日志无限增长)
+    最新的一条始终保留, MAX(seq) 可以作为数据版本号 (不会因清理而变小或为空)
+    """
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute(f"""SELECT MIN(last_seq), (SELECT MAX(seq) FROM {OUTBOX_TABLE})
+        FROM {OFFSETS_TABLE} WHERE updated_at >= ?""", (cutoff,))
+    min_seq, max_seq = cursor.fetchone()
+    if max_seq is None:
+        return 0
+    # 没有有效的消费者时只按保留天数清理
+    limit_seq = max_seq - 1 if min_seq is None else min(min_seq, max_seq - 1)
+    cursor.execute(f"DELETE FROM {OUTBOX_TABLE} WHERE seq <= ? AND created_at < ?", (limit_seq, cutoff))
+    return cursor.rowcount
+
+
+class OutboxPruner:
+    """后台定期清理 outbox; 每个进程一个线程 (gunicorn fork 之后启动), 多个 worker 重复清理无害"""
+
+    def __init__(self, interval=OUTBOX_PRUNE_INTERVAL, retention_days=OUTBOX_RETENTION_DAYS):
+        self.interval = interval
+        self.retention_days = retention_days
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if self.interval <= 0 or self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self._run, name='outbox-prune', daemon=True).start()
+
+    def prune_once(self):
+        with get_db_connection() as conn:
+            deleted = prune(conn.cursor(), self.retention_days)
+        if deleted:
+            log.info("已清理 %s 条变更", deleted)
+        return deleted
+
+    def _run(self):
+        while True:
+            try:
+                self.prune_once()
+            except Exception as e:
+                log.warning("清理变更日志出错: %s", e)
+            time.sleep(self.interval)
+
+
+outbox_pruner = OutboxPruner()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if command == 'status':
+            cursor.execute(f"SELECT COUNT(*), MIN(seq), MAX(seq) FROM {OUTBOX_TABLE}")
+            total, min_seq, max_seq = cursor.fetchone()
+            print(f"变更日志: {total} 条 (seq {min_seq} - {max_seq})")
+            for consumer, last_seq, updated_at in get_offsets(cursor):
+                _, pending, oldest = get_lag(cursor, consumer)
+                print(f"  {consumer}: last_seq={last_seq} 待处理={pending} 最早={oldest} 更新于={updated_at}")
+        elif command == 'prune':
+            days = float(sys.argv[2]) if len(sys.argv) > 2 else OUTBOX_RETENTION_DAYS
+            print(f"已删除 {prune(cursor, days)} 条变更")
+        elif command == 'drop' and len(sys.argv) > 2:
+            print(f"已删除消费者 {sys.argv[2]}" if drop_offset(cursor, sys.argv[2]) else f"消费者 {sys.argv[2]} 不存在")
+        else:
+            print("用法: python outbox.py [status|prune [保留天数]|drop 消费者]")
+            sys.exit(1)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+用户权限缓存 - 每个用户的页面权限压缩为一个位图, 权限检查只查进程内存
+
+每个页面占 3 位 (查看/编辑/删除), 5 个页面共 15 位; 连同角色、是否启用一起按用户缓存.
+登录时加载一次 (一次数据库连接: users + user_permissions), 之后 check_page_permission()、
+check_user_permission()、require_permission 以及登录跳转都只查位图.
+
+失效: users.permissions_version (migrations.py 版本 12) 记录每个用户权限的版本号,
+manage_user_permissions()、update_user()、delete_user() 在同一事务中递增 (bump_version),
+提交后调用 publish_change():
+- 本进程立即删除该用户的缓存
+- 通过事件总线通知其他 worker 删除, 并记下最新版本号; 版本更旧的加载结果 (与修改并发读到的旧数据) 不放入缓存
+- TTL 兜底: 事件总线发布失败时, 其他 worker 最多延迟 TTL 秒
+
+环境变量:
+- PERMISSION_CACHE_TTL   缓存有效期 (秒, 默认 300, 0 表示每次检查都重新加载)
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+from database import get_db_connection
+from events import event_bus
+
+PERMISSION_CACHE_TTL = float(os.environ.get('PERMISSION_CACHE_TTL', '300'))
+
+# 位顺序固定, 与管理页面的页面列表一致; 新页面只能追加到末尾
+PAGES = ('index', 'sorting', 'history', 'statistics', 'logs')
+PERMISSION_TYPES = ('view', 'edit', 'delete')
+_PAGE_INDEX = {page_name: index for index, page_name in enumerate(PAGES)}
+_TYPE_INDEX = {permission_type: index for index, permission_type in enumerate(PERMISSION_TYPES)}
+
+# 事件总线上的权限变更事件 (不推送给 SSE 客户端)
+PERMISSIONS_CHANGED_EVENT = 'permissions_changed'
+
+# version: users.permissions_version; 用户不存在时 role 为 None、is_active 为 False
+PermissionEntry = namedtuple('PermissionEntry', 'version role is_active bits loaded_at')
+
+
+def permission_bit(page_name, permission_type='view'):
+    """页面权限对应的位, 未知的页面或权限类型返回 0"""
+    page_index = _PAGE_INDEX.get(page_name)
+    type_index = _TYPE_INDEX.get(permission_type)
+    if page_index is None or type_index is None:
+        return 0
+    return 1 << (page_index * len(PERMISSION_TYPES) + type_index)
+
+
+def encode_permissions(rows):
+    """(page_name, can_view, can_edit, can_delete) 行转为位图"""
+    bits = 0
+    for page_name, can_view, can_edit, can_delete in rows:
+        for permission_type, allowed in zip(PERMISSION_TYPES, (can_view, can_edit, can_delete)):
+            if allowed:
+                bits |= permission_bit(page_name, permission_type)
+    return bits
+
+
+def decode_permissions(bits):
+    """位图转为 /api/user_permissions 返回的格式 {page_name: {'can_view': bool, ...}}"""
+    return {
+        page_name: {f'can_{permission_type}': bool(bits & permission_bit(page_name, permission_type))
+                    for permission_type in PERMISSION_TYPES}
+        for page_name in PAGES
+    }
+
+
+def bump_version(cursor, user_id):
+    """递增用户的权限版本号 (调用方负责提交, 提交后调用 publish_change), 返回新版本号"""
+    cursor.execute("""
+        UPDATE users SET permissions_version = COALESCE(permissions_version, 0) + 1
+        WHERE id = ?
+    """, (user_id,))
+    cursor.execute("SELECT permissions_version FROM users WHERE id = ?", (user_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def load_entry(user_id):
+    """从数据库读取用户的角色、状态与全部页面权限"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT role, is_active, permissions_version FROM users WHERE id = ?", (user_id,))
+        user = cursor.fetchone()
+        if user is None:
+            return PermissionEntry(0, None, False, 0, time.monotonic())
+        cursor.execute("""
+            SELECT page_name, can_view, can_edit, can_delete
+            FROM user_permissions
+            WHERE user_id = ?
+        """, (user_id,))
+        bits = encode_permissions(cursor.fetchall())
+    return PermissionEntry(user[2] or 0, user[0], bool(user[1]), bits, time.monotonic())
+
+
+class PermissionCache:
+    """线程安全的按用户权限缓存"""
+
+    def __init__(self, ttl=PERMISSION_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        # 事件中收到的各用户最新版本号
+        self._min_versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, refresh=False):
+        """返回用户的权限条目, 没有缓存、已过期或 refresh=True 时从数据库加载"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and not refresh and time.monotonic() - entry.loaded_at < self.ttl:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = load_entry(user_id)
+        with self._lock:
+            if entry.version >= self._min_versions.get(user_id, 0):
+                self._entries[user_id] = entry
+        return entry
+
+    def invalidate(self, user_id, version=None):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            if version is not None and version > self._min_versions.get(user_id, 0):
+                self._min_versions[user_id] = version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+permission_cache = PermissionCache()
+
+
+def has_permission(user_id, page_name, permission_type='view', admin_all=False):
+    """
+    用户是否有页面权限 (只查缓存)
+    admin_all: 管理员拥有所有页面权限 (页面访问检查的规则)
+    """
+    if user_id is None:
+        return False
+    entry = permission_cache.get(user_id)
+    if not entry.is_active:
+        return False
+    if admin_all and entry.role == 'admin':
+        return True
+    return bool(entry.bits & permission_bit(page_name, permission_type))
+
+
+def publish_change(user_id, version=None):
+    """权限变更提交后调用: 本进程立即失效, 并通知其他 worker"""
+    permission_cache.invalidate(user_id, version)
+    event_bus.publish({'type': PERMISSIONS_CHANGED_EVENT, 'data': {'user_id': user_id, 'version': version}})
+
+
+def _on_event(message):
+    data = message.get('data') or {}
+    if message.get('type') == PERMISSIONS_CHANGED_EVENT and data.get('user_id') is not None:
+        permission_cache.invalidate(data['user_id'], data.get('version'))
+    elif data.get('action') == 'resync':
+        # 事件总线断线重连, 期间的权限变更可能漏掉
+        permission_cache.clear()
+
+
+event_bus.subscribe(_on_event)
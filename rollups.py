@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+每日汇总表 (daily_rollups) - 增量维护与重建
+
+按 业务日 + 车型 + 时间段 汇总入库记录的车次、件数和托盘数,
+趋势类接口直接读取汇总表, 不再逐日扫描 inbound_records.
+
+业务日: 洛杉矶时间 05:00 至次日 05:00
+
+维护方式:
+- record() / update_record() / delete_record() 在同一事务内调用 apply_record_delta()
+- init_db() 在汇总表为空时自动回填
+- 手动重建: python rollups.py rebuild
+"""
+import sys
+from datetime import datetime, timedelta
+
+import pytz
+
+from app_logging import get_logger
+from database import get_db_connection, table_exists, USE_POSTGRES
+
+log = get_logger(__name__)
+
+# 洛杉矶时区
+LA_TZ = pytz.timezone('America/Los_Angeles')
+
+# 业务日从洛杉矶时间 05:00 开始
+BUSINESS_DAY_START_HOUR = 5
+
+# 托盘统计的车型
+PALLET_VEHICLE_TYPES = ('26英尺', '53英尺')
+
+# PostgreSQL 回填时使用的咨询锁, 避免多个 worker 同时回填
+ROLLUP_ADVISORY_LOCK_ID = 7302001
+
+CREATE_ROLLUP_TABLE = """
+    CREATE TABLE IF NOT EXISTS daily_rollups (
+        business_date DATE NOT NULL,
+        vehicle_type TEXT NOT NULL,
+        time_slot TEXT NOT NULL,
+        vehicles INTEGER NOT NULL DEFAULT 0,
+        pieces INTEGER NOT NULL DEFAULT 0,
+        pallets INTEGER NOT NULL DEFAULT 0,
+        g53_vehicles INTEGER NOT NULL DEFAULT 0,
+        g53_pieces INTEGER NOT NULL DEFAULT 0,
+        g53_pallets INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (business_date, vehicle_type, time_slot)
+    )
+"""
+
+UPSERT_ROLLUP = """
+    INSERT INTO daily_rollups
+        (business_date, vehicle_type, time_slot,
+         vehicles, pieces, pallets, g53_vehicles, g53_pieces, g53_pallets)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (business_date, vehicle_type, time_slot) DO UPDATE SET
+        vehicles = daily_rollups.vehicles + excluded.vehicles,
+        pieces = daily_rollups.pieces + excluded.pieces,
+        pallets = daily_rollups.pallets + excluded.pallets,
+        g53_vehicles = daily_rollups.g53_vehicles + excluded.g53_vehicles,
+        g53_pieces = daily_rollups.g53_pieces + excluded.g53_pieces,
+        g53_pallets = daily_rollups.g53_pallets + excluded.g53_pallets
+"""
+
+
+def parse_created_at(value):
+    """将 created_at 解析为系统本地时间的 datetime (SQLite 为字符串, PostgreSQL 为 datetime)"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def business_date_of(created_at):
+    """
+    返回记录所属的业务日 (date)
+    数据库中存储的是系统本地时间, 先转换为洛杉矶时间再按 05:00 分界
+    """
+    # naive datetime 的 astimezone() 按系统本地时区解释
+    la_time = parse_created_at(created_at).astimezone(LA_TZ)
+    return (la_time - timedelta(hours=BUSINESS_DAY_START_HOUR)).date()
+
+
+def _row_value(record, key):
+    try:
+        return record[key]
+    except (KeyError, IndexError):
+        return None
+
+
+def rollup_key_and_values(record):
+    """
+    计算一条入库记录对汇总表的贡献
+    返回 ((business_date, vehicle_type, time_slot), (vehicles, pieces, pallets, g53_vehicles, g53_pieces, g53_pallets))
+    """
+    vehicle_type = _row_value(record, 'vehicle_type')
+    pieces = int(_row_value(record, 'pieces') or 0)
+    load_amount = int(_row_value(record, 'load_amount') or 0)
+    pallets = load_amount if vehicle_type in PALLET_VEHICLE_TYPES else 0
+    # 特殊规则: 53英尺车牌号为G的车辆, 单独记录以便统计时排除货量和托盘
+    is_g53 = vehicle_type == '53英尺' and _row_value(record, 'vehicle_no') == 'G'
+
+    key = (
+        business_date_of(_row_value(record, 'created_at')).strftime('%Y-%m-%d'),
+        vehicle_type or '',
+        str(_row_value(record, 'time_slot') or ''),
+    )
+    values = (
+        1, pieces, pallets,
+        1 if is_g53 else 0,
+        pieces if is_g53 else 0,
+        pallets if is_g53 else 0,
+    )
+    return key, values
+
+
+def apply_record_delta(cursor, record, sign):
+    """
+    将一条入库记录计入 (sign=1) 或移出 (sign=-1) 汇总表
+    必须与对 inbound_records 的修改在同一事务中调用
+    """
+    if not record:
+        return
+    key, values = rollup_key_and_values(record)
+    cursor.execute(UPSERT_ROLLUP, key + tuple(v * sign for v in values))
+    if sign < 0:
+        # 清理已经没有记录的汇总行
+        cursor.execute("""
+            DELETE FROM daily_rollups
+            WHERE business_date = ? AND vehicle_type = ? AND time_slot = ? AND vehicles <= 0
+        """, key)
+
+
+def ensure_rollup_table(cursor):
+    """创建汇总表 (如果不存在)"""
+    cursor.execute(CREATE_ROLLUP_TABLE)
+
+
+def rebuild_rollups(cursor, batch_size=5000):
+    """
+    根据 inbound_records 全量重建汇总表
+    分批读取记录, 内存中只保留汇总结果; 返回 (记录数, 汇总行数)
+    """
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_xact_lock(?)", (ROLLUP_ADVISORY_LOCK_ID,))
+    cursor.execute("DELETE FROM daily_rollups")
+
+    cursor.execute("""
+        SELECT created_at, vehicle_type, vehicle_no, pieces, load_amount, time_slot
+        FROM inbound_records
+        WHERE created_at IS NOT NULL
+    """)
+    totals = {}
+    record_count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            key, values = rollup_key_and_values(row)
+            current = totals.get(key)
+            totals[key] = values if current is None else tuple(a + b for a, b in zip(current, values))
+            record_count += 1
+
+    if totals:
+        cursor.executemany(UPSERT_ROLLUP, [key + values for key, values in totals.items()])
+    return record_count, len(totals)
+
+
+def backfill_if_empty(cursor):
+    """汇总表为空而入库记录不为空时自动回填 (首次部署)"""
+    if not table_exists(cursor, 'inbound_records'):
+        return False
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_xact_lock(?)", (ROLLUP_ADVISORY_LOCK_ID,))
+    cursor.execute("SELECT 1 FROM daily_rollups LIMIT 1")
+    if cursor.fetchone():
+        return False
+    cursor.execute("SELECT 1 FROM inbound_records LIMIT 1")
+    if not cursor.fetchone():
+        return False
+    record_count, rollup_count = rebuild_rollups(cursor)
+    log.info("已回填 %s 条记录, 生成 %s 行汇总", record_count, rollup_count)
+    return True
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ('rebuild', 'backfill'):
+        print("用法: python rollups.py rebuild   # 清空并全量重建汇总表")
+        print("      python rollups.py backfill  # 仅在汇总表为空时回填")
+        return 1
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        ensure_rollup_table(cursor)
+        if argv[1] == 'rebuild':
+            record_count, rollup_count = rebuild_rollups(cursor)
+            print(f"[汇总表] 重建完成: {record_count} 条记录, {rollup_count} 行汇总")
+        elif not backfill_if_empty(cursor):
+            print("[汇总表] 汇总表已有数据或没有入库记录, 无需回填")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
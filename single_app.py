@@ -6,9 +6,7 @@ from datetime import datetime, timedelta, date
 import pytz
 import threading
 import time
-from openpyxl import Workbook
 import json
-from queue import Queue
 
 
 
@@ -18,20 +16,57 @@ try:
 except ImportError:
     psycopg2 = None
     DictCursor = None
-from openpyxl.styles import Font, PatternFill, Alignment
-from openpyxl.utils import get_column_letter
 import json
 import hashlib
 import functools
+import logging
 
 # 数据库抽象层 - 自动适配 SQLite/PostgreSQL
-from database import get_db_connection, convert_sql, get_placeholder, USE_POSTGRES
+from database import get_db_connection, acquire_connection, get_pool_stats, convert_sql, get_placeholder, insert_returning_id, USE_POSTGRES
+# 每日汇总表 - 趋势接口读取, 写入时增量维护
+import rollups
+# 索引迁移
+import migrations
+# 只读接口响应缓存 - broadcast_update 时失效
+from cache import cached_response, bump_data_version, response_cache
+# 跨 worker 事件总线 - SSE 推送与缓存失效
+from events import event_bus
+# SSE 推送中心 - 有界缓冲区与断线续传
+from sse_hub import sse_hub
+# 流式 Excel 导出
+import exports
+# 变更日志 (outbox) 与后台同步
+import outbox
+from sync import sync_worker, SYNC_CONSUMER
+# 道口占用状态与时长计算
+import docks
+import durations
+# 业务日与小时列
+import business_days
+# 用户权限位图缓存（权限检查不再查询数据库）
+import permissions
+# 页面 HTML 内存缓存（预压缩 + ETag）
+from static_pages import StaticPageCache
+# 接口响应压缩（gzip / brotli）
+from compression import init_compression, response_compressor
+from metrics import init_metrics
+# 结构化日志（级别控制、后台写入、请求 ID）
+import app_logging
+from app_logging import get_logger, init_request_logging
+
+log = get_logger(__name__)
 
 app = Flask(__name__)
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['SESSION_PERMANENT'] = False
 app.config['SESSION_USE_SIGNER'] = True
 app.config['SESSION_KEY_PREFIX'] = 'inbound_app:'
+# 各路由的请求耗时、查询次数与响应字节数，GET /metrics（需在压缩之前注册，统计压缩后的字节数）
+init_metrics(app)
+# 按 Accept-Encoding 压缩 JSON、CSV 等文本响应（SSE 事件流除外）
+init_compression(app)
+# 每个请求分配请求 ID，写入日志和响应头 X-Request-ID
+init_request_logging(app)
 
 # 获取正确的数据库路径
 def get_db_path():
@@ -59,61 +94,12 @@ def get_static_dir():
 
 # 数据库连接辅助函数 - 兼容 SQLite 和 PostgreSQL
 def get_db():
-    """获取数据库连接 - 自动适配 SQLite/PostgreSQL"""
-    if USE_POSTGRES:
-        import psycopg2
-        # 使用 DictCursor 替代 RealDictCursor
-        # DictCursor 返回的行对象同时支持 索引访问(row[0]) 和 键访问(row['id'])
-        # 这完美兼容了我们现有的代码 (混合使用了两种访问方式)
-        from psycopg2.extras import DictCursor
-        from database import DATABASE_URL
-        
-        # 创建原始连接
-        original_conn = psycopg2.connect(DATABASE_URL, cursor_factory=DictCursor)
-        
-        # 创建连接包装类
-        class ConnectionWrapper:
-            def __init__(self, conn):
-                self._conn = conn
-            
-            def cursor(self, *args, **kwargs):
-                cur = self._conn.cursor(*args, **kwargs)
-                original_execute = cur.execute
-                
-                def execute_wrapper(query, params=None):
-                    # 自动转换 ? 为 %s
-                    converted_query = query.replace('?', '%s')
-                    return original_execute(converted_query, params)
-                
-                cur.execute = execute_wrapper
-                return cur
-            
-            def commit(self):
-                return self._conn.commit()
-            
-            def rollback(self):
-                return self._conn.rollback()
-            
-            def close(self):
-                return self._conn.close()
-            
-            def __enter__(self):
-                return self
-            
-            def __exit__(self, exc_type, exc_val, exc_tb):
-                if exc_type:
-                    self._conn.rollback()
-                else:
-                    self._conn.commit()
-                self._conn.close()
-        
-        return ConnectionWrapper(original_conn)
-    else:
-        import sqlite3
-        conn = sqlite3.connect(DB_PATH)
-        # 使用 Row 工厂,使 SQLite 结果可以像字典一样访问
-        conn.row_factory = sqlite3.Row
-        return conn
+    """
+    从连接池借出数据库连接 - 自动适配 SQLite/PostgreSQL
+    PostgreSQL 游标自动将 ? 转换为 %s, 行对象同时支持 row[0] 和 row['id']
+    conn.close() 会将连接归还连接池而不是真正关闭
+    """
+    return acquire_connection()
 
 def convert_query_placeholders(query):
     """转换 SQL 查询占位符 - SQLite 的 ? 转为 PostgreSQL 的 %s"""
@@ -159,14 +145,12 @@ def initialize_app():
     global _app_initialized
     if not _app_initialized:
         try:
-            print("[应用初始化] 开始初始化数据库...")
+            log.info("开始初始化数据库...")
             init_db()
-            print("[应用初始化] 数据库初始化完成")
+            log.info("数据库初始化完成")
             _app_initialized = True
         except Exception as e:
-            print(f"[应用初始化] 错误: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("应用初始化出错")
             # 不要抛出异常,让应用继续启动
             # 这样可以看到更详细的错误信息
 
@@ -184,6 +168,9 @@ def get_static_dir():
         # 开发环境 - 使用脚本所在目录的static子目录
         return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
+# 页面文件只读取一次，开发环境修改后自动重新加载
+static_pages = StaticPageCache(get_static_dir())
+
 # 定义洛杉矶时区
 LA_TZ = pytz.timezone('America/Los_Angeles')
 
@@ -202,16 +189,32 @@ def round_to_ten_thousand(value):
 # Server-Sent Events (SSE) Infrastructure for Real-Time Cross-Device Sync
 # ============================================================================
 
-# Global list of SSE client queues
-sse_queues = []
-sse_queues_lock = threading.Lock()
+# 写接口提交后发布的通知: 各 worker 的 SSE 推送线程据此从变更日志读取新的变更
+DATA_CHANGED_EVENT = 'data_changed'
+
+def deliver_local_update(message):
+    """
+    在本进程内处理一条更新事件：使响应缓存失效，并推送给本进程的 SSE 客户端
+    broadcast_update() 直接调用；其他 worker 发布的事件由事件总线的监听线程调用
+    """
+    # 权限变更事件由 permissions 模块处理，不推送给客户端
+    if message.get('type') == permissions.PERMISSIONS_CHANGED_EVENT:
+        return
+    # 数据已变更，使只读接口的响应缓存失效
+    bump_data_version()
+    if message.get('type') == DATA_CHANGED_EVENT:
+        # 入库记录的变更事件按 seq 从变更日志读取，所有 worker 的事件 ID 与顺序一致
+        sse_hub.wake()
+    else:
+        sse_hub.publish(message)
 
 def broadcast_update(event_type='refresh_stats', data=None):
     """
-    向所有连接的 SSE 客户端广播更新事件
+    向所有连接的 SSE 客户端广播更新事件（包括其他 worker 进程的客户端）
     
     Args:
-        event_type: 事件类型 (默认: 'refresh_stats')
+        event_type: 事件类型 (默认: 'refresh_stats')；写入已提交的数据时为 DATA_CHANGED_EVENT，
+                    只唤醒推送线程，客户端收到的事件来自变更日志
         data: 附加数据 (可选)
     """
     message = {
@@ -220,24 +223,46 @@ def broadcast_update(event_type='refresh_stats', data=None):
         'timestamp': datetime.now(LA_TZ).isoformat()
     }
     
-    print(f"[SSE] Broadcasting {event_type} to {len(sse_queues)} clients")
-    
-    with sse_queues_lock:
-        # 向所有连接的客户端发送消息
-        dead_queues = []
-        for q in sse_queues:
-            try:
-                q.put(message)
-            except Exception as e:
-                print(f"[SSE] Error sending to client: {e}")
-                dead_queues.append(q)
-        
-        # 清理失败的队列
-        for q in dead_queues:
-            try:
-                sse_queues.remove(q)
-            except:
-                pass
+    deliver_local_update(message)
+    # 通过事件总线通知其他 worker
+    event_bus.publish(message)
+
+def change_event(change):
+    """
+    变更日志中的一条入库记录变更转为 SSE 事件（sse_hub 按 seq 顺序读取后调用，事件 ID 为 seq）
+    事件带变更后/变更前的记录及统计增量 stats_delta，客户端据此直接更新页面，不必重新请求 /api/stats
+    其他表的变更不推送，返回 None
+    """
+    if change['table_name'] != 'inbound_records':
+        return None
+    op = change['op']
+    record = change['row'] if op != 'delete' else None
+    old_record = change['old_row'] if op == 'update' else (change['row'] if op == 'delete' else None)
+    data = {'action': {'insert': 'add', 'update': 'update', 'delete': 'delete'}[op], 'id': change['pk']}
+    stats_delta = []
+    for key, sign, row in (('record', 1, record), ('old_record', -1, old_record)):
+        if not row:
+            continue
+        data[key] = row
+        contribution = stats_contribution(row)
+        if contribution:
+            data[key.replace('record', 'business_date')] = contribution['business_date']
+            stats_delta.append(dict(contribution, sign=sign))
+    # 没有修改前数据的更新只改了道口占用时长（outbox.record_row_change），不影响统计
+    if op != 'update' or old_record:
+        data['stats_delta'] = stats_delta
+    return {'type': 'refresh_stats', 'data': data, 'timestamp': change['created_at']}
+
+event_bus.subscribe(deliver_local_update)
+sse_hub.set_event_builder(change_event)
+
+@app.before_request
+def start_event_listener():
+    """每个 worker 进程处理第一个请求时启动事件监听、SSE 推送、同步和 outbox 清理线程（gunicorn fork 之后）"""
+    event_bus.start()
+    sse_hub.start()
+    sync_worker.start()
+    outbox.outbox_pruner.start()
 
 # ============================================================================
 
@@ -259,7 +284,9 @@ def init_db():
             # PostgreSQL RealDictCursor 返回字典,需要用列名访问
             need = not result['exists'] if USE_POSTGRES else not result[0]
         else:
-            need = not os.path.exists(DB_PATH)
+            # 连接池打开连接时已创建数据库文件，按表是否存在判断
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'inbound_records'")
+            need = cursor.fetchone() is None
         
         if need:
             # 创建入库记录表
@@ -438,6 +465,21 @@ def init_db():
                 );""")
                 cursor.execute(sql)
 
+        # 创建每日汇总表，首次部署时根据已有入库记录回填
+        rollups.ensure_rollup_table(cursor)
+        rollups.backfill_if_empty(cursor)
+        
+        # 执行索引迁移（热点查询的复合索引）
+        migrations.run_migrations(cursor)
+        
+        # 道口占用状态表（迁移版本 10 创建），首次部署时根据已有入库记录回填
+        docks.backfill_if_empty(cursor)
+        
+        # 业务日与小时列（迁移版本 11 创建），补齐为空的记录
+        for table_name, count in business_days.backfill_all(cursor).items():
+            if count:
+                log.info("业务日: %s 已回填 %s 条记录", table_name, count)
+
 def convert_utc_to_la(utc_time_str):
     """直接返回时间字符串，因为数据库中存储的已经是洛杉矶时间"""
     return utc_time_str
@@ -447,20 +489,8 @@ def check_user_permission(page_name, permission_type='view'):
     if 'user_id' not in session:
         return False
     
-    user_id = session['user_id']
-    
-    # 查询用户权限
-    conn = get_db()
-    query = f"""
-        SELECT up.can_{permission_type}
-        FROM user_permissions up
-        WHERE up.user_id = ? AND up.page_name = ?
-    """
-    cursor = conn.cursor(); cursor.execute(query, (user_id, page_name))
-    result = cursor.fetchone()
-    conn.close()
-    
-    return result and (result[f'can_{permission_type}'] if USE_POSTGRES else result[0])
+    # 查询用户权限（进程内缓存）
+    return permissions.has_permission(session['user_id'], page_name, permission_type)
 
 def daily_reset_check():
     """每日重置检查函数"""
@@ -471,7 +501,7 @@ def daily_reset_check():
             
             # 如果是午夜（0点）附近，执行重置
             if la_now.hour == 0 and la_now.minute == 0:
-                print(f"执行每日重置: {la_now}")
+                log.info("执行每日重置: %s", la_now)
                 perform_daily_reset()
                 
                 # 等待一分钟，避免重复执行
@@ -480,15 +510,15 @@ def daily_reset_check():
                 # 每分钟检查一次
                 time.sleep(60)
         except Exception as e:
-            print(f"每日重置检查出错: {e}")
+            log.error("每日重置检查出错: %s", e)
             time.sleep(60)
 
 def perform_daily_reset():
     """执行每日重置 - 仅记录日志，不删除历史数据"""
     try:
-        print("每日重置检查完成 - 历史数据已永久保存")
+        log.info("每日重置检查完成 - 历史数据已永久保存")
     except Exception as e:
-        print(f"每日重置执行出错: {e}")
+        log.error("每日重置执行出错: %s", e)
 
 
 @app.route('/')
@@ -502,14 +532,7 @@ def index():
         return redirect('/no_permission')
     
     # 有权限则返回主页
-    static_dir = get_static_dir()
-    file_path = os.path.join(static_dir, 'index.html')
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
-    else:
-        return f"File not found: {file_path}", 404
+    return static_pages.serve('index.html')
 
 @app.route('/sorting')
 def sorting():
@@ -521,14 +544,7 @@ def sorting():
         return redirect('/no_permission')
     
     # 返回分拣录入页面
-    static_dir = get_static_dir()
-    file_path = os.path.join(static_dir, 'sorting.html')
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
-    else:
-        return f"File not found: {file_path}", 404
+    return static_pages.serve('sorting.html')
 
 @app.route('/history')
 def history():
@@ -540,14 +556,7 @@ def history():
         return redirect('/no_permission')
     
     # 返回历史查询页面
-    static_dir = get_static_dir()
-    file_path = os.path.join(static_dir, 'history.html')
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
-    else:
-        return f"File not found: {file_path}", 404
+    return static_pages.serve('history.html')
 
 @app.route('/statistics')
 def statistics():
@@ -559,14 +568,7 @@ def statistics():
         return redirect('/no_permission')
     
     # 返回统计数据页面
-    static_dir = get_static_dir()
-    file_path = os.path.join(static_dir, 'statistics.html')
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
-    else:
-        return f"File not found: {file_path}", 404
+    return static_pages.serve('statistics.html')
 
 
 @app.route('/react-dashboard')
@@ -580,12 +582,12 @@ def react_dashboard():
         # if not check_page_permission('statistics'):
         #     return redirect('/no_permission')
         
-        print(f"DEBUG: Processing /react-dashboard request from {request.remote_addr}")
+        log.debug("Processing /react-dashboard request from %s", request.remote_addr)
         
         # 返回React仪表板页面
         static_dir = get_static_dir()
         file_path = os.path.join(static_dir, 'react-dashboard', 'dist', 'index.html')
-        print(f"DEBUG: Serving dashboard file from: {file_path}")
+        log.debug("Serving dashboard file from: %s", file_path)
         
         if os.path.exists(file_path):
             # 使用send_file更加健壮，并禁用缓存以方便调试
@@ -595,13 +597,11 @@ def react_dashboard():
             response.headers['Expires'] = '0'
             return response
         else:
-            print(f"ERROR: File not found at {file_path}")
+            log.error("File not found at %s", file_path)
             return f"Dashboard file not found at: {file_path}", 404
             
     except Exception as e:
-        print(f"ERROR: Exception in react_dashboard: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Exception in react_dashboard")
         return f"Server Error: {str(e)}", 500
 
 @app.route('/tabler-dashboard')
@@ -628,6 +628,31 @@ def ping():
     """健康检查接口"""
     return "pong", 200
 
+@app.route('/api/pool_stats')
+def pool_stats():
+    """数据库连接池指标: 池大小、占用数、等待时间"""
+    return jsonify(get_pool_stats())
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    """响应缓存指标: 条目数、命中次数、数据版本号"""
+    return jsonify(response_cache.get_stats())
+
+@app.route('/api/static_page_stats')
+def static_page_stats():
+    """页面缓存指标: 各页面原文/压缩后大小、命中次数、304 次数"""
+    return jsonify(static_pages.get_stats())
+
+@app.route('/api/compression_stats')
+def compression_stats():
+    """响应压缩指标: 压缩次数、压缩前后字节数"""
+    return jsonify(response_compressor.get_stats())
+
+@app.route('/api/log_stats')
+def log_stats():
+    """日志指标: 当前级别、队列中待写入和丢弃的条数"""
+    return jsonify(app_logging.get_stats())
+
 @app.route('/dashboard-assets/<path:filename>')
 def serve_dashboard_assets(filename):
     """Serve React Dashboard assets from a custom path to avoid conflicts"""
@@ -685,14 +710,7 @@ def logs_page():
         return jsonify({'error': '权限不足'}), 403
     
     # 返回操作日志查询页面
-    static_dir = get_static_dir()
-    file_path = os.path.join(static_dir, 'logs.html')
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
-    else:
-        return f"File not found: {file_path}", 404
+    return static_pages.serve('logs.html')
 
 # 登录页面
 @app.route('/login')
@@ -784,26 +802,12 @@ def login_page():
 @app.route('/admin')
 def admin_page():
     # 返回管理员后台页面
-    static_dir = get_static_dir()
-    file_path = os.path.join(static_dir, 'admin.html')
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
-    else:
-        return f"File not found: {file_path}", 404
+    return static_pages.serve('admin.html')
 
 # 无权限提示页面
 @app.route('/no_permission')
 def no_permission():
-    static_dir = get_static_dir()
-    file_path = os.path.join(static_dir, 'no_permission.html')
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
-    else:
-        return f"File not found: {file_path}", 404
+    return static_pages.serve('no_permission.html')
 
 # 检查重复记录的API端点
 @app.route('/api/check_duplicate', methods=['POST'])
@@ -819,27 +823,17 @@ def check_duplicate():
     if not dock_no:
         return jsonify({"is_duplicate": False})
     
+    # 道口当前的车辆（dock_state 主键查询）
     conn = get_db()
-    cursor = conn.cursor(); cursor.execute("""
-        SELECT id, vehicle_type, vehicle_no, created_at 
-        FROM inbound_records 
-        WHERE dock_no = ? AND vehicle_type NOT IN ('Car', 'Van')
-        ORDER BY created_at DESC 
-        LIMIT 1
-    """, (dock_no,))
-    
-    last_record = cursor.fetchone()
+    last_record = docks.get_current(conn.cursor(), dock_no)
     conn.close()
-    
+
     if not last_record:
         return jsonify({"is_duplicate": False})
-    
+
     # 计算时间差
     try:
-        if isinstance(last_record[3], str):
-            last_time = datetime.strptime(last_record[3], '%Y-%m-%d %H:%M:%S')
-        else:
-            last_time = last_record[3]
+        last_time = docks.parse_arrived_at(last_record[1])
         current_time = datetime.now()
         time_diff_seconds = (current_time - last_time).total_seconds()
         time_diff_minutes = int(time_diff_seconds / 60)
@@ -850,20 +844,45 @@ def check_duplicate():
                 "time_diff_minutes": time_diff_minutes,
                 "last_record": {
                     "id": last_record[0],
-                    "vehicle_type": last_record[1],
-                    "vehicle_no": last_record[2] or "无",
-                    "created_at": last_record[3]
+                    "vehicle_type": last_record[2],
+                    "vehicle_no": last_record[3] or "无",
+                    "created_at": last_record[1]
                 }
             })
     except Exception as e:
-        print(f"检查重复记录时出错: {e}")
+        log.error("检查重复记录时出错: %s", e)
         return jsonify({"is_duplicate": False})
     
     return jsonify({"is_duplicate": False})
 
-@app.route('/api/record', methods=['POST'])
-def record():
-    data = request.json
+@app.route('/api/docks')
+def get_docks():
+    """
+    实时道口看板：每个道口当前停靠的车辆（最后到达的非 Car/Van 车辆）及已占用的分钟数
+    客户端收到 SSE 推送后重新请求即可
+    """
+    try:
+        conn = get_db()
+        rows = docks.list_docks(conn.cursor())
+        conn.close()
+        now = datetime.now()
+        result = []
+        for dock_no, record_id, arrived_at, vehicle_type, vehicle_no in rows:
+            arrived_time = docks.parse_arrived_at(arrived_at)
+            result.append({
+                "dock_no": dock_no,
+                "record_id": record_id,
+                "vehicle_type": vehicle_type,
+                "vehicle_no": vehicle_no,
+                "arrived_at": arrived_time.strftime('%Y-%m-%d %H:%M:%S'),
+                "occupied_minutes": max(0, int((now - arrived_time).total_seconds() / 60))
+            })
+        return jsonify({"docks": result, "count": len(result), "generated_at": now.strftime('%Y-%m-%d %H:%M:%S')})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def apply_vehicle_defaults(data):
+    """按车辆类型填充默认的单位、装载量和件数（单条录入与批量录入共用）"""
     vt = data.get("vehicle_type","")
     if vt=="26英尺":
         data["unit"]="托盘"
@@ -891,9 +910,32 @@ def record():
         # 如果已有件数但没有装载量，也可以反向计算装载量
         elif data.get("pieces") and data["pieces"] > 0:
             data["load_amount"] = data["pieces"] // 344
+    return data
+
+def find_client_request(cursor, table_name, client_request_id):
+    """按客户端请求 ID 查找已写入的记录，返回记录 ID（不存在时为 None）"""
+    cursor.execute(f"SELECT id FROM {table_name} WHERE client_request_id = ?", (client_request_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
 
+def is_unique_violation(error):
+    """SQLite 与 PostgreSQL 的唯一约束冲突"""
+    return 'unique' in str(error).lower()
+
+@app.route('/api/record', methods=['POST'])
+def record():
+    data = apply_vehicle_defaults(request.json)
+    # 客户端生成的请求 ID：超时重试或离线补交时，已写入的记录直接返回，不会重复插入
+    client_request_id = data.get("client_request_id") or None
 
     conn=get_db()
+    if client_request_id:
+        existing_id = find_client_request(conn.cursor(), 'inbound_records', client_request_id)
+        if existing_id:
+            conn.close()
+            return jsonify({"success": True, "record_id": existing_id, "duplicate": True})
+    # 写事务开始：先取 outbox 锁（PostgreSQL），之后再锁道口和汇总表的行
+    outbox.begin_write(conn.cursor())
     # 获取当前系统时间
     current_time = datetime.now()
     current_time_str = current_time.strftime('%Y-%m-%d %H:%M:%S')
@@ -917,25 +959,16 @@ def record():
     vehicle_type = data.get("vehicle_type")
     
     # 只有非Car/Van车型才计算道口占用时长
-    if dock_no and vehicle_type not in ['Car', 'Van']:
-        # 查询同一道口的最后一条非Car/Van记录
-        cursor = conn.cursor(); cursor.execute("""
-            SELECT id, created_at, vehicle_type FROM inbound_records 
-            WHERE dock_no = ? AND vehicle_type NOT IN ('Car', 'Van')
-            ORDER BY created_at DESC 
-            LIMIT 1
-        """, (dock_no,))
-        last_record = cursor.fetchone()
-        
+    occupies_dock = docks.occupies_dock(dock_no, vehicle_type)
+    if occupies_dock:
+        # 道口当前的车辆（dock_state 主键查询，PostgreSQL 锁定该行到提交）
+        last_record = docks.get_current(conn.cursor(), dock_no, for_update=True)
+
         if last_record:
             try:
                 last_id = last_record[0]
                 last_vehicle_type = last_record[2]
-                # 解析上一条记录的时间
-                if isinstance(last_record[1], str):
-                    last_time = datetime.strptime(last_record[1], '%Y-%m-%d %H:%M:%S')
-                else:
-                    last_time = last_record[1] # 已经是 datetime 对象
+                last_time = docks.parse_arrived_at(last_record[1])
                 # 计算上一台车的占用时长(分钟)
                 time_diff_seconds = (current_time - last_time).total_seconds()
                 last_duration = int(time_diff_seconds / 60)
@@ -946,36 +979,288 @@ def record():
                 # 更新上一条记录的时长
                 conn.cursor().execute("""
                     UPDATE inbound_records 
-                    SET duration = ? 
+                    SET duration = ?, updated_at = ? 
                     WHERE id = ?
-                """, (last_duration, last_id))
-                print(f"[INFO] 更新记录ID {last_id} ({last_vehicle_type}) 的时长为 {last_duration} 分钟")
+                """, (last_duration, current_time_str, last_id))
+                outbox.record_row_change(conn.cursor(), 'inbound_records', last_id)
+                log.debug("更新记录ID %s (%s) 的时长为 %s 分钟", last_id, last_vehicle_type, last_duration)
             except Exception as e:
-                print(f"计算并更新上一条记录时长时出错: {e}")
+                log.error("计算并更新上一条记录时长时出错: %s", e)
+    
+    # 业务日与小时在写入时计算一次
+    business_date, hour_bucket = business_days.business_fields(current_time)
     
     # 插入新记录,时长为NULL(车刚到,还不知道会占用多久)
-    cursor = conn.cursor()
-    cursor.execute("""INSERT INTO inbound_records
-        (dock_no, vehicle_type, vehicle_no, unit, load_amount, pieces, time_slot, shift_type, remark, created_at, duration)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)""",
-        (data.get("dock_no"), data.get("vehicle_type"), data.get("vehicle_no"),
-         data.get("unit"), data.get("load_amount"), data.get("pieces"),
-         time_slot, shift_type, data.get("remark"), current_time_str))
-    
-    new_id = cursor.lastrowid
+    try:
+        new_id = insert_returning_id(conn.cursor(), """INSERT INTO inbound_records
+            (dock_no, vehicle_type, vehicle_no, unit, load_amount, pieces, time_slot, shift_type, remark, created_at, updated_at, duration, client_request_id, business_date, hour_bucket)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, ?)""",
+            (data.get("dock_no"), data.get("vehicle_type"), data.get("vehicle_no"),
+             data.get("unit"), data.get("load_amount"), data.get("pieces"),
+             time_slot, shift_type, data.get("remark"), current_time_str, current_time_str, client_request_id,
+             business_date, hour_bucket))
+    except Exception as e:
+        conn.rollback()
+        if client_request_id and is_unique_violation(e):
+            # 同一请求并发提交，另一个请求已经写入（上一台车的时长更新随本事务一起回滚）
+            existing_id = find_client_request(conn.cursor(), 'inbound_records', client_request_id)
+            conn.close()
+            return jsonify({"success": True, "record_id": existing_id, "duplicate": True})
+        conn.close()
+        raise
+    new_record = {
+        "id": new_id, "dock_no": data.get("dock_no"), "vehicle_type": data.get("vehicle_type"),
+        "vehicle_no": data.get("vehicle_no"), "unit": data.get("unit"),
+        "load_amount": data.get("load_amount"), "pieces": data.get("pieces"),
+        "time_slot": time_slot, "shift_type": shift_type, "remark": data.get("remark"),
+        "created_at": current_time_str, "duration": None, "client_request_id": client_request_id,
+        "business_date": business_date, "hour_bucket": hour_bucket
+    }
+    if occupies_dock:
+        # 新车成为道口当前的车辆
+        docks.set_current(conn.cursor(), dock_no, new_id, current_time, vehicle_type, data.get("vehicle_no"))
+
+    # 在同一事务中更新每日汇总表
+    rollups.apply_record_delta(conn.cursor(), {
+        "vehicle_type": data.get("vehicle_type"), "vehicle_no": data.get("vehicle_no"),
+        "load_amount": data.get("load_amount"), "pieces": data.get("pieces"),
+        "time_slot": time_slot, "created_at": current_time
+    }, 1)
+    outbox.record_change(conn.cursor(), 'inbound_records', new_id, 'insert',
+                         dict(new_record, updated_at=current_time_str))
     conn.commit()
     conn.close()
     
     # Broadcast update to all connected SSE clients
-    broadcast_update('refresh_stats', {'action': 'add', 'id': new_id})
+    broadcast_update(DATA_CHANGED_EVENT, {'action': 'add', 'id': new_id})
         
-    return jsonify({"success":True})
+    return jsonify({"success":True, "record_id": new_id})
+
+# 批量录入单次最多条数
+BULK_MAX_RECORDS = 1000
+
+def parse_client_time(value, now):
+    """
+    解析客户端提交的录入时间，返回系统本地时间（不带时区，精确到秒）
+    支持 'YYYY-MM-DD HH:MM:SS'（本地时间）和带时区的 ISO 8601（如离线队列的 toISOString()）
+    为空时使用 now；晚于 now 的时间按 now 处理
+    """
+    if not value:
+        return now
+    value = str(value).strip()
+    try:
+        parsed = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone().replace(tzinfo=None)
+    parsed = parsed.replace(microsecond=0)
+    return min(parsed, now)
+
+def plan_dock_durations(cursor, new_items):
+    """
+    在内存中计算一批新记录的道口占用时长
+    
+    与单条录入相同的规则：同一道口（不含 Car/Van）按到达时间排列，每台车的时长为到下一台车到达的分钟数，
+    最后一台为 NULL。批量记录可能早于道口上已有的记录（离线补录），因此每个道口读取第一条新记录之前的
+    最后一条记录以及之后的所有记录，与新记录合并排序：
+    - 新记录的时长 = 到下一台车（新的或已有的）的时间
+    - 已有记录只在下一台车是新记录时更新时长，其余保持不变（保留手工修改的时长）
+    直接设置 item['duration']，返回需要更新的已有记录 [(id, duration)]
+    """
+    by_dock = {}
+    for item in new_items:
+        item['duration'] = None
+        if item.get('dock_no') and item.get('vehicle_type') not in ['Car', 'Van']:
+            by_dock.setdefault(item['dock_no'], []).append(item)
+    
+    existing_updates = []
+    for dock_no, items in by_dock.items():
+        earliest = min(item['created_at'] for item in items).strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute("""
+            SELECT id, created_at FROM inbound_records
+            WHERE dock_no = ? AND vehicle_type NOT IN ('Car', 'Van')
+              AND created_at >= COALESCE((
+                  SELECT MAX(created_at) FROM inbound_records
+                  WHERE dock_no = ? AND vehicle_type NOT IN ('Car', 'Van') AND created_at < ?
+              ), ?)
+            ORDER BY created_at, id
+        """, (dock_no, dock_no, earliest, earliest))
+        timeline = []
+        for row in cursor.fetchall():
+            created_at = row[1]
+            if isinstance(created_at, str):
+                created_at = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+            timeline.append((created_at, 0, {'id': row[0]}))
+        # 同一时间先排已有记录，新记录之间保持批内顺序
+        timeline.extend((item['created_at'], 1 + index, item) for index, item in enumerate(items))
+        timeline.sort(key=lambda entry: entry[:2])
+        
+        for (current_time, current_order, current), (next_time, next_order, _) in zip(timeline, timeline[1:]):
+            if current_order == 0 and next_order == 0:
+                continue
+            duration = max(0, int((next_time - current_time).total_seconds() / 60))
+            if current_order == 0:
+                existing_updates.append((current['id'], duration))
+            else:
+                current['duration'] = duration
+    return existing_updates
+
+@app.route('/api/records/bulk', methods=['POST'])
+def bulk_record():
+    """
+    批量录入（离线队列恢复网络后一次提交）
+    
+    请求体: {"records": [...]} 或直接为数组，每条与 POST /api/record 相同，另外可带:
+    - client_request_id: 客户端生成的 UUID，已存在的记录不会重复插入
+    - created_at: 实际录入时间（'YYYY-MM-DD HH:MM:SS' 或 ISO 8601），默认当前时间
+    全部记录按 created_at 顺序在一个事务中写入，道口时长在内存中一次算好，只推送一次更新。
+    返回每条记录的结果（顺序与请求一致）: {"client_request_id", "id", "status": "created" | "duplicate"}
+    """
+    payload = request.get_json(silent=True)
+    items = payload.get('records') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "error": "请求体应为非空的记录数组"}), 400
+    if len(items) > BULK_MAX_RECORDS:
+        return jsonify({"success": False, "error": f"单次最多提交 {BULK_MAX_RECORDS} 条记录"}), 400
+    
+    now = datetime.now().replace(microsecond=0)
+    records = []
+    for index, raw_item in enumerate(items):
+        if not isinstance(raw_item, dict):
+            return jsonify({"success": False, "error": f"第 {index + 1} 条记录格式无效"}), 400
+        item = apply_vehicle_defaults(dict(raw_item))
+        try:
+            item['created_at'] = parse_client_time(item.get('created_at'), now)
+        except ValueError:
+            return jsonify({"success": False, "error": f"第 {index + 1} 条记录的 created_at 格式无效"}), 400
+        # 班次和时间段按实际录入时间计算：17点之前是早班，17点之后是晚班
+        item['shift_type'] = "早班" if item['created_at'].hour < 17 else "晚班"
+        if not item.get('time_slot'):
+            item['time_slot'] = str(item['created_at'].hour)
+        item['client_request_id'] = str(item['client_request_id']) if item.get('client_request_id') else None
+        records.append(item)
+    
+    # 并发提交同一批记录时可能违反唯一索引，回滚后重试一次即可识别为重复
+    for attempt in range(2):
+        conn = get_db()
+        try:
+            result = _write_bulk_records(conn, records, now)
+            conn.commit()
+            break
+        except Exception as e:
+            conn.rollback()
+            conflict = is_unique_violation(e)
+            if conflict and attempt == 0:
+                log.warning("批量录入: 客户端请求 ID 冲突，重试: %s", e)
+                continue
+            log.error("批量录入: 写入失败: %s", e)
+            return jsonify({"success": False, "error": str(e)}), 409 if conflict else 500
+        finally:
+            conn.close()
+    
+    inserted, results = result
+    if inserted:
+        # 整批只通知一次；通知经 pg_notify 转发（负载上限 8000 字节），只带条数和业务日，
+        # 各条记录的事件由 SSE 推送线程从变更日志读取
+        broadcast_update(DATA_CHANGED_EVENT, {
+            'action': 'bulk_add',
+            'count': len(inserted),
+            'business_dates': sorted({rollups.business_date_of(record['created_at']).strftime('%Y-%m-%d')
+                                      for record in inserted}),
+        })
+    return jsonify({
+        "success": True,
+        "created": len(inserted),
+        "duplicates": sum(1 for r in results if r['status'] == 'duplicate'),
+        "results": results
+    })
+
+def _write_bulk_records(conn, records, now):
+    """批量录入的事务部分，返回 (新插入的记录, 每条结果)"""
+    # 使用副本：冲突重试时不受上一次尝试写入的字段（时长）影响，也不修改调用方的数据
+    records = [dict(item) for item in records]
+    cursor = conn.cursor()
+    now_str = now.strftime('%Y-%m-%d %H:%M:%S')
+    outbox.begin_write(cursor)
+    
+    # 已存在的客户端请求 ID
+    existing = {}
+    request_ids = list({r['client_request_id'] for r in records if r['client_request_id']})
+    for start in range(0, len(request_ids), 500):
+        chunk = request_ids[start:start + 500]
+        cursor.execute(f"""SELECT client_request_id, id FROM inbound_records
+            WHERE client_request_id IN ({', '.join('?' * len(chunk))})""", chunk)
+        existing.update((row[0], row[1]) for row in cursor.fetchall())
+    
+    # 本次要插入的记录在 records 中的下标
+    new_indexes = []
+    seen = set()
+    for index, item in enumerate(records):
+        request_id = item['client_request_id']
+        if request_id and (request_id in existing or request_id in seen):
+            continue
+        if request_id:
+            seen.add(request_id)
+        new_indexes.append(index)
+    # 按录入时间顺序写入（相同时间保持提交顺序）
+    new_indexes.sort(key=lambda index: records[index]['created_at'])
+    new_items = [records[index] for index in new_indexes]
+    
+    existing_updates = plan_dock_durations(cursor, new_items)
+    for record_id, duration in existing_updates:
+        conn.cursor().execute("UPDATE inbound_records SET duration = ?, updated_at = ? WHERE id = ?",
+                              (duration, now_str, record_id))
+        outbox.record_row_change(conn.cursor(), 'inbound_records', record_id)
+    
+    inserted = []
+    # 本次插入的记录 ID，按 records 中的下标（客户端提交的 id 字段不参与判断）
+    created_ids = {}
+    for index in new_indexes:
+        item = records[index]
+        created_at_str = item['created_at'].strftime('%Y-%m-%d %H:%M:%S')
+        business_date, hour_bucket = business_days.business_fields(item['created_at'])
+        new_id = insert_returning_id(conn.cursor(), """INSERT INTO inbound_records
+            (dock_no, vehicle_type, vehicle_no, unit, load_amount, pieces, time_slot, shift_type, remark,
+             created_at, updated_at, duration, client_request_id, business_date, hour_bucket)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (item.get("dock_no"), item.get("vehicle_type"), item.get("vehicle_no"),
+             item.get("unit"), item.get("load_amount"), item.get("pieces"),
+             item['time_slot'], item['shift_type'], item.get("remark"),
+             created_at_str, now_str, item['duration'], item['client_request_id'], business_date, hour_bucket))
+        created_ids[index] = new_id
+        new_record = {
+            "id": new_id, "dock_no": item.get("dock_no"), "vehicle_type": item.get("vehicle_type"),
+            "vehicle_no": item.get("vehicle_no"), "unit": item.get("unit"),
+            "load_amount": item.get("load_amount"), "pieces": item.get("pieces"),
+            "time_slot": item['time_slot'], "shift_type": item['shift_type'], "remark": item.get("remark"),
+            "created_at": created_at_str, "updated_at": now_str, "duration": item['duration'],
+            "client_request_id": item['client_request_id'], "business_date": business_date, "hour_bucket": hour_bucket
+        }
+        rollups.apply_record_delta(conn.cursor(), new_record, 1)
+        outbox.record_change(conn.cursor(), 'inbound_records', new_id, 'insert', new_record)
+        inserted.append(new_record)
+    # 补录的记录可能早于道口当前的车辆，按记录重新确定每个道口的当前车辆
+    docks.refresh_docks(cursor, *(item for item in new_items
+                                  if docks.occupies_dock(item.get('dock_no'), item.get('vehicle_type'))))
+    
+    # 重复的请求 ID 返回已有记录（或本批中第一次出现的记录）的 ID
+    ids_by_request = dict(existing)
+    ids_by_request.update((records[index]['client_request_id'], new_id)
+                          for index, new_id in created_ids.items() if records[index]['client_request_id'])
+    results = []
+    for index, item in enumerate(records):
+        if index in created_ids:
+            results.append({"client_request_id": item['client_request_id'], "id": created_ids[index], "status": "created"})
+        else:
+            results.append({"client_request_id": item['client_request_id'],
+                            "id": ids_by_request.get(item['client_request_id']), "status": "duplicate"})
+    return inserted, results
 
 @app.route('/api/record/<int:record_id>', methods=['PUT'])
 def update_record(record_id):
-    print(f"[DEBUG] PUT /api/record/{record_id} 被调用")
     data = request.json
-    print(f"[DEBUG] 接收到的数据: {data}")
+    log.debug("PUT /api/record/%s 接收到的数据: %s", record_id, data)
     
     # 获取当前系统时间并自动判断班次类型
     current_time = datetime.now()
@@ -1006,21 +1291,23 @@ def update_record(record_id):
     conn = None
     try:
         conn = get_db()
-        print(f"[DEBUG] 数据库连接成功: {DB_PATH}")
+        outbox.begin_write(conn.cursor())
         
         # 获取修改前的数据
         old_record_cur = conn.cursor(); old_record_cur.execute("SELECT * FROM inbound_records WHERE id=?", (record_id,))
         old_record = old_record_cur.fetchone()
-        print(f"[DEBUG] 原始记录: {old_record}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("原始记录: %s", dict(old_record) if old_record else None)
         
         cursor = conn.cursor(); cursor.execute("""UPDATE inbound_records SET
-            dock_no=?, vehicle_type=?, vehicle_no=?, unit=?, load_amount=?, pieces=?, time_slot=?, shift_type=?, remark=?, duration=?
+            dock_no=?, vehicle_type=?, vehicle_no=?, unit=?, load_amount=?, pieces=?, time_slot=?, shift_type=?, remark=?, duration=?, updated_at=?
             WHERE id=?""",
             (data.get("dock_no"), data.get("vehicle_type"), data.get("vehicle_no"),
              data.get("unit"), data.get("load_amount"), data.get("pieces"),
-             data.get("time_slot"), shift_type, data.get("remark"), data.get("duration"), record_id))
+             data.get("time_slot"), shift_type, data.get("remark"), data.get("duration"),
+             current_time.strftime('%Y-%m-%d %H:%M:%S'), record_id))
         
-        print(f"[DEBUG] 更新操作影响的行数: {cursor.rowcount}")
+        log.debug("更新操作影响的行数: %s", cursor.rowcount)
         
         # 如果记录被成功更新，记录日志
         if cursor.rowcount > 0:
@@ -1046,24 +1333,34 @@ def update_record(record_id):
                  json.dumps(old_data, default=str), 
                  json.dumps(new_data, default=str)))
             
+            # 在同一事务中更新每日汇总表：移出旧值，计入新值
+            rollups.apply_record_delta(conn.cursor(), old_record, -1)
+            rollups.apply_record_delta(conn.cursor(), new_record, 1)
+            # 道口号或车型可能改变，重新确定修改前后所在道口的当前车辆
+            docks.refresh_docks(conn.cursor(), old_record, new_record)
+            # 同时记录修改前的数据，SSE 推送据此计算统计增量
+            outbox.record_change(conn.cursor(), 'inbound_records', record_id, 'update', new_data, old_data)
+            # 换了道口（或在占用/不占用道口的车型之间切换）时，重新计算前后相邻车辆的时长
+            if durations.placement_changed(old_record, new_record):
+                durations.recompute_for_records(conn.cursor(), old_record, new_record)
             
             conn.commit()
             
             # Broadcast update to all connected SSE clients
-            broadcast_update('refresh_stats', {'action': 'update', 'id': record_id})
+            broadcast_update(DATA_CHANGED_EVENT, {'action': 'update', 'id': record_id})
 
             if conn:
                 conn.close()
-            print("[DEBUG] 记录更新成功")
+            log.debug("记录 %s 更新成功", record_id)
             return jsonify({"success": True})
         else:
             conn.commit()
             if conn:
                 conn.close()
-            print("[DEBUG] 记录未找到")
+            log.debug("记录 %s 未找到", record_id)
             return jsonify({"success": False, "error": "记录未找到"}), 404
     except Exception as e:
-        print(f"[DEBUG] 更新记录时发生错误: {str(e)}")
+        log.error("更新记录 %s 时发生错误: %s", record_id, e)
         if conn:
             conn.rollback()
             conn.close()
@@ -1103,6 +1400,7 @@ def delete_record(record_id):
     conn = None
     try:
         conn = get_db()
+        outbox.begin_write(conn.cursor())
         
         # 获取删除前的数据
         old_record_cur = conn.cursor(); old_record_cur.execute("SELECT * FROM inbound_records WHERE id=?", (record_id,))
@@ -1127,6 +1425,18 @@ def delete_record(record_id):
                  json.dumps(old_data, default=str), 
                  json.dumps({})))  # 删除操作没有新数据
             
+            # 在同一事务中从每日汇总表移出该记录
+            rollups.apply_record_delta(conn.cursor(), old_record, -1)
+            # 删除的可能是道口当前的车辆
+            docks.refresh_docks(conn.cursor(), old_record)
+            # 前一台车的时长改为到下一台车到达
+            durations.recompute_for_records(conn.cursor(), old_record)
+            
+            # 记录删除的ID，增量列表 (/api/list?updated_since=) 据此通知客户端
+            conn.cursor().execute("""INSERT INTO deleted_records (table_name, record_id, deleted_at)
+                VALUES (?, ?, ?)""", ('inbound_records', record_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            outbox.record_change(conn.cursor(), 'inbound_records', record_id, 'delete', old_data)
+            
             conn.commit()
             
             # 删除相关的操作日志
@@ -1135,7 +1445,7 @@ def delete_record(record_id):
             conn.close()
             
             # Broadcast update to all connected SSE clients
-            broadcast_update('refresh_stats', {'action': 'delete', 'id': record_id})
+            broadcast_update(DATA_CHANGED_EVENT, {'action': 'delete', 'id': record_id})
             
             return jsonify({"success": True})
         else:
@@ -1153,108 +1463,137 @@ def delete_record(record_id):
             except:
                 pass
 
-@app.route('/api/list')
+@app.route('/api/list', methods=['GET', 'HEAD'])
 def list_data():
-    print("[DEBUG] /api/list 路由被调用")
-    print("[DEBUG] 函数开始执行")
-    conn=get_db()
-    print(f"[DEBUG] 数据库连接成功: {DB_PATH}")
-    
-    # 获取当前日期和昨天日期
+    """
+    昨天和今天的入库记录（按时间倒序）
+    
+    不带参数时返回完整列表（数组），兼容旧页面。
+    增量参数（返回 {"records": [...], "deleted": [...], "cursor": {...}}）:
+    - since_id: 只返回 ID 大于该值的新记录
+    - updated_since: 只返回该时间之后新增或修改的记录，并返回此后删除的记录 ID
+    - limit: 最多返回的记录数（最新的 N 条）
+    下次请求使用返回的 cursor 中的 since_id / updated_since。
+    响应带 ETag；数据没有变化时，条件请求和 HEAD 请求只需一次索引查询。
+    """
+    since_id = request.args.get('since_id')
+    updated_since = request.args.get('updated_since')
+    limit = request.args.get('limit')
+    try:
+        since_id = int(since_id) if since_id else None
+        limit = int(limit) if limit else None
+        if updated_since:
+            updated_since = datetime.strptime(updated_since, '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return jsonify({"error": "参数无效: since_id/limit 必须是整数, updated_since 格式为 YYYY-MM-DD HH:MM:SS"}), 400
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit 参数必须是正整数"}), 400
+    incremental = since_id is not None or updated_since is not None or limit is not None
+    
+    # 查询范围：昨天00:00:00 到 次日00:00:00（系统时间）
     current_date = datetime.now().date()
-    yesterday_date = current_date - timedelta(days=1)
-    print(f"[DEBUG] 当前系统日期: {current_date}")
-    print(f"[DEBUG] 昨天日期: {yesterday_date}")
-
-    # 计算当天和昨天的查询时间范围
-    # 当天00:00:00
-    today_start = datetime.combine(current_date, datetime.min.time())
-    # 今天23:59:59
-    today_end = datetime.combine(current_date, datetime.max.time())
-    # 昨天00:00:00
-    yesterday_start = datetime.combine(yesterday_date, datetime.min.time())
-    # 昨天23:59:59
-    yesterday_end = datetime.combine(yesterday_date, datetime.max.time())
-    
-    # 次日00:00:00的时间（系统时间，用于上限）
+    yesterday_start = datetime.combine(current_date - timedelta(days=1), datetime.min.time())
     next_day_start = datetime.combine(current_date + timedelta(days=1), datetime.min.time())
-
-    print(f"[DEBUG] 查询时间范围: {yesterday_start} 到 {next_day_start}")
-
-    # 查询当天和昨天的所有记录
-    # 修改：排除车牌号包含'G'的53英尺车辆
-    cur = conn.cursor(); cur.execute("""
-        SELECT ir.id, ir.dock_no, ir.vehicle_type, ir.vehicle_no, ir.unit, ir.load_amount,
-               ir.pieces, ir.time_slot, ir.shift_type, ir.remark, ir.created_at, ir.created_by,
-               u.username as created_by_username, ir.duration
-        FROM inbound_records ir
-        LEFT JOIN users u ON ir.created_by = u.id
-        WHERE 
-            (ir.created_at >= ? AND ir.created_at <= ?) OR (ir.created_at >= ? AND ir.created_at <= ?)
-        ORDER BY ir.created_at DESC""", (
-            yesterday_start.strftime('%Y-%m-%d %H:%M:%S'),
-            yesterday_end.strftime('%Y-%m-%d %H:%M:%S'),
-            today_start.strftime('%Y-%m-%d %H:%M:%S'),
-            today_end.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+    # 下一次增量请求的起点，在查询之前取值，避免漏掉查询期间的修改
+    server_now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    raw_rows = cur.fetchall()
-    print(f"[DEBUG] 数据库查询返回记录数: {len(raw_rows)}")
+    conn = get_db()
+    try:
+        # 数据版本标记：变更日志的最大序号（每次新增、修改、删除都在写入事务中递增，主键查询）
+        # updated_at 只精确到秒，同一秒内的两次修改无法区分，不能作为标记
+        cur = conn.cursor(); cur.execute(f"SELECT MAX(seq) FROM {outbox.OUTBOX_TABLE}")
+        marker = cur.fetchone()[0]
+        etag = hashlib.md5(repr((
+            marker, current_date.isoformat(), sorted(request.args.items(multi=True))
+        )).encode()).hexdigest()
+        
+        # If-None-Match 按弱比较：压缩后的响应带的是弱 ETag (W/)
+        if request.method == 'HEAD' or request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=200 if request.method == 'HEAD' else 304,
+                                          mimetype='application/json')
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        
+        query = """
+            SELECT ir.id, ir.dock_no, ir.vehicle_type, ir.vehicle_no, ir.unit, ir.load_amount,
+                   ir.pieces, ir.time_slot, ir.shift_type, ir.remark, ir.created_at, ir.created_by,
+                   u.username as created_by_username, ir.duration
+            FROM inbound_records ir
+            LEFT JOIN users u ON ir.created_by = u.id
+            WHERE ir.created_at >= ? AND ir.created_at < ?"""
+        params = [yesterday_start.strftime('%Y-%m-%d %H:%M:%S'), next_day_start.strftime('%Y-%m-%d %H:%M:%S')]
+        changed = []
+        if since_id is not None:
+            changed.append("ir.id > ?")
+            params.append(since_id)
+        if updated_since is not None:
+            # 迁移前的记录没有 updated_at，按创建时间判断
+            changed.append("(ir.updated_at >= ? OR ir.created_at >= ?)")
+            params.extend([updated_since, updated_since])
+        if changed:
+            query += " AND (" + " OR ".join(changed) + ")"
+        query += " ORDER BY ir.created_at DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        cur = conn.cursor(); cur.execute(query, params)
+        rows = [{
+            "id":r[0], "dock_no":r[1], "vehicle_type":r[2], "vehicle_no":r[3],
+            "unit":r[4], "load_amount":r[5], "pieces":r[6],
+            "time_slot":r[7], "shift_type":r[8], "remark":r[9],
+            "created_at":r[10],  # 数据库中存储的是系统时间，直接返回
+            "created_by":r[11],  # 创建者用户ID
+            "created_by_username":r[12] or "未知用户",  # 创建者用户名
+            "duration":r[13]  # 时长(分钟)
+        } for r in cur.fetchall()]
+        
+        if not incremental:
+            response = jsonify(rows)
+        else:
+            deleted = []
+            if updated_since is not None:
+                cur = conn.cursor(); cur.execute("""
+                    SELECT record_id FROM deleted_records
+                    WHERE table_name = 'inbound_records' AND deleted_at >= ?""", (updated_since,))
+                deleted = [r[0] for r in cur.fetchall()]
+            response = jsonify({
+                "records": rows,
+                "deleted": deleted,
+                "cursor": {
+                    "since_id": max([since_id or 0] + [r["id"] for r in rows]),
+                    "updated_since": server_now
+                }
+            })
+    finally:
+        conn.close()
     
-    rows=[{
-        "id":r[0], "dock_no":r[1], "vehicle_type":r[2], "vehicle_no":r[3],
-        "unit":r[4], "load_amount":r[5], "pieces":r[6],
-        "time_slot":r[7], "shift_type":r[8], "remark":r[9],
-        "created_at":r[10],  # 数据库中存储的是系统时间，直接返回
-        "created_by":r[11],  # 创建者用户ID
-        "created_by_username":r[12] or "未知用户",  # 创建者用户名
-        "duration":r[13]  # 时长(分钟)
-    } for r in raw_rows]
-    
-    print(f"[DEBUG] 处理后返回记录数: {len(rows)}")
-    conn.close()
-    print(f"[DEBUG] 返回JSON数据: {jsonify(rows)}")
-    return jsonify(rows)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 # 新增API：获取按时间段分组的入库数据
 
 @app.route('/api/inbound_hourly')
+@cached_response()
 def inbound_hourly_data():
     # 获取日期参数，默认为今天
     date_str = request.args.get('date')
     
-    conn=get_db()
-    
-    # 获取洛杉矶当前日期
-    la_tz = pytz.timezone('America/Los_Angeles')
-    
     if date_str:
         # 如果提供了日期参数，使用指定日期
         try:
             request_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         except ValueError:
-            conn.close()
             return jsonify({"error": "日期格式无效，请使用YYYY-MM-DD格式"}), 400
     else:
-        # 如果没有提供日期参数，使用今天
-        request_date = datetime.now(la_tz).date()
+        # 如果没有提供日期参数，使用当前业务日（与 /api/stats 一致）
+        request_date = business_days.current_business_date()
     
-    # 计算次日日期
-    next_date = request_date + timedelta(days=1)
-    
-    # 构建日期范围查询条件（使用洛杉矶时区时间进行计算）
-    # 当天05:00:00的时间（洛杉矶时间）
-    request_date_5am_la = la_tz.localize(datetime.combine(request_date, datetime.min.time().replace(hour=5)))
-    
-    # 次日05:00:00的时间（洛杉矶时间，用于上限）
-    next_date_5am_la = la_tz.localize(datetime.combine(next_date, datetime.min.time().replace(hour=5)))
-    
-    # 转换为系统本地时间用于数据库查询
-    # 注意：数据库中存储的是系统本地时间，不是UTC时间
-    request_date_5am_local = request_date_5am_la.astimezone()
-    next_date_5am_local = next_date_5am_la.astimezone()
+    conn=get_db()
     
-    # 查询入库记录，按时间段分组（查询当天05:00之后到次日05:00之前的所有记录）
+    # 查询入库记录，按时间段分组（业务日：当天05:00到次日05:00，写入时已计算）
     # 同时查询26英尺和53英尺车辆的装载量
     cur = conn.cursor(); cur.execute("""
         SELECT 
@@ -1266,74 +1605,43 @@ def inbound_hourly_data():
             END) as total_load_amount
         FROM inbound_records ir
         WHERE 
-            ir.created_at >= ? AND ir.created_at < ? AND ir.time_slot IS NOT NULL
+            ir.business_date = ? AND ir.time_slot IS NOT NULL
         GROUP BY ir.time_slot
-        ORDER BY ir.time_slot""", (
-            request_date_5am_local.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_date_5am_local.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        ORDER BY ir.time_slot""", (request_date.strftime('%Y-%m-%d'),))
     rows=[{
         "time_slot": r[0],
         "total_pieces": r[1] if r[1] else 0,
         "total_load_amount": r[2] if r[2] else 0
     } for r in cur.fetchall()]
+    conn.close()
     return jsonify(rows)
 
 @app.route('/api/pallet_hourly')
+@cached_response()
 def pallet_hourly_data():
     # 获取日期参数，默认为今天
     date_str = request.args.get('date')
     
-    conn=get_db()
-    
-    # 获取洛杉矶当前日期
-    la_tz = pytz.timezone('America/Los_Angeles')
-    
     if date_str:
         # 如果提供了日期参数，使用指定日期
         try:
             request_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         except ValueError:
-            conn.close()
             return jsonify({"error": "日期格式无效，请使用YYYY-MM-DD格式"}), 400
     else:
-        # 如果没有提供日期参数，使用今天
-        # 但为了确保能看到最新数据，我们需要调整日期范围
-        # 如果当前时间在洛杉矶时间05:00之前，我们应该查看昨天的数据
-        now_la = datetime.now(la_tz)
-        if now_la.hour < 5:
-            # 如果当前洛杉矶时间在05:00之前，使用昨天的日期
-            request_date = now_la.date() - timedelta(days=1)
-        else:
-            # 否则使用今天的日期
-            request_date = now_la.date()
-    
-    # 计算次日日期
-    next_date = request_date + timedelta(days=1)
-    
-    # 构建日期范围查询条件（使用洛杉矶时区时间进行计算）
-    # 当天05:00:00的时间（洛杉矶时间）
-    request_date_5am_la = la_tz.localize(datetime.combine(request_date, datetime.min.time().replace(hour=5)))
+        # 如果没有提供日期参数，使用当前业务日（洛杉矶时间05:00之前属于前一天）
+        request_date = business_days.current_business_date()
     
-    # 次日05:00:00的时间（洛杉矶时间，用于上限）
-    next_date_5am_la = la_tz.localize(datetime.combine(next_date, datetime.min.time().replace(hour=5)))
-    
-    # 转换为系统本地时间用于数据库查询
-    # 注意：数据库中存储的是系统本地时间，不是UTC时间
-    request_date_5am_local = request_date_5am_la.astimezone()
-    next_date_5am_local = next_date_5am_la.astimezone()
+    conn=get_db()
     
     # 查询当天数据：入库记录中车辆类型为26英尺或53英尺的记录，按时间段分组
     cur = conn.cursor(); cur.execute("""
         SELECT time_slot, SUM(load_amount) as total_load_amount, COUNT(*) as count
         FROM inbound_records 
         WHERE 
-            created_at >= ? AND created_at < ? AND (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
+            business_date = ? AND (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
         GROUP BY time_slot
-        ORDER BY time_slot""", (
-            request_date_5am_local.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_date_5am_local.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        ORDER BY time_slot""", (request_date.strftime('%Y-%m-%d'),))
     current_day_rows=[{
         "time_slot": r[0] if r[0] else '未指定',
         "total_load_amount": r[1] if r[1] else 0,
@@ -1346,7 +1654,7 @@ def pallet_hourly_data():
             time_slot,
             SUM(load_amount) as total_load_amount,
             COUNT(*) as total_count,
-            COUNT(DISTINCT DATE(created_at)) as days_count
+            COUNT(DISTINCT business_date) as days_count
         FROM inbound_records
         WHERE vehicle_type IN ('26英尺', '53英尺')
             AND time_slot IS NOT NULL
@@ -1458,29 +1766,19 @@ def get_history():
                 }
             }), 400
         
-        # 计算次日日期
+        # 分拣记录按分拣日期查询：当天到次日（不含）
         next_date = request_date + timedelta(days=1)
         
-        # 构建日期范围查询条件（使用自然日）
-        # 当天00:00:00的时间（系统时间）
-        today_start = datetime.combine(request_date, datetime.min.time())
-        
-        # 次日00:00:00的时间（系统时间，用于上限）
-        next_day_start = datetime.combine(next_date, datetime.min.time())
-        
-        # 查询指定日期的入库记录（查询当天00:00之后到次日00:00之前的所有记录）
+        # 查询指定业务日的入库记录（与 /api/stats 口径一致：当天05:00到次日05:00）
         inbound_query = """
             SELECT id, dock_no, vehicle_type, vehicle_no, unit, load_amount,
                    pieces, time_slot, shift_type, remark, created_at, duration, is_synced
             FROM inbound_records 
             WHERE 
-                created_at >= ? AND created_at < ?
+                business_date = ?
             ORDER BY created_at DESC
         """
-        inbound_cur = conn.cursor(); inbound_cur.execute(inbound_query, (
-            today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        inbound_cur = conn.cursor(); inbound_cur.execute(inbound_query, (request_date.strftime('%Y-%m-%d'),))
         inbound_rows = [{
             "id": r[0], "dock_no": r[1], "vehicle_type": r[2], "vehicle_no": r[3],
             "unit": r[4], "load_amount": r[5], "pieces": r[6],
@@ -1499,8 +1797,8 @@ def get_history():
             ORDER BY created_at DESC
         """
         sorting_cur = conn.cursor(); sorting_cur.execute(sorting_query, (
-            today_start.strftime('%Y-%m-%d'), 
-            next_day_start.strftime('%Y-%m-%d')
+            request_date.strftime('%Y-%m-%d'), 
+            next_date.strftime('%Y-%m-%d')
         ))
         sorting_rows = [{
             "id": r[0], "sorting_time": r[1], "pieces": r[2], "remark": r[3],
@@ -1547,93 +1845,133 @@ def get_history():
         conn.close()
         return jsonify({"error": f"处理历史记录查询时出错: {str(e)}"}), 500
 
+# 操作日志分页：默认每页条数与上限
+LOGS_DEFAULT_LIMIT = 50
+LOGS_MAX_LIMIT = 500
+
+def format_operation_log(row, raw=False):
+    """操作日志行转为字典；raw=True 时 old_data/new_data 保持数据库中的 JSON 字符串，不做解析"""
+    log_id, operation_type, table_name, record_id, old_data, new_data, created_at = row
+    if not raw:
+        # 解析JSON数据
+        try:
+            old_data = json.loads(old_data) if old_data else {}
+        except:
+            old_data = {"raw_data": old_data}
+        try:
+            new_data = json.loads(new_data) if new_data else {}
+        except:
+            new_data = {"raw_data": new_data}
+    return {
+        "id": log_id,
+        "operation_type": operation_type,
+        "table_name": table_name,
+        "record_id": record_id,
+        "old_data": old_data,
+        "new_data": new_data,
+        "created_at": created_at
+    }
+
 @app.route('/api/logs')
 def get_operation_logs():
-    """获取操作日志列表"""
+    """
+    获取操作日志列表（按 ID 倒序，即最新在前）
+    
+    不带参数时返回最新的 LOGS_MAX_LIMIT 条（数组），兼容旧调用。
+    带任意参数时按游标分页，返回 {"logs": [...], "pagination": {...}}:
+    - before_id: 只返回 ID 小于该值的日志（上一页返回的 next_before_id）
+    - limit: 每页条数（默认 50，最多 500）
+    - operation_type / table_name / record_id: 精确筛选
+    - date_from / date_to: 创建日期范围 YYYY-MM-DD（含两端）
+    - raw=1: old_data/new_data 直接返回数据库中的 JSON 字符串
+    """
+    args = request.args
+    paged = bool(args)
+    try:
+        before_id = int(args['before_id']) if args.get('before_id') else None
+        limit = int(args['limit']) if args.get('limit') else (LOGS_DEFAULT_LIMIT if paged else LOGS_MAX_LIMIT)
+        record_id = int(args['record_id']) if args.get('record_id') else None
+        date_from = datetime.strptime(args['date_from'], '%Y-%m-%d') if args.get('date_from') else None
+        date_to = datetime.strptime(args['date_to'], '%Y-%m-%d') if args.get('date_to') else None
+    except ValueError:
+        return jsonify({"error": "参数无效: before_id/limit/record_id 必须是整数, date_from/date_to 格式为 YYYY-MM-DD"}), 400
+    if limit <= 0:
+        return jsonify({"error": "limit 参数必须是正整数"}), 400
+    limit = min(limit, LOGS_MAX_LIMIT)
+    raw = args.get('raw', '').lower() in ('1', 'true', 'yes')
+    
+    conditions = []
+    params = []
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    for column in ('operation_type', 'table_name'):
+        if args.get(column):
+            conditions.append(f"{column} = ?")
+            params.append(args[column])
+    if record_id is not None:
+        conditions.append("record_id = ?")
+        params.append(record_id)
+    if date_from is not None:
+        conditions.append("created_at >= ?")
+        params.append(date_from.strftime('%Y-%m-%d %H:%M:%S'))
+    if date_to is not None:
+        conditions.append("created_at < ?")
+        params.append((date_to + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'))
+    
+    query = """
+        SELECT id, operation_type, table_name, record_id, old_data, new_data, created_at 
+        FROM operation_logs"""
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    # 多取一条判断是否还有下一页
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    
+    try:
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            logs = cursor.fetchall()
+        finally:
+            conn.close()
+        
+        has_next = len(logs) > limit
+        result = [format_operation_log(row, raw) for row in logs[:limit]]
+        if not paged:
+            return jsonify(result)
+        return jsonify({
+            "logs": result,
+            "pagination": {
+                "limit": limit,
+                "has_next": has_next,
+                "next_before_id": result[-1]["id"] if has_next else None
+            }
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/logs/<int:log_id>')
+def get_operation_log_detail(log_id):
+    """获取单个操作日志详情"""
     try:
         conn = get_db()
         cursor = conn.cursor()
         
-        # 查询所有操作日志，按时间倒序排列
+        # 查询指定ID的操作日志
         cursor.execute("""
             SELECT id, operation_type, table_name, record_id, old_data, new_data, created_at 
             FROM operation_logs 
-            ORDER BY created_at DESC
-        """)
+            WHERE id = ?
+        """, (log_id,))
         
-        logs = cursor.fetchall()
-        result = []
-        
-        for log in logs:
-            log_id, operation_type, table_name, record_id, old_data, new_data, created_at = log
-            
-            # 解析JSON数据
-            try:
-                old_data_parsed = json.loads(old_data) if old_data else {}
-            except:
-                old_data_parsed = {"raw_data": old_data}
-                
-            try:
-                new_data_parsed = json.loads(new_data) if new_data else {}
-            except:
-                new_data_parsed = {"raw_data": new_data}
-            
-            result.append({
-                "id": log_id,
-                "operation_type": operation_type,
-                "table_name": table_name,
-                "record_id": record_id,
-                "old_data": old_data_parsed,
-                "new_data": new_data_parsed,
-                "created_at": created_at
-            })
-        
-        conn.close()
-        return jsonify(result)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route('/api/logs/<int:log_id>')
-def get_operation_log_detail(log_id):
-    """获取单个操作日志详情"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # 查询指定ID的操作日志
-        cursor.execute("""
-            SELECT id, operation_type, table_name, record_id, old_data, new_data, created_at 
-            FROM operation_logs 
-            WHERE id = ?
-        """, (log_id,))
-        
-        log = cursor.fetchone()
-        if not log:
+        row = cursor.fetchone()
+        if not row:
             conn.close()
             return jsonify({"error": "日志未找到"}), 404
         
-        log_id, operation_type, table_name, record_id, old_data, new_data, created_at = log
-        
-        # 解析JSON数据
-        try:
-            old_data_parsed = json.loads(old_data) if old_data else {}
-        except:
-            old_data_parsed = {"raw_data": old_data}
-            
-        try:
-            new_data_parsed = json.loads(new_data) if new_data else {}
-        except:
-            new_data_parsed = {"raw_data": new_data}
-        
-        result = {
-            "id": log_id,
-            "operation_type": operation_type,
-            "table_name": table_name,
-            "record_id": record_id,
-            "old_data": old_data_parsed,
-            "new_data": new_data_parsed,
-            "created_at": created_at
-        }
+        result = format_operation_log(row)
         
         conn.close()
         return jsonify(result)
@@ -1643,21 +1981,45 @@ def get_operation_log_detail(log_id):
 @app.route('/api/sorting', methods=['POST'])
 def add_sorting_record():
     data = request.json
+    client_request_id = data.get("client_request_id") or None
     
     conn=get_db()
+    if client_request_id:
+        existing_id = find_client_request(conn.cursor(), 'sorting_records', client_request_id)
+        if existing_id:
+            conn.close()
+            return jsonify({"success": True, "record_id": existing_id, "duplicate": True})
+    outbox.begin_write(conn.cursor())
     
     # 获取当前洛杉矶时间
     la_tz = pytz.timezone('America/Los_Angeles')
     current_la_time = datetime.now(la_tz)
     current_la_time_str = current_la_time.strftime('%Y-%m-%d %H:%M:%S')
+    # 分拣记录的 created_at 已经是洛杉矶时间
+    business_date, hour_bucket = business_days.business_fields(current_la_time_str, is_la_time=True)
     
-    conn.cursor().execute("""INSERT INTO sorting_records
-        (sorting_time, pieces, remark, time_slot, created_at)
-        VALUES (?, ?, ?, ?, ?)""",
-        (data.get("sorting_time"), data.get("pieces"), data.get("remark"), data.get("time_slot"), current_la_time_str))
+    try:
+        new_id = insert_returning_id(conn.cursor(), """INSERT INTO sorting_records
+            (sorting_time, pieces, remark, time_slot, created_at, client_request_id, business_date, hour_bucket)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (data.get("sorting_time"), data.get("pieces"), data.get("remark"), data.get("time_slot"),
+             current_la_time_str, client_request_id, business_date, hour_bucket))
+    except Exception as e:
+        conn.rollback()
+        if client_request_id and is_unique_violation(e):
+            existing_id = find_client_request(conn.cursor(), 'sorting_records', client_request_id)
+            conn.close()
+            return jsonify({"success": True, "record_id": existing_id, "duplicate": True})
+        conn.close()
+        raise
+    outbox.record_change(conn.cursor(), 'sorting_records', new_id, 'insert', {
+        "id": new_id, "sorting_time": data.get("sorting_time"), "pieces": data.get("pieces"),
+        "remark": data.get("remark"), "time_slot": data.get("time_slot"), "created_at": current_la_time_str,
+        "client_request_id": client_request_id, "business_date": business_date, "hour_bucket": hour_bucket
+    })
     conn.commit()
     conn.close()
-    return jsonify({"success":True})
+    return jsonify({"success":True, "record_id": new_id})
 
 @app.route('/api/sorting', methods=['GET'])
 def get_sorting_records():
@@ -1675,6 +2037,7 @@ def delete_sorting_record(record_id):
     conn = None
     try:
         conn = get_db()
+        outbox.begin_write(conn.cursor())
         
         # 获取删除前的数据
         old_record_cur = conn.cursor(); old_record_cur.execute("SELECT * FROM sorting_records WHERE id=?", (record_id,))
@@ -1697,6 +2060,7 @@ def delete_sorting_record(record_id):
                 ('delete', 'sorting_records', record_id, 
                  json.dumps(old_data, default=str), 
                  json.dumps({})))  # 删除操作没有新数据
+            outbox.record_change(conn.cursor(), 'sorting_records', record_id, 'delete', old_data)
         
             conn.commit()
             conn.close()
@@ -1719,69 +2083,84 @@ def delete_sorting_record(record_id):
 
 # 获取揽收预估与实际入库对比数据
 @app.route('/api/forecast_vs_actual')
+@cached_response()
 def forecast_vs_actual():
-    conn = get_db()
+    """
+    揽收预估与实际入库对比
     
-    # 查询所有有预估数据的日期，按日期升序排列
-    forecast_dates_cur = conn.cursor(); forecast_dates_cur.execute("""
-        SELECT forecast_date, forecast_amount 
-        FROM pickup_forecast 
-        ORDER BY forecast_date ASC
-    """)
+    可选参数:
+    - start / end: YYYY-MM-DD，只返回该范围内的预估日期
+    - limit: 只返回最近 N 个预估日期（仍按日期升序）
+    """
+    start_str = request.args.get('start')
+    end_str = request.args.get('end')
+    try:
+        if start_str:
+            datetime.strptime(start_str, '%Y-%m-%d')
+        if end_str:
+            datetime.strptime(end_str, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({"error": "日期格式无效，请使用YYYY-MM-DD格式"}), 400
+    try:
+        limit = int(request.args.get('limit')) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({"error": "limit 参数必须是正整数"}), 400
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit 参数必须是正整数"}), 400
+    
+    # 一次查询：按业务日汇总实际件数（排除53英尺G车的货量），与预估表关联
+    query = """
+        SELECT f.forecast_date, f.forecast_amount, a.actual_pieces
+        FROM pickup_forecast f
+        LEFT JOIN (
+            SELECT business_date, SUM(pieces - g53_pieces) AS actual_pieces
+            FROM daily_rollups
+            GROUP BY business_date
+        ) a ON a.business_date = f.forecast_date
+    """
+    conditions = []
+    params = []
+    if start_str:
+        conditions.append("f.forecast_date >= ?")
+        params.append(start_str)
+    if end_str:
+        conditions.append("f.forecast_date <= ?")
+        params.append(end_str)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if limit:
+        query += " ORDER BY f.forecast_date DESC LIMIT ?"
+        params.append(limit)
+    else:
+        query += " ORDER BY f.forecast_date ASC"
     
-    forecast_records = forecast_dates_cur.fetchall()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    if limit:
+        rows = rows[::-1]
     
     dates = []
     forecast_data = []
     actual_data = []
     difference_percent = []
     
-    # 遍历所有有预估数据的日期
-    for record in forecast_records:
-        date_str = record[0]
-        forecast_val = record[1]
+    for row in rows:
+        forecast_val = row[1]
+        actual_val = int(row[2]) if row[2] else 0
         
-        dates.append(date_str)
+        # 兼容处理: PostgreSQL 返回 date 对象, SQLite 返回字符串
+        dates.append(row[0])
         forecast_data.append(forecast_val)
+        actual_data.append(actual_val)
         
-        # 查询该日期的实际入库数据
-        try:
-            # 兼容处理: PostgreSQL 可能直接返回 date 对象, SQLite 返回字符串
-            if isinstance(date_str, str):
-                date = datetime.strptime(date_str, '%Y-%m-%d').date()
-            else:
-                date = date_str # 假设是 date 或 datetime 对象
-            day_start = datetime.combine(date, datetime.min.time())
-            next_day = date + timedelta(days=1)
-            day_end = datetime.combine(next_day, datetime.min.time())
-            
-            actual_cur = conn.cursor(); actual_cur.execute("""
-                SELECT SUM(CASE 
-                    WHEN vehicle_type = '53英尺' AND vehicle_no = 'G' THEN 0 
-                    ELSE pieces 
-                END) as total_pieces
-                FROM inbound_records
-                WHERE created_at >= ? AND created_at < ?
-            """, (day_start.strftime('%Y-%m-%d %H:%M:%S'), 
-                  day_end.strftime('%Y-%m-%d %H:%M:%S')))
-            
-            actual_row = actual_cur.fetchone()
-            actual_val = int(actual_row[0]) if actual_row and actual_row[0] else 0
-            actual_data.append(actual_val)
-            
-            # 计算差异百分比
-            if forecast_val > 0:
-                diff_pct = round((actual_val - forecast_val) / forecast_val * 100, 1)
-            else:
-                diff_pct = 0
-            difference_percent.append(diff_pct)
-        except Exception as e:
-            print(f"处理日期 {date_str} 时出错: {e}")
-            actual_data.append(0)
+        # 计算差异百分比
+        if forecast_val > 0:
+            difference_percent.append(round((actual_val - forecast_val) / forecast_val * 100, 1))
+        else:
             difference_percent.append(0)
     
-    conn.close()
-    
     return jsonify({
         "dates": dates,
         "forecast": forecast_data,
@@ -1797,419 +2176,353 @@ def forecast_vs_actual():
 def sse_updates():
     """
     Server-Sent Events 端点，用于推送实时更新到所有连接的客户端
-    支持跨设备、跨浏览器的实时同步
+    事件 ID 为变更日志的 seq；连接时通过 Last-Event-ID 请求头或 ?last_event_id= 参数
+    （首次连接时为 /api/stats 返回的 seq）补发之后的事件
     """
-    def event_stream():
-        # 为这个客户端创建一个队列
-        q = Queue()
-        with sse_queues_lock:
-            sse_queues.append(q)
-            client_count = len(sse_queues)
-        
-        print(f"[SSE] New client connected. Total clients: {client_count}")
-        
-        try:
-            # 发送初始连接消息
-            yield f"data: {json.dumps({'type': 'connected', 'message': 'SSE connection established'})}\n\n"
-            
-            # 持续监听队列中的事件
-            while True:
-                try:
-                    # 等待事件，超时30秒发送心跳
-                    message = q.get(timeout=30)
-                    yield f"data: {json.dumps(message)}\n\n"
-                except:
-                    # 超时，发送心跳保持连接
-                    yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.now(LA_TZ).isoformat()})}\n\n"
-        finally:
-            # 客户端断开时，移除队列
-            with sse_queues_lock:
-                if q in sse_queues:
-                    sse_queues.remove(q)
-                    client_count = len(sse_queues)
-            print(f"[SSE] Client disconnected. Remaining clients: {client_count}")
-    
-    return Response(event_stream(), mimetype='text/event-stream', headers={
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    
+    client = sse_hub.connect(last_event_id)
+    if client is None:
+        # 连接数已满（线程模式下避免长连接占满 worker 线程）；客户端稍后重连，期间轮询
+        return Response('SSE 连接数已满，请稍后重试', status=503,
+                        mimetype='text/plain', headers={'Retry-After': '30'})
+    
+    response = Response(sse_hub.stream(client), mimetype='text/event-stream', headers={
         'Cache-Control': 'no-cache',
         'X-Accel-Buffering': 'no',  # Disable nginx buffering
         'Connection': 'keep-alive'
     })
+    # 客户端在事件流开始前断开时生成器不会执行，这里确保释放连接名额
+    response.call_on_close(lambda: sse_hub.disconnect(client))
+    return response
+
+@app.route('/api/sse_stats')
+def sse_stats():
+    """SSE 连接数、已发布和丢弃的事件数"""
+    return jsonify(sse_hub.get_stats())
+
+# 变更日志读取：每次最多返回的条数
+CHANGES_DEFAULT_LIMIT = 100
+CHANGES_MAX_LIMIT = 1000
+
+@app.route('/api/changes')
+def get_changes():
+    """
+    按序号增量读取变更日志 (change_outbox)
+    - since: 返回 seq 大于该值的变更（默认 0）；省略且提供 consumer 时从该消费者已确认的位置开始
+    - consumer: 消费者名称，处理完后用 POST /api/changes/ack 确认位置
+    - limit: 最多返回条数（默认 100，最多 1000）
+    - table: 只返回该表的变更
+    - raw=1: row 保持数据库中的 JSON 字符串，不做解析
+    返回 {"changes": [...], "next_since": 下次请求的 since, "has_more": 是否还有更多}
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': '未登录'}), 401
+    # 变更日志包含完整的行数据，只有管理员可以读取和确认
+    if session.get('role') != 'admin':
+        return jsonify({'error': '权限不足'}), 403
+    args = request.args
+    consumer = args.get('consumer')
+    try:
+        since = int(args['since']) if args.get('since') else None
+        limit = int(args['limit']) if args.get('limit') else CHANGES_DEFAULT_LIMIT
+    except ValueError:
+        return jsonify({"error": "参数无效: since/limit 必须是整数"}), 400
+    if limit <= 0:
+        return jsonify({"error": "limit 参数必须是正整数"}), 400
+    limit = min(limit, CHANGES_MAX_LIMIT)
+    raw = args.get('raw', '').lower() in ('1', 'true', 'yes')
+    
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            if since is None:
+                since = outbox.get_offset(cursor, consumer) if consumer else 0
+            # 多取一条判断是否还有更多
+            changes = outbox.fetch_changes(cursor, since, limit + 1, args.get('table'), raw)
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        return jsonify({
+            "changes": changes,
+            "next_since": changes[-1]['seq'] if changes else since,
+            "has_more": has_more
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/changes/ack', methods=['POST'])
+def ack_changes():
+    """确认消费者已处理到的位置：{"consumer": "...", "seq": N}"""
+    if 'user_id' not in session:
+        return jsonify({'error': '未登录'}), 401
+    # 变更日志包含完整的行数据，只有管理员可以读取和确认
+    if session.get('role') != 'admin':
+        return jsonify({'error': '权限不足'}), 403
+    data = request.json or {}
+    consumer = str(data.get('consumer') or '').strip()
+    try:
+        seq = int(data.get('seq'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "seq 必须是整数"}), 400
+    if not consumer or seq < 0:
+        return jsonify({"error": "需要 consumer 和非负的 seq"}), 400
+    if consumer == SYNC_CONSUMER:
+        return jsonify({"error": f"{consumer} 由后台同步使用"}), 400
+    try:
+        with get_db_connection() as conn:
+            outbox.set_offset(conn.cursor(), consumer, seq)
+        return jsonify({"success": True, "consumer": consumer, "last_seq": seq})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/sync_stats')
+def sync_stats():
+    """后台同步积压：待同步条数、最早待同步变更的时长、最近一次成功/失败"""
+    try:
+        return jsonify(sync_worker.get_stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ============================================================================
+
 
 # ============================================================================
+# 统计引擎 - 一次分组查询同时计算指定业务日与前一业务日
+# ============================================================================
+
+# 前一业务日与指定业务日的记录在一次扫描中按 (业务日, 车型, 时间段) 分组
+# 业务日为写入时计算的 business_date 列, 不再换算时区范围
+# 特殊规则: 53英尺车牌号为G的车辆,车次计入但货量和托盘不计入
+# 未录入时间段的记录保留 created_at 作为分组键, 以便按创建时间后备统计
+STATS_GROUP_QUERY = """
+    SELECT
+        CASE WHEN business_date = ? THEN 1 ELSE 0 END AS is_current,
+        vehicle_type,
+        time_slot,
+        CASE WHEN time_slot IS NULL OR time_slot = '' THEN created_at END AS fallback_at,
+        COUNT(*) AS vehicles,
+        SUM(CASE
+            WHEN vehicle_type = '53英尺' AND vehicle_no = 'G' THEN 0
+            ELSE pieces
+        END) AS pieces,
+        SUM(CASE
+            WHEN (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
+                 AND NOT (vehicle_type = '53英尺' AND vehicle_no = 'G') THEN load_amount
+        END) AS pallets
+    FROM inbound_records
+    WHERE business_date IN (?, ?)
+    GROUP BY 1, 2, 3, 4
+"""
+
+# 统计结果与变更日志最大序号在同一条语句中读取 (同一快照), 客户端以此为起点应用 SSE 增量
+# 没有记录时 LEFT JOIN 仍返回一行序号
+STATS_SNAPSHOT_QUERY = f"""
+    SELECT o.seq, s.*
+    FROM (SELECT MAX(seq) AS seq FROM {outbox.OUTBOX_TABLE}) o
+    LEFT JOIN ({STATS_GROUP_QUERY}) s ON 1 = 1
+"""
+
+def classify_night_slot(time_slot, fallback_at, business_date):
+    """
+    判断记录属于哪些晚班时段, 返回 (19点, 20点, 超过24点) 三个布尔值
+    优先使用录入的时间段; 未录入时按创建时间后备判断; 无法判断时返回 None
+    """
+    if time_slot:
+        try:
+            slot = int(time_slot)
+        except ValueError:
+            # 如果time_slot不是有效的整数，跳过这条记录
+            return None
+        return slot == 19, slot == 20, slot >= 24
+    if not fallback_at:
+        return None
+    # 将UTC时间字符串转换为系统本地时间
+    if isinstance(fallback_at, str):
+        utc_time = datetime.strptime(fallback_at, '%Y-%m-%d %H:%M:%S')
+    else:
+        utc_time = fallback_at
+    local_time = pytz.utc.localize(utc_time).astimezone()
+    return local_time.hour == 19, local_time.hour == 20, local_time.date() > business_date
+
+def compute_business_day_stats(conn, request_date):
+    """
+    计算指定业务日的统计数据及相对前一业务日的趋势
+    只执行一次数据库查询, 新增计数器无需额外的查询
+    """
+    prev_date = request_date - timedelta(days=1)
+    current_key = request_date.strftime('%Y-%m-%d')
+
+    cur = conn.cursor(); cur.execute(STATS_SNAPSHOT_QUERY, (current_key, prev_date.strftime('%Y-%m-%d'), current_key))
+
+    current = {'vehicles': 0, 'pieces': 0, 'pallets': 0, '19': 0, '20': 0, 'after_24': 0}
+    prev = dict(current)
+    vehicle_stats = {}
+    by_type_19 = {}
+    by_type_20 = {}
+    seq = None
+
+    for row in cur.fetchall():
+        seq, is_current, vehicle_type, time_slot, fallback_at, count, pieces, pallets = row
+        if is_current is None:
+            continue
+        counters = current if is_current else prev
+        counters['vehicles'] += count
+        counters['pieces'] += int(pieces) if pieces else 0
+        counters['pallets'] += int(pallets) if pallets else 0
+
+        if is_current:
+            stat = vehicle_stats.setdefault(vehicle_type, [0, 0])
+            stat[0] += count
+            stat[1] += int(pieces) if pieces else 0
+
+        try:
+            flags = classify_night_slot(time_slot, fallback_at, request_date if is_current else prev_date)
+        except Exception as e:
+            if is_current:
+                log.warning("处理时间 %s 的记录时出错: %s", fallback_at, e)
+            continue
+        if flags is None:
+            continue
+        in_19, in_20, after_24 = flags
+
+        if is_current:
+            # 当天: 各时段独立统计
+            if in_19:
+                current['19'] += count
+                by_type_19[vehicle_type] = by_type_19.get(vehicle_type, 0) + count
+            if in_20:
+                current['20'] += count
+                by_type_20[vehicle_type] = by_type_20.get(vehicle_type, 0) + count
+            if after_24:
+                current['after_24'] += count
+        else:
+            # 前一天: 每条记录只计入一个时段 (超过24点优先)
+            if after_24:
+                prev['after_24'] += count
+            elif in_19:
+                prev['19'] += count
+            elif in_20:
+                prev['20'] += count
+
+    # 各车型统计按车型排序 (与 GROUP BY vehicle_type 的输出顺序一致)
+    vehicle_stats_list = [{
+        "vehicle_type": vt,
+        "count": stat[0],
+        "total_pieces": stat[1]
+    } for vt, stat in sorted(vehicle_stats.items(), key=lambda item: (item[0] is not None, item[0] or ''))]
+
+    # 计算增长率
+    def calculate_trend(current_val, previous_val):
+        if previous_val == 0:
+            return 100 if current_val > 0 else 0
+        return ((current_val - previous_val) / previous_val) * 100
+
+    today_night_shift_total = current['19'] + current['20'] + current['after_24']
+    prev_night_shift_total = prev['19'] + prev['20'] + prev['after_24']
+
+    return {
+        "total_vehicles": current['vehicles'],
+        "total_pieces": current['pieces'],
+        "total_pallets": current['pallets'],
+        "vehicle_stats": vehicle_stats_list,
+        "vehicles_19_to_20": current['19'],
+        "vehicles_19_to_20_by_type": by_type_19,
+        "vehicles_20_to_21": current['20'],
+        "vehicles_20_to_21_by_type": by_type_20,
+        "vehicles_after_24": current['after_24'],
+        # 趋势数据
+        "pieces_trend": round(calculate_trend(current['pieces'], prev['pieces']), 1),
+        "vehicles_trend": round(calculate_trend(current['vehicles'], prev['vehicles']), 1),
+        "pallets_trend": round(calculate_trend(current['pallets'], prev['pallets']), 1),
+        "night_shift_trend": round(calculate_trend(today_night_shift_total, prev_night_shift_total), 1),
+        "vehicles_19_to_20_trend": round(calculate_trend(current['19'], prev['19']), 1),
+        "vehicles_20_to_21_trend": round(calculate_trend(current['20'], prev['20']), 1),
+        "vehicles_after_24_trend": round(calculate_trend(current['after_24'], prev['after_24']), 1),
+        "prev_pieces": prev['pieces'],
+        "prev_vehicles": prev['vehicles'],
+        # 前一业务日的其他计数, 客户端应用增量后据此重新计算趋势
+        "prev_pallets": prev['pallets'],
+        "prev_vehicles_19_to_20": prev['19'],
+        "prev_vehicles_20_to_21": prev['20'],
+        "prev_vehicles_after_24": prev['after_24'],
+        # 统计对应的变更日志序号 (SSE 事件 ID), 客户端从这里开始接收增量
+        "seq": seq or 0
+    }
 
+def stats_contribution(row):
+    """
+    一条入库记录对所属业务日统计的贡献, 口径与 STATS_GROUP_QUERY、compute_business_day_stats 一致
+    客户端查看该业务日时按 "当天" 规则计入, 查看后一业务日时按 "前一天" 规则计入
+    没有业务日的记录不参与统计, 返回 None
+    """
+    if not row.get('business_date'):
+        return None
+    business_date = datetime.strptime(str(row['business_date'])[:10], '%Y-%m-%d').date()
+    vehicle_type = row.get('vehicle_type')
+    excluded = vehicle_type == '53英尺' and row.get('vehicle_no') == 'G'
+    pallets = row.get('load_amount') if vehicle_type in ('26英尺', '53英尺') and not excluded else None
+    try:
+        flags = classify_night_slot(row.get('time_slot'),
+                                    None if row.get('time_slot') else row.get('created_at'), business_date)
+    except Exception as e:
+        log.warning("处理时间 %s 的记录时出错: %s", row.get('created_at'), e)
+        flags = None
+    return {
+        'business_date': business_date.strftime('%Y-%m-%d'),
+        'vehicle_type': vehicle_type,
+        'pieces': 0 if excluded or not row.get('pieces') else int(float(row['pieces'])),
+        'pallets': int(float(pallets)) if pallets else 0,
+        # (19点, 20点, 超过24点); 无法判断时段时为 None
+        'night': list(flags) if flags else None,
+    }
 
 @app.route('/api/stats')
+@cached_response()
 def get_statistics():
     # 获取日期参数，默认为今天
     date_str = request.args.get('date')
-    
-    conn=get_db()
-    
-    # 获取洛杉矶当前日期
-    la_tz = pytz.timezone('America/Los_Angeles')
-    
+
     if date_str:
         # 如果提供了日期参数，使用指定日期
         try:
             request_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         except ValueError:
-            if 'conn' in locals(): conn.close()
             return jsonify({"error": "日期格式无效，请使用YYYY-MM-DD格式"}), 400
     else:
-        # 如果没有提供日期参数，自动判断业务日期（05:00为界）
-        now_la = datetime.now(la_tz)
-        if now_la.hour < 5:
-            # 凌晨0-5点属于前一天
-            request_date = now_la.date() - timedelta(days=1)
-        else:
-            request_date = now_la.date()
-    
-    # 计算次日日期
-    next_date = request_date + timedelta(days=1)
-    
-    # 构建日期范围查询条件（使用洛杉矶时区时间进行计算）
-    # 当天05:00:00的时间（洛杉矶时间）
-    request_date_5am_la = la_tz.localize(datetime.combine(request_date, datetime.min.time().replace(hour=5)))
-    
-    # 次日05:00:00的时间（洛杉矶时间，用于上限）
-    next_date_5am_la = la_tz.localize(datetime.combine(next_date, datetime.min.time().replace(hour=5)))
-    
-    # 转换为系统本地时间用于数据库查询
-    today_start = request_date_5am_la.astimezone()
-    next_day_start = next_date_5am_la.astimezone()
-    
-    # 查询属于指定自然日的记录（查询当天05:00之后到次日05:00之前的所有记录）
-    records_query = """
-        SELECT id, created_at, vehicle_type, time_slot FROM inbound_records 
-        WHERE 
-            created_at >= ? AND created_at < ?
-    """
-    records_cur = conn.cursor(); records_cur.execute(records_query, (
-        today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-        next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-    ))
-    records = records_cur.fetchall()
-    
-    # 总车次和总货物量（查询当天00:00之后到次日00:00之前的所有记录）
-    # 特殊规则: 53英尺车牌号为G的车辆,货量不计入总计,但车次计入
-    total_query = """
-        SELECT COUNT(*) as total_vehicles, 
-               SUM(CASE 
-                   WHEN vehicle_type = '53英尺' AND vehicle_no = 'G' THEN 0 
-                   ELSE pieces 
-               END) as total_pieces 
-        FROM inbound_records 
-        WHERE 
-            created_at >= ? AND created_at < ?
-    """
-    total_cur = conn.cursor(); total_cur.execute(total_query, (
-        today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-        next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-    ))
-    total_result = total_cur.fetchone()
-    total_vehicles = (total_result['total_vehicles'] if USE_POSTGRES else total_result[0]) if total_result else 0
-    # 注意: SQLite 中 SUM 可能返回 None, PostgreSQL 也可能
-    total_pieces_val = total_result['total_pieces'] if USE_POSTGRES else total_result[1]
-    total_pieces = int(total_pieces_val) if total_pieces_val else 0
-    
-    # 托盘总数（查询当天00:00之后到次日00:00之前，车辆类型为26英尺或53英尺的装载量总和）
-    # 特殊规则: 53英尺车牌号为G的车辆,装载量不计入
-    pallet_query = """
-        SELECT SUM(load_amount) as total_pallets
-        FROM inbound_records 
-        WHERE 
-            created_at >= ? AND created_at < ? 
-            AND (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
-            AND NOT (vehicle_type = '53英尺' AND vehicle_no = 'G')
-    """
-    pallet_cur = conn.cursor(); pallet_cur.execute(pallet_query, (
-        today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-        next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-    ))
-    pallet_result = pallet_cur.fetchone()
-    pallet_val = pallet_result['total_pallets'] if USE_POSTGRES else pallet_result[0]
-    total_pallets = int(pallet_val) if pallet_val else 0
-    
-    # 各车型统计（查询当天00:00之后到次日00:00之前的所有记录）
-    # 特殊规则: 53英尺车牌号为G的车辆,车次计入但货量不计入
-    vehicle_stats_query = """
-        SELECT vehicle_type, 
-               COUNT(*) as count, 
-               SUM(CASE 
-                   WHEN vehicle_type = '53英尺' AND vehicle_no = 'G' THEN 0 
-                   ELSE pieces 
-               END) as total_pieces 
-        FROM inbound_records 
-        WHERE 
-            created_at >= ? AND created_at < ?
-        GROUP BY vehicle_type
-    """
-    vehicle_stats_cur = conn.cursor(); vehicle_stats_cur.execute(vehicle_stats_query, (
-        today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-        next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-    ))
-    vehicle_stats = [{
-        "vehicle_type": r[0],
-        "count": r[1],
-        "total_pieces": int(r[2]) if r[2] else 0
-    } for r in vehicle_stats_cur.fetchall()]
-    
-    # 初始化统计变量
-    vehicles_19_to_20 = 0
-    # 统计19:00-20:00时间段各车型到车数量
-    vehicles_19_to_20_by_type = {}
-    
-    # 统计20:00-21:00时间段记录
-    vehicles_20_to_21 = 0
-    # 统计20:00-21:00时间段各车型到车数量
-    vehicles_20_to_21_by_type = {}
-    
-    # 统计超过24:00的记录（即次日00:00之后的记录）
-    vehicles_after_24 = 0
-    
-    # 处理每条记录，用于统计特定时间段的数据（按录入的时间段time_slot统计）
-    for record in records:
-        record_id, created_at_str, vehicle_type, time_slot = record
-        # 基于录入的时间段进行统计
-        if time_slot:
-            try:
-                time_slot_int = int(time_slot)
-                # 检查是否在19:00-20:00之间（录入的时间段为19）
-                if time_slot_int == 19:
-                    vehicles_19_to_20 += 1
-                    
-                    # 统计19:00-20:00时间段各车型到车数量
-                    if vehicle_type not in vehicles_19_to_20_by_type:
-                        vehicles_19_to_20_by_type[vehicle_type] = 0
-                    vehicles_19_to_20_by_type[vehicle_type] += 1
-                
-                # 检查是否在20:00-21:00之间（录入的时间段为20）
-                if time_slot_int == 20:
-                    vehicles_20_to_21 += 1
-                    
-                    # 统计20:00-21:00时间段各车型到车数量
-                    if vehicle_type not in vehicles_20_to_21_by_type:
-                        vehicles_20_to_21_by_type[vehicle_type] = 0
-                    vehicles_20_to_21_by_type[vehicle_type] += 1
-                
-                # 检查是否是超过24:00的记录（录入的时间段为24或更大）
-                if time_slot_int >= 24:
-                    vehicles_after_24 += 1
-            except ValueError:
-                # 如果time_slot不是有效的整数，跳过这条记录
-                pass
-        else:
-            # 如果没有录入时间段，仍然使用原来基于创建时间的逻辑作为后备
-            if created_at_str:
-                try:
-                    # 将UTC时间字符串转换为datetime对象
-                    if isinstance(created_at_str, str):
-                        utc_time = datetime.strptime(created_at_str, '%Y-%m-%d %H:%M:%S')
-                    else:
-                        utc_time = created_at_str
-                    utc_time = pytz.utc.localize(utc_time)
-                    # 转换为系统本地时间（修改这里）
-                    local_time = utc_time.astimezone()
-                    
-                    # 检查是否在19:00-20:00之间（系统本地时间）
-                    if local_time.hour == 19:
-                        vehicles_19_to_20 += 1
-                        
-                        # 统计19:00-20:00时间段各车型到车数量
-                        if vehicle_type not in vehicles_19_to_20_by_type:
-                            vehicles_19_to_20_by_type[vehicle_type] = 0
-                        vehicles_19_to_20_by_type[vehicle_type] += 1
-                    
-                    # 检查是否在20:00-21:00之间（系统本地时间）
-                    if local_time.hour == 20:
-                        vehicles_20_to_21 += 1
-                        
-                        # 统计20:00-21:00时间段各车型到车数量
-                        if vehicle_type not in vehicles_20_to_21_by_type:
-                            vehicles_20_to_21_by_type[vehicle_type] = 0
-                        vehicles_20_to_21_by_type[vehicle_type] += 1
-                    
-                    # 检查是否是明天的记录（即次日00:00之后的记录）
-                    if local_time.date() > request_date:
-                        vehicles_after_24 += 1
-                except Exception as e:
-                    print(f"处理记录 {record_id} 的时间时出错: {e}")
-    
-    
-    # === 计算趋势数据 (环比昨天) ===
-    # 计算昨天的日期范围
-    prev_date = request_date - timedelta(days=1)
-    prev_next_date = prev_date + timedelta(days=1)
-    
-    prev_date_5am_la = la_tz.localize(datetime.combine(prev_date, datetime.min.time().replace(hour=5)))
-    prev_next_date_5am_la = la_tz.localize(datetime.combine(prev_next_date, datetime.min.time().replace(hour=5)))
-    
-    prev_start = prev_date_5am_la.astimezone()
-    prev_end = prev_next_date_5am_la.astimezone()
-    
-    # 查询昨天的总车次和货量
-    trend_query = """
-        SELECT COUNT(*) as total_vehicles, 
-               SUM(CASE 
-                   WHEN vehicle_type = '53英尺' AND vehicle_no = 'G' THEN 0 
-                   ELSE pieces 
-               END) as total_pieces 
-        FROM inbound_records 
-        WHERE 
-            created_at >= ? AND created_at < ?
-    """
-    trend_cur = conn.cursor(); trend_cur.execute(trend_query, (
-        prev_start.strftime('%Y-%m-%d %H:%M:%S'), 
-        prev_end.strftime('%Y-%m-%d %H:%M:%S')
-    ))
-    trend_result = trend_cur.fetchone()
-    
-    prev_vehicles = (trend_result['total_vehicles'] if USE_POSTGRES else trend_result[0]) if trend_result else 0
-    prev_pieces_val = trend_result['total_pieces'] if USE_POSTGRES else trend_result[1]
-    prev_pieces = int(prev_pieces_val) if prev_pieces_val else 0
-
-    # [新增] 查询昨天的托盘总数
-    trend_pallet_query = """
-        SELECT SUM(load_amount) as total_pallets
-        FROM inbound_records 
-        WHERE 
-            created_at >= ? AND created_at < ? 
-            AND (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
-            AND NOT (vehicle_type = '53英尺' AND vehicle_no = 'G')
-    """
-    trend_pallet_cur = conn.cursor(); trend_pallet_cur.execute(trend_pallet_query, (
-        prev_start.strftime('%Y-%m-%d %H:%M:%S'), 
-        prev_end.strftime('%Y-%m-%d %H:%M:%S')
-    ))
-    trend_pallet_result = trend_pallet_cur.fetchone()
-    prev_pallets_val = trend_pallet_result['total_pallets'] if USE_POSTGRES else trend_pallet_result[0]
-    prev_pallets = int(prev_pallets_val) if prev_pallets_val else 0
-
-    # [新增] 查询昨天的晚班数据 (用于计算晚班趋势)
-    trend_records_query = """
-        SELECT id, created_at, vehicle_type, time_slot FROM inbound_records 
-        WHERE 
-            created_at >= ? AND created_at < ?
-    """
-    trend_records_cur = conn.cursor(); trend_records_cur.execute(trend_records_query, (
-        prev_start.strftime('%Y-%m-%d %H:%M:%S'), 
-        prev_end.strftime('%Y-%m-%d %H:%M:%S')
-    ))
-    prev_records = trend_records_cur.fetchall()
-
-    prev_night_shift_total = 0
-    prev_vehicles_19_to_20 = 0
-    prev_vehicles_20_to_21 = 0
-    prev_vehicles_after_24 = 0
-
-    for record in prev_records:
-        record_id, created_at_str, vehicle_type, time_slot = record
-        if time_slot:
-            try:
-                time_slot_int = int(time_slot)
-                if time_slot_int == 19:
-                    prev_vehicles_19_to_20 += 1
-                    prev_night_shift_total += 1
-                elif time_slot_int == 20:
-                    prev_vehicles_20_to_21 += 1
-                    prev_night_shift_total += 1
-                elif time_slot_int >= 24:
-                    prev_vehicles_after_24 += 1
-                    prev_night_shift_total += 1
-            except ValueError:
-                pass
-        else:
-            # 后备逻辑
-            if created_at_str:
-                try:
-                    if isinstance(created_at_str, str):
-                        utc_time = datetime.strptime(created_at_str, '%Y-%m-%d %H:%M:%S')
-                    else:
-                        utc_time = created_at_str
-                    utc_time = pytz.utc.localize(utc_time)
-                    local_time = utc_time.astimezone()
-                    
-                    if local_time.date() > prev_date: # 次日00:00以后
-                         prev_vehicles_after_24 += 1
-                         prev_night_shift_total += 1
-                    elif local_time.hour == 19:
-                         prev_vehicles_19_to_20 += 1
-                         prev_night_shift_total += 1
-                    elif local_time.hour == 20:
-                         prev_vehicles_20_to_21 += 1
-                         prev_night_shift_total += 1
-                except:
-                    pass
-    
-    # 计算增长率
-    def calculate_trend(current, previous):
-        if previous == 0:
-            return 100 if current > 0 else 0
-        return ((current - previous) / previous) * 100
+        # 如果没有提供日期参数，使用当前业务日（05:00为界，凌晨0-5点属于前一天）
+        request_date = business_days.current_business_date()
 
-    pieces_trend = calculate_trend(total_pieces, prev_pieces)
-    vehicles_trend = calculate_trend(total_vehicles, prev_vehicles)
-    pallets_trend = calculate_trend(total_pallets, prev_pallets)
+    conn = get_db()
+    try:
+        stats = compute_business_day_stats(conn, request_date)
+    finally:
+        conn.close()
 
-    # 计算今日晚班总数
-    today_night_shift_total = vehicles_19_to_20 + vehicles_20_to_21 + vehicles_after_24
-    night_shift_trend = calculate_trend(today_night_shift_total, prev_night_shift_total)
-    
-    # 计算各时段趋势
-    vehicles_19_to_20_trend = calculate_trend(vehicles_19_to_20, prev_vehicles_19_to_20)
-    vehicles_20_to_21_trend = calculate_trend(vehicles_20_to_21, prev_vehicles_20_to_21)
-    vehicles_after_24_trend = calculate_trend(vehicles_after_24, prev_vehicles_after_24)
-    
-    conn.close()
-    
-    return jsonify({
-        "total_vehicles": total_vehicles,
-        "total_pieces": total_pieces,
-        "total_pallets": total_pallets,
-        "vehicle_stats": vehicle_stats,
-        "vehicles_19_to_20": vehicles_19_to_20,
-        "vehicles_19_to_20_by_type": vehicles_19_to_20_by_type,
-        "vehicles_20_to_21": vehicles_20_to_21,
-        "vehicles_20_to_21_by_type": vehicles_20_to_21_by_type,
-        "vehicles_after_24": vehicles_after_24,
-        # 趋势数据
-        "pieces_trend": round(pieces_trend, 1),
-        "vehicles_trend": round(vehicles_trend, 1),
-        "pallets_trend": round(pallets_trend, 1),
-        "night_shift_trend": round(night_shift_trend, 1),
-        "vehicles_19_to_20_trend": round(vehicles_19_to_20_trend, 1),
-        "vehicles_20_to_21_trend": round(vehicles_20_to_21_trend, 1),
-        "vehicles_after_24_trend": round(vehicles_after_24_trend, 1),
-        "prev_pieces": prev_pieces,
-        "prev_vehicles": prev_vehicles
-    })
+    return jsonify(stats)
 
 @app.route('/api/daily_trend')
+@cached_response()
 def get_daily_trend():
     """获取每日货物趋势数据（显示所有有记录的日期）"""
     try:
         conn = get_db()
         
-        # 查询数据库中所有有记录的日期（按日期分组）
-        # 使用DATE函数提取日期部分
-        dates_query = """
-            SELECT DISTINCT DATE(created_at) as record_date
-            FROM inbound_records
-            ORDER BY record_date ASC
-        """
-        cursor = conn.cursor(); cursor.execute(dates_query)
-        # 兼容处理：确保转换为字符串
-        raw_dates = [row[0] for row in cursor.fetchall()]
-        record_dates = []
-        for d in raw_dates:
-            if isinstance(d, (datetime, date)):
-                record_dates.append(d.strftime('%Y-%m-%d'))
-            else:
-                record_dates.append(str(d))
+        # 从每日汇总表一次查询所有业务日的货物总量、车次总数和托盘总数
+        cursor = conn.cursor(); cursor.execute("""
+            SELECT business_date, SUM(pieces), SUM(vehicles), SUM(pallets)
+            FROM daily_rollups
+            GROUP BY business_date
+            ORDER BY business_date ASC
+        """)
+        daily_rows = cursor.fetchall()
+        conn.close()
         
         # 如果没有记录，返回空数组
-        if not record_dates:
-            conn.close()
+        if not daily_rows:
             return jsonify([])
         
         # 美国联邦假期（2025-2026年）
@@ -2242,36 +2555,14 @@ def get_daily_trend():
         # 准备结果数组
         result = []
         
-        # 为每个有记录的日期查询数据
-        for date_str in record_dates:
+        for row in daily_rows:
+            # 兼容处理：PostgreSQL 返回 date 对象, SQLite 返回字符串
+            date_str = row[0].strftime('%Y-%m-%d') if isinstance(row[0], (datetime, date)) else str(row[0])
             target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-            next_date = target_date + timedelta(days=1)
-            
-            # 构建日期范围查询条件
-            day_start = datetime.combine(target_date, datetime.min.time())
-            day_end = datetime.combine(next_date, datetime.min.time())
-            
-            # 查询当天的货物总量、车次总数和托盘总数
-            query = """
-                SELECT 
-                    SUM(pieces) as total_pieces,
-                    COUNT(*) as total_vehicles,
-                    SUM(CASE 
-                        WHEN vehicle_type IN ('26英尺', '53英尺') THEN load_amount 
-                        ELSE 0 
-                    END) as total_pallets
-                FROM inbound_records
-                WHERE created_at >= ? AND created_at < ?
-            """
-            cursor = conn.cursor(); cursor.execute(query, (
-                day_start.strftime('%Y-%m-%d %H:%M:%S'),
-                day_end.strftime('%Y-%m-%d %H:%M:%S')
-            ))
-            row = cursor.fetchone()
             # 直接使用实际数值，不取整
-            total_pieces = int(row[0]) if row[0] else 0
-            total_vehicles = int(row[1]) if row[1] else 0
-            total_pallets = int(row[2]) if row[2] else 0
+            total_pieces = int(row[1]) if row[1] else 0
+            total_vehicles = int(row[2]) if row[2] else 0
+            total_pallets = int(row[3]) if row[3] else 0
             
             # 获取星期几 (0=Monday, 6=Sunday)
             weekday = target_date.weekday()
@@ -2292,7 +2583,6 @@ def get_daily_trend():
                 'total_pallets': total_pallets
             })
         
-        conn.close()
         return jsonify(result)
     
     except Exception as e:
@@ -2303,92 +2593,91 @@ def get_daily_trend():
 
 
 @app.route('/api/week_comparison')
+@cached_response()
 def get_week_comparison():
-    """获取所有周的对比数据，包含每周内每天的详细数据（使用自然周：周一00:00到周日23:59）"""
+    """
+    获取周对比数据，包含每周内每天的详细数据（使用自然周：周一到周日）
+    
+    可选参数:
+    - start / end: YYYY-MM-DD，只返回覆盖该日期范围的周
+    - weeks: 只返回最近 N 周（截止到 end，默认今天）
+    不传参数时返回全部历史（第一周不完整时过滤掉）
+    """
+    start_str = request.args.get('start')
+    end_str = request.args.get('end')
+    weeks_str = request.args.get('weeks')
     try:
-        conn = get_db()
-        
-        # 1. 获取最小日期（第一条记录的时间）
-        query = "SELECT MIN(created_at) FROM inbound_records"
-        cursor = conn.cursor(); cursor.execute(query)
-        min_res = cursor.fetchone()
-        min_str = (min_res['min'] if USE_POSTGRES else min_res[0]) if min_res else None
-        
-        if not min_str:
-            conn.close()
+        start_date = datetime.strptime(start_str, '%Y-%m-%d').date() if start_str else None
+        end_date = datetime.strptime(end_str, '%Y-%m-%d').date() if end_str else None
+    except ValueError:
+        return jsonify({"error": "日期格式无效，请使用YYYY-MM-DD格式"}), 400
+    try:
+        weeks_limit = int(weeks_str) if weeks_str else None
+    except ValueError:
+        return jsonify({"error": "weeks 参数必须是正整数"}), 400
+    if weeks_limit is not None and weeks_limit <= 0:
+        return jsonify({"error": "weeks 参数必须是正整数"}), 400
+    
+    # 辅助函数：获取自然周的周一
+    def get_week_monday(day):
+        return day - timedelta(days=day.weekday())  # weekday() 返回0-6，0是周一
+    
+    # 设置最大日期（默认今天，确保显示到本周）
+    max_date = end_date or datetime.now(LA_TZ).date()
+    if weeks_limit:
+        week_start_limit = get_week_monday(max_date) - timedelta(days=7 * (weeks_limit - 1))
+        start_date = max(start_date, week_start_limit) if start_date else week_start_limit
+    range_requested = start_date is not None
+    
+    try:
+        # 1. 一次分组查询读取范围内所有业务日的车次和货量
+        #    指定了起始日期时多取一周，用于计算第一周的环比
+        query = "SELECT business_date, SUM(vehicles), SUM(pieces) FROM daily_rollups"
+        params = []
+        if range_requested:
+            query += " WHERE business_date >= ?"
+            params.append((get_week_monday(start_date) - timedelta(days=7)).strftime('%Y-%m-%d'))
+            if end_date:
+                query += " AND business_date <= ?"
+                params.append((get_week_monday(end_date) + timedelta(days=6)).strftime('%Y-%m-%d'))
+        elif end_date:
+            query += " WHERE business_date <= ?"
+            params.append((get_week_monday(end_date) + timedelta(days=6)).strftime('%Y-%m-%d'))
+        query += " GROUP BY business_date"
+        
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+        
+        daily_totals = {}
+        for row in rows:
+            day_key = row[0].strftime('%Y-%m-%d') if isinstance(row[0], (datetime, date)) else str(row[0])
+            daily_totals[day_key] = (int(row[1]) if row[1] else 0, int(row[2]) if row[2] else 0)
+        
+        if range_requested:
+            min_date = get_week_monday(start_date) - timedelta(days=7)
+        elif daily_totals:
+            # 最小日期（第一条记录所属的业务日）
+            min_date = datetime.strptime(min(daily_totals), '%Y-%m-%d').date()
+        else:
             return jsonify([])  # 没有数据
-            
-        # 解析最小日期
-        try:
-            if hasattr(min_str, 'date'): # 检查是否为 datetime/date 对象
-                min_date = min_str.date() if hasattr(min_str, 'date') and callable(min_str.date) else min_str
-                # 如果是 datetime 对象，它有 date() 方法；如果是 date 对象，它就是 date
-                if isinstance(min_date, datetime):
-                     min_date = min_date.date()
-            else:
-                # 字符串处理
-                min_date = datetime.strptime(str(min_str).split(' ')[0], '%Y-%m-%d').date()
-        except Exception as e:
-            print(f"解析最小日期出错: {e}, 使用当前日期")
-            min_date = datetime.now(LA_TZ).date()
-            
-        # 设置最大日期为今天（确保显示到本周）
-        max_date = datetime.now(LA_TZ).date()
-        
-        # 辅助函数：获取自然周的起止日期
-        def get_natural_week_range(date):
-            """获取自然周的起止时间（周一到周日）"""
-            # weekday() 返回0-6，0是周一
-            weekday = date.weekday()
-            week_start = date - timedelta(days=weekday)
-            week_end = week_start + timedelta(days=6)
-            return week_start, week_end
-            
-        # 对齐最小日期到该周的周一
-        current_start, current_end = get_natural_week_range(min_date)
         
+        # 2. 在内存中按周组装，计算环比
         weeks_data = []
-        
-        # 循环直到包含当前日期
+        current_start = get_week_monday(min_date)
         while current_start <= max_date:
-            # 查询该周每一天的数据
+            current_end = current_start + timedelta(days=6)
             daily_data = []
             week_total_pieces = 0
             week_total_vehicles = 0
             
-            # 循环7天（周一到周日）
+            # 循环7天（周一到周日），没有记录的日期为 0
             for day_offset in range(7):
                 current_day = current_start + timedelta(days=day_offset)
-                next_day = current_day + timedelta(days=1)
-                
-                # 构造当天的日期时间范围 (00:00:00 到 23:59:59.999999)
-                day_start_dt = datetime.combine(current_day, datetime.min.time())
-                day_end_dt = datetime.combine(next_day, datetime.min.time())
-                
-                # 查询当天数据
-                day_query = """
-                    SELECT 
-                        COUNT(*) as vehicle_count,
-                        SUM(pieces) as total_pieces
-                    FROM inbound_records
-                    WHERE created_at >= ? AND created_at < ?
-                """
-                
-                cursor = conn.cursor(); cursor.execute(day_query, (
-                    day_start_dt.strftime('%Y-%m-%d %H:%M:%S'),
-                    day_end_dt.strftime('%Y-%m-%d %H:%M:%S')
-                ))
-                
-                row = cursor.fetchone()
-                day_vehicles = row[0] if row[0] else 0
-                # 直接使用实际数值，不取整
-                day_pieces = int(row[1]) if row[1] else 0
-                
-                # 累加到周总计
+                day_vehicles, day_pieces = daily_totals.get(current_day.strftime('%Y-%m-%d'), (0, 0))
                 week_total_vehicles += day_vehicles
                 week_total_pieces += day_pieces
-                
-                # 添加到每日数据数组
                 daily_data.append({
                     'date': current_day.strftime('%Y-%m-%d'),
                     'weekday': current_day.weekday(),  # 0=周一, 6=周日
@@ -2399,11 +2688,9 @@ def get_week_comparison():
             # 计算环比（如果不是第一周）
             pieces_change_percent = 0
             vehicles_change_percent = 0
-            
             if weeks_data:
-                last_week = weeks_data[-1]
-                last_pieces = last_week['week_total_pieces']
-                last_vehicles = last_week['week_total_vehicles']
+                last_pieces = weeks_data[-1]['week_total_pieces']
+                last_vehicles = weeks_data[-1]['week_total_vehicles']
                 
                 if last_pieces > 0:
                     pieces_change_percent = ((week_total_pieces - last_pieces) / last_pieces) * 100
@@ -2428,31 +2715,25 @@ def get_week_comparison():
             
             # 移动到下一周
             current_start = current_start + timedelta(days=7)
-            current_end = current_end + timedelta(days=7)
-            
-        conn.close()
+        
+        if range_requested:
+            # 去掉只用于计算环比的前一周
+            return jsonify(weeks_data[1:])
         
         # 过滤掉第一周（如果不完整）
         # 判断标准：如果第一周的起始日期早于数据库中的最小日期，说明这周是不完整的
-        if weeks_data and len(weeks_data) > 0:
-            first_week = weeks_data[0]
-            first_week_start = datetime.strptime(first_week['start_date'], '%Y-%m-%d').date()
-            
-            # 如果第一周的周一早于数据库最小日期，说明第一周不完整
-            if first_week_start < min_date:
-                print(f"过滤掉不完整的第一周: {first_week['week_label']}")
-                weeks_data = weeks_data[1:]  # 移除第一周
+        if weeks_data and datetime.strptime(weeks_data[0]['start_date'], '%Y-%m-%d').date() < min_date:
+            log.debug("过滤掉不完整的第一周: %s", weeks_data[0]['week_label'])
+            weeks_data = weeks_data[1:]
         
         # [Option A] 将显示的第一个周的环比设为 0%
-        if weeks_data and len(weeks_data) > 0:
+        if weeks_data:
             weeks_data[0]['pieces_change_percent'] = 0
             weeks_data[0]['vehicles_change_percent'] = 0
         
         return jsonify(weeks_data)
     
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         return jsonify({'error': f'获取周环比数据出错: {str(e)}'}), 500
 
 
@@ -2473,73 +2754,54 @@ def export_csv():
         # 解析请求的日期
         request_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         
-        # 计算次日日期
-        next_date = request_date + timedelta(days=1)
-        
-        # 构建日期范围查询条件（使用自然日而不是洛杉矶时区时间）
-        # 当天00:00:00的时间（系统时间）
-        today_start = datetime.combine(request_date, datetime.min.time())
-        
-        # 次日00:00:00的时间（系统时间，用于上限）
-        next_day_start = datetime.combine(next_date, datetime.min.time())
+        # 按业务日查询（与 /api/stats 口径一致：当天05:00到次日05:00）
+        day_params = (request_date.strftime('%Y-%m-%d'),)
         
-        # 总车次和总货物量（查询当天00:00之后到次日00:00之前的所有记录）
+        # 总车次和总货物量
         total_query = """
             SELECT COUNT(*) as total_vehicles, SUM(pieces) as total_pieces 
             FROM inbound_records 
             WHERE 
-                created_at >= ? AND created_at < ?
+                business_date = ?
         """
-        total_cur = conn.cursor(); total_cur.execute(total_query, (
-            today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        total_cur = conn.cursor(); total_cur.execute(total_query, day_params)
         total_result = total_cur.fetchone()
         total_vehicles = total_result[0] if total_result[0] else 0
         total_pieces = int(total_result[1]) if total_result[1] else 0
         
-        # 托盘总数（查询当天00:00之后到次日00:00之前，车辆类型为26英尺或53英尺的装载量总和）
+        # 托盘总数（车辆类型为26英尺或53英尺的装载量总和）
         pallet_query = """
             SELECT SUM(load_amount) as total_pallets
             FROM inbound_records 
             WHERE 
-                created_at >= ? AND created_at < ? AND (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
+                business_date = ? AND (vehicle_type = '26英尺' OR vehicle_type = '53英尺')
         """
-        pallet_cur = conn.cursor(); pallet_cur.execute(pallet_query, (
-            today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        pallet_cur = conn.cursor(); pallet_cur.execute(pallet_query, day_params)
         pallet_result = pallet_cur.fetchone()
         total_pallets = int(pallet_result[0]) if pallet_result[0] else 0
         
-        # 各车型统计（查询当天00:00之后到次日00:00之前的所有记录）
+        # 各车型统计
         vehicle_stats_query = """
             SELECT vehicle_type, COUNT(*) as count, SUM(pieces) as total_pieces 
             FROM inbound_records 
             WHERE 
-                created_at >= ? AND created_at < ?
+                business_date = ?
             GROUP BY vehicle_type
         """
-        vehicle_stats_cur = conn.cursor(); vehicle_stats_cur.execute(vehicle_stats_query, (
-            today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        vehicle_stats_cur = conn.cursor(); vehicle_stats_cur.execute(vehicle_stats_query, day_params)
         vehicle_stats = [{
             "vehicle_type": r[0],
             "count": r[1],
             "total_pieces": int(r[2]) if r[2] else 0
         } for r in vehicle_stats_cur.fetchall()]
         
-        # 查询属于指定自然日的记录（查询当天00:00之后到次日00:00之前的所有记录）
+        # 查询属于指定业务日的记录
         records_query = """
             SELECT id, created_at, vehicle_type, time_slot FROM inbound_records 
             WHERE 
-                created_at >= ? AND created_at < ?
+                business_date = ?
         """
-        records_cur = conn.cursor(); records_cur.execute(records_query, (
-            today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        records_cur = conn.cursor(); records_cur.execute(records_query, day_params)
         records = records_cur.fetchall()
         
         # 初始化统计变量
@@ -2589,7 +2851,7 @@ def export_csv():
                         if local_time.date() > request_date:
                             vehicles_after_24 += 1
                     except Exception as e:
-                        print(f"处理记录 {record_id} 的时间时出错: {e}")
+                        log.warning("处理记录 %s 的时间时出错: %s", record_id, e)
         
         conn.close()
         
@@ -2640,9 +2902,7 @@ def export_csv():
         return response
         
     except Exception as e:
-        print(f"导出CSV文件出错: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("导出CSV文件出错")
         return jsonify({"error": f"导出失败: {str(e)}"}), 500
 
 @app.route('/api/export_excel')
@@ -2655,280 +2915,139 @@ def export_excel():
             # 获取系统当前日期（使用洛杉矶时间）
             date_str = datetime.now(LA_TZ).strftime('%Y-%m-%d')
         
-        conn = get_db()
-        
         # 解析请求的日期
         request_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         
-        # 计算次日日期
-        next_date = request_date + timedelta(days=1)
-        
-        # 构建日期范围查询条件（使用自然日而不是洛杉矶时区时间）
-        # 当天00:00:00的时间（系统时间）
-        today_start = datetime.combine(request_date, datetime.min.time())
-        
-        # 次日00:00:00的时间（系统时间，用于上限）
-        next_day_start = datetime.combine(next_date, datetime.min.time())
-        
-        # 查询指定日期的入库记录（查询当天00:00之后到次日00:00之前的所有记录）
-        inbound_query = """
-            SELECT id, dock_no, vehicle_type, vehicle_no, unit, load_amount,
-                   pieces, time_slot, shift_type, remark, created_at, duration
-            FROM inbound_records 
-            WHERE 
-                created_at >= ? AND created_at < ?
-            ORDER BY created_at DESC
-        """
-        inbound_cur = conn.cursor(); inbound_cur.execute(inbound_query, (
-            today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-        ))
-        inbound_rows = [{
-            "id": r[0], "dock_no": r[1], "vehicle_type": r[2], "vehicle_no": r[3],
-            "unit": r[4], "load_amount": r[5], "pieces": r[6],
-            "time_slot": r[7], "shift_type": r[8], "remark": r[9],
-            "created_at": r[10],  # 数据库中存储的是系统时间，直接返回
-            "duration": r[11]  # 时长(分钟)
-        } for r in inbound_cur.fetchall()]
-        
-        # 查询指定日期的分拣记录（按照自然日逻辑查询，查询当天00:00之后到次日00:00之前的所有记录）
-        sorting_query = """
-            SELECT id, sorting_time, pieces, remark, created_at, time_slot
-            FROM sorting_records 
-            WHERE 
-                created_at >= ? AND created_at < ?
-            ORDER BY created_at DESC
-        """
-        sorting_cur = conn.cursor(); sorting_cur.execute(sorting_query, (
-            today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-            next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-        ))
-        sorting_rows = [{
-            "id": r[0], "sorting_time": r[1], "pieces": r[2], "remark": r[3],
-            "created_at": r[4], "time_slot": r[5]
-        } for r in sorting_cur.fetchall()]
-        
-        conn.close()
-        
-        # 创建Excel工作簿
-        wb = Workbook()
-        
-        # 创建入库记录工作表
-        ws1 = wb.active
-        ws1.title = "入库记录"
-        
-        # 添加表头
-        inbound_headers = ['ID', '码头号', '车辆类型', '车牌号', '单位', '装载量', '件数', '时间段', '班次类型', '备注', '创建时间', '时长(分钟)']
-        ws1.append(inbound_headers)
-        
-        # 设置表头样式
-        header_font = Font(bold=True)
-        header_fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-        for col in range(1, len(inbound_headers) + 1):
-            cell = ws1.cell(row=1, column=col)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center")
-        
-        # 添加入库数据
-        for row_dict in inbound_rows:
-            # 按照表头顺序构造行数据
-            row_data = [
-                row_dict["id"], row_dict["dock_no"], row_dict["vehicle_type"], row_dict["vehicle_no"],
-                row_dict["unit"], row_dict["load_amount"], row_dict["pieces"],
-                row_dict["time_slot"], row_dict["shift_type"], row_dict["remark"], row_dict["created_at"],
-                row_dict.get("duration", "")  # 时长(分钟),如果没有则为空
-            ]
-            ws1.append(row_data)
-        
-        # 调整列宽
-        for column in ws1.columns:
-            max_length = 0
-            column_letter = get_column_letter(column[0].column)
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws1.column_dimensions[column_letter].width = min(adjusted_width, 50)
-        
-        # 创建分拣记录工作表（只有在有数据时才创建）
-        if sorting_rows:
-            ws2 = wb.create_sheet("分拣记录")
-            
-            # 添加表头
-            sorting_headers = ['ID', '分拣日期', '件数', '时间段', '备注', '创建时间']
-            ws2.append(sorting_headers)
-            
-            # 设置表头样式
-            for col in range(1, len(sorting_headers) + 1):
-                cell = ws2.cell(row=1, column=col)
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.alignment = Alignment(horizontal="center")
-            
-            # 添加分拣数据
-            for row_dict in sorting_rows:
-                # 按照表头顺序构造行数据
-                row_data = [
-                    row_dict["id"], row_dict["sorting_time"], row_dict["pieces"],
-                    row_dict["time_slot"], row_dict["remark"], row_dict["created_at"]
-                ]
-                ws2.append(row_data)
-            
-            # 调整列宽
-            for column in ws2.columns:
-                max_length = 0
-                column_letter = get_column_letter(column[0].column)
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                ws2.column_dimensions[column_letter].width = min(adjusted_width, 50)
-        
-        # 保存Excel文件
-        filename = f"inbound_stats_{date_str}.xlsx"  # 使用英文文件名避免编码问题
-        filepath = os.path.join(os.path.dirname(__file__), filename)
-        wb.save(filepath)
-        
-        # 返回Excel文件，使用更直接的方法避免文件名编码问题
-        from flask import Response
-        import os
-        
-        # 读取文件内容
-        with open(filepath, 'rb') as f:
-            file_content = f.read()
+        # 按业务日查询（与 /api/stats 口径一致：当天05:00到次日05:00）
+        day_params = (request_date.strftime('%Y-%m-%d'),)
+        
+        with get_db_connection() as conn:
+            # 查询指定业务日的入库记录
+            inbound_cur = conn.cursor()
+            inbound_cur.execute("""
+                SELECT id, dock_no, vehicle_type, vehicle_no, unit, load_amount,
+                       pieces, time_slot, shift_type, remark, created_at, duration
+                FROM inbound_records 
+                WHERE 
+                    business_date = ?
+                ORDER BY created_at DESC
+            """, day_params)
+            inbound_rows = exports.SpooledRows(
+                ['ID', '码头号', '车辆类型', '车牌号', '单位', '装载量', '件数', '时间段', '班次类型', '备注', '创建时间', '时长(分钟)']
+            ).extend(exports.iter_cursor(inbound_cur))
+            
+            # 查询指定业务日录入的分拣记录
+            sorting_cur = conn.cursor()
+            sorting_cur.execute("""
+                SELECT id, sorting_time, pieces, time_slot, remark, created_at
+                FROM sorting_records 
+                WHERE 
+                    business_date = ?
+                ORDER BY created_at DESC
+            """, day_params)
+            sorting_rows = exports.SpooledRows(
+                ['ID', '分拣日期', '件数', '时间段', '备注', '创建时间']
+            ).extend(exports.iter_cursor(sorting_cur))
+        
+        sheets = [("入库记录", inbound_rows)]
+        # 分拣记录工作表只有在有数据时才创建
+        if sorting_rows.count:
+            sheets.append(("分拣记录", sorting_rows))
+        else:
+            sorting_rows.close()
         
-        # 创建响应对象，明确设置Content-Type和Content-Disposition
-        response = Response(
-            file_content,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={
-                'Content-Disposition': f'attachment; filename="{filename}"'
-            }
-        )
-        return response
+        output, size = exports.build_workbook(sheets)
+        # 使用英文文件名避免编码问题
+        return exports.stream_file_response(output, size, f"inbound_stats_{date_str}.xlsx")
         
     except Exception as e:
-        print(f"导出Excel文件出错: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("导出Excel文件出错")
         return jsonify({"error": f"导出失败: {str(e)}"}), 500
 
 # 新增API：导出最近记录
 @app.route('/api/export_recent_records')
 def export_recent_records():
     try:
-        conn = get_db()
-        
-        # 获取系统当前日期
-        today = datetime.now().date()
-        
-        # 计算次日日期
-        next_date = today + timedelta(days=1)
+        # 当前业务日（洛杉矶时间05:00之前属于前一天）
+        today = business_days.current_business_date()
+        
+        with get_db_connection() as conn:
+            # 查询属于当前业务日的记录
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id, dock_no, vehicle_type, vehicle_no, unit, load_amount,
+                       pieces, time_slot, shift_type, remark, created_at
+                FROM inbound_records 
+                WHERE 
+                    business_date = ?
+                ORDER BY created_at DESC""", (today.strftime('%Y-%m-%d'),))
+            rows = exports.SpooledRows(
+                ['ID', '码头号', '车辆类型', '车牌号', '单位', '装载量', '件数', '时间段', '班次类型', '备注', '创建时间']
+            ).extend(exports.iter_cursor(cur))
+        
+        output, size = exports.build_workbook([("最近记录", rows)])
+        return exports.stream_file_response(output, size, f"recent_records_{today.strftime('%Y-%m-%d')}.xlsx")
         
-        # 构建日期范围查询条件（使用自然日）
-        # 当天00:00:00的时间（系统时间）
-        today_start = datetime.combine(today, datetime.min.time())
-        
-        # 次日00:00:00的时间（系统时间，用于上限）
-        next_day_start = datetime.combine(next_date, datetime.min.time())
-        
-        # 查询属于当前自然日的记录（查询当天00:00之后到次日00:00之前的所有记录）
-        cur = conn.cursor(); cur.execute("""
-            SELECT id, dock_no, vehicle_type, vehicle_no, unit, load_amount,
-                   pieces, time_slot, shift_type, remark, created_at
-            FROM inbound_records 
-            WHERE 
-                created_at >= ? AND created_at < ?
-            ORDER BY created_at DESC""", (
-                today_start.strftime('%Y-%m-%d %H:%M:%S'), 
-                next_day_start.strftime('%Y-%m-%d %H:%M:%S')
-            ))
-        
-        rows = [{
-            "id": r[0], "dock_no": r[1], "vehicle_type": r[2], "vehicle_no": r[3],
-            "unit": r[4], "load_amount": r[5], "pieces": r[6],
-            "time_slot": r[7], "shift_type": r[8], "remark": r[9],
-            "created_at": r[10]  # 数据库中存储的是系统时间，直接返回
-        } for r in cur.fetchall()]
-        
-        conn.close()
-        
-        # 创建Excel工作簿
-        wb = Workbook()
-        
-        # 创建工作表
-        ws = wb.active
-        ws.title = "最近记录"
-        
-        # 添加表头
-        headers = ['ID', '码头号', '车辆类型', '车牌号', '单位', '装载量', '件数', '时间段', '班次类型', '备注', '创建时间']
-        ws.append(headers)
-        
-        # 设置表头样式
-        header_font = Font(bold=True)
-        header_fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-        for col in range(1, len(headers) + 1):
-            cell = ws.cell(row=1, column=col)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center")
-        
-        # 添加数据
-        for row_dict in rows:
-            # 按照表头顺序构造行数据
-            row_data = [
-                row_dict["id"], row_dict["dock_no"], row_dict["vehicle_type"], row_dict["vehicle_no"],
-                row_dict["unit"], row_dict["load_amount"], row_dict["pieces"],
-                row_dict["time_slot"], row_dict["shift_type"], row_dict["remark"], row_dict["created_at"]
-            ]
-            ws.append(row_data)
-        
-        # 调整列宽
-        for column in ws.columns:
-            max_length = 0
-            column_letter = get_column_letter(column[0].column)
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column_letter].width = min(adjusted_width, 50)
-        
-        # 保存Excel文件
-        filename = f"recent_records_{today.strftime('%Y-%m-%d')}.xlsx"
-        filepath = os.path.join(os.path.dirname(__file__), filename)
-        wb.save(filepath)
-        
-        # 返回Excel文件
-        from flask import Response
-        
-        # 读取文件内容
-        with open(filepath, 'rb') as f:
-            file_content = f.read()
-        
-        # 创建响应对象，明确设置Content-Type和Content-Disposition
-        response = Response(
-            file_content,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={
-                'Content-Disposition': f'attachment; filename="{filename}"'
-            }
-        )
-        return response
+    except Exception as e:
+        log.exception("导出最近记录Excel文件出错")
+        return jsonify({"error": f"导出失败: {str(e)}"}), 500
+
+# 区间批量导出: /api/export?start=&end=&format=csv|xlsx|jsonl&table=inbound|sorting&columns=&gzip=1
+@app.route('/api/export')
+def export_range():
+    try:
+        today_str = datetime.now(LA_TZ).strftime('%Y-%m-%d')
+        start_str = request.args.get('start') or today_str
+        end_str = request.args.get('end') or start_str
+        fmt = (request.args.get('format') or 'csv').lower()
+        table_key = request.args.get('table') or 'inbound'
+        use_gzip = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+        try:
+            start_date = datetime.strptime(start_str, '%Y-%m-%d').date()
+            end_date = datetime.strptime(end_str, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({"error": "start/end 日期格式应为 YYYY-MM-DD"}), 400
+        if start_date > end_date:
+            return jsonify({"error": "start 不能晚于 end"}), 400
+        if fmt not in exports.EXPORT_FORMATS:
+            return jsonify({"error": f"format 参数无效，可选: {', '.join(exports.EXPORT_FORMATS)}"}), 400
+        try:
+            columns = exports.resolve_export_columns(table_key, request.args.get('columns'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # 按业务日查询（与单日导出一致）：start 到 end（含）
+        table_name = exports.EXPORT_TABLES[table_key][0]
+        query = f"""
+            SELECT {', '.join(name for name, _ in columns)}
+            FROM {table_name}
+            WHERE business_date >= ? AND business_date <= ?
+            ORDER BY created_at, id
+        """
+        params = (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+        filename = f"{table_key}_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}.{fmt}"
+        
+        if fmt == 'xlsx':
+            # xlsx 是 zip 包, 需要完整生成后再输出 (行数据暂存在临时文件中, 不占用内存)
+            with get_db_connection() as conn:
+                cursor = exports.open_stream_cursor(conn, query, params)
+                rows = exports.SpooledRows([label for _, label in columns]).extend(exports.iter_cursor(cursor))
+                cursor.close()
+            title = "入库记录" if table_key == 'inbound' else "分拣记录"
+            output, size = exports.build_workbook([(title, rows)])
+            return exports.stream_file_response(output, size, filename)
+        
+        # CSV / JSON Lines 边查询边输出, 连接在输出结束后归还
+        conn = get_db()
+        try:
+            cursor = exports.open_stream_cursor(conn, query, params)
+        except Exception:
+            conn.close()
+            raise
+        return exports.stream_rows_response(conn, cursor, columns, fmt, filename, gzip=use_gzip)
         
     except Exception as e:
-        print(f"导出最近记录Excel文件出错: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("区间导出出错")
         return jsonify({"error": f"导出失败: {str(e)}"}), 500
 
 # 用户登录API
@@ -2938,32 +3057,19 @@ def check_page_permission(page_name):
     if 'user_id' not in session:
         return False
     
-    # 管理员有所有权限
-    if session.get('role') == 'admin':
-        return True
-    
-    # 查询用户权限
+    # 管理员有所有权限；按缓存中的当前角色判断，角色修改后立即生效
     try:
-        conn = get_db()
-        cursor = conn.cursor(); cursor.execute("""
-            SELECT can_view FROM user_permissions
-            WHERE user_id = ? AND page_name = ?
-        """, (session['user_id'], page_name))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        return result and bool(result['can_view'] if USE_POSTGRES else result[0])
+        return permissions.has_permission(session['user_id'], page_name, admin_all=True)
     except:
         return False
 
 def get_first_accessible_page(user_id, role):
     """获取用户第一个有权限访问的页面"""
-    print(f"[DEBUG] get_first_accessible_page called: user_id={user_id}, role={role}")
+    log.debug("get_first_accessible_page: user_id=%s, role=%s", user_id, role)
     
     # 管理员默认跳转到首页
     if role == 'admin':
-        print(f"[DEBUG] User is admin, redirecting to /")
+        log.debug("User is admin, redirecting to /")
         return '/'
     
     # 页面优先级顺序
@@ -2976,25 +3082,14 @@ def get_first_accessible_page(user_id, role):
     ]
     
     try:
-        conn = get_db()
         for page_name, page_url in page_priority:
-            cursor = conn.cursor(); cursor.execute("""
-                SELECT can_view FROM user_permissions
-                WHERE user_id = ? AND page_name = ? AND can_view = 1
-            """, (user_id, page_name))
-            
-            result = cursor.fetchone()
-            print(f"[DEBUG] Checking {page_name}: result={result}")
-            
-            if result:
-                print(f"[DEBUG] Found accessible page: {page_name} -> {page_url}")
-                conn.close()
+            if permissions.has_permission(user_id, page_name):
+                log.debug("Found accessible page: %s -> %s", page_name, page_url)
                 return page_url
         
-        conn.close()
-        print(f"[DEBUG] No accessible pages found, redirecting to /no_permission")
+        log.debug("No accessible pages found, redirecting to /no_permission")
     except Exception as e:
-        print(f"[DEBUG] Exception in get_first_accessible_page: {e}")
+        log.warning("Exception in get_first_accessible_page: %s", e)
         pass
     
     # 如果没有任何页面权限,跳转到无权限页面
@@ -3032,6 +3127,8 @@ def login():
         # 获取第一个有权限的页面
         user_id = user['id'] if USE_POSTGRES else user[0]
         user_role = user['role'] if USE_POSTGRES else user[2]
+        # 登录时重新加载一次全部权限，之后的权限检查只查缓存
+        permissions.permission_cache.get(user_id, refresh=True)
         redirect_url = get_first_accessible_page(user_id, user_role)
         
         return jsonify({
@@ -3073,27 +3170,9 @@ def get_user_permissions():
     if 'user_id' not in session:
         return jsonify({'error': '未登录'}), 401
     
-    user_id = session['user_id']
-    
-    # 查询用户权限
-    conn = get_db()
-    cursor = conn.cursor(); cursor.execute("""
-        SELECT page_name, can_view, can_edit, can_delete
-        FROM user_permissions
-        WHERE user_id = ?
-    """, (user_id,))
-    
-    permissions = {}
-    for row in cursor.fetchall():
-        page_name, can_view, can_edit, can_delete = row
-        permissions[page_name] = {
-            'can_view': bool(can_view),
-            'can_edit': bool(can_edit),
-            'can_delete': bool(can_delete)
-        }
-    
-    conn.close()
-    return jsonify(permissions)
+    # 查询用户权限（进程内缓存）
+    entry = permissions.permission_cache.get(session['user_id'])
+    return jsonify(permissions.decode_permissions(entry.bits))
 
 # 用户权限装饰器
 def require_permission(page_name, permission_type='view'):
@@ -3104,19 +3183,8 @@ def require_permission(page_name, permission_type='view'):
             if 'user_id' not in session:
                 return jsonify({'error': '未登录'}), 401
             
-            # 检查权限
-            conn = get_db()
-            query = f"""
-                SELECT up.can_{permission_type}
-                FROM user_permissions up
-                WHERE up.user_id = ? AND up.page_name = ?
-            """
-            cursor = conn.cursor(); cursor.execute(query, (session['user_id'], page_name))
-            result = cursor.fetchone()
-            conn.close()
-            
-            check_val = result[f'can_{permission_type}'] if USE_POSTGRES else result[0]
-            if not result or not check_val:
+            # 检查权限（进程内缓存）
+            if not permissions.has_permission(session['user_id'], page_name, permission_type):
                 return jsonify({'error': '权限不足'}), 403
             
             return func(*args, **kwargs)
@@ -3222,24 +3290,24 @@ def manage_user_permissions(user_id):
                 WHERE user_id = ?
             """, (user_id,))
             
-            permissions = {}
+            page_permissions = {}
             for row in cursor.fetchall():
                 page_name, can_view, can_edit, can_delete = row
-                permissions[page_name] = {
+                page_permissions[page_name] = {
                     'can_view': bool(can_view),
                     'can_edit': bool(can_edit),
                     'can_delete': bool(can_delete)
                 }
             
             conn.close()
-            return jsonify(permissions)
+            return jsonify(page_permissions)
         except Exception as e:
             return jsonify({'error': str(e)}), 500
     
     # PUT - 更新用户权限
     elif request.method == 'PUT':
         data = request.json
-        permissions = data.get('permissions', {})
+        page_permissions = data.get('permissions', {})
         
         try:
             conn = get_db()
@@ -3248,7 +3316,7 @@ def manage_user_permissions(user_id):
             conn.cursor().execute("DELETE FROM user_permissions WHERE user_id = ?", (user_id,))
             
             # 插入新权限
-            for page_name, perms in permissions.items():
+            for page_name, perms in page_permissions.items():
                 conn.cursor().execute("""
                     INSERT INTO user_permissions 
                     (user_id, page_name, can_view, can_edit, can_delete)
@@ -3261,33 +3329,14 @@ def manage_user_permissions(user_id):
                     perms.get('can_delete', False)
                 ))
             
+            # 递增权限版本号，提交后所有 worker 的权限缓存失效
+            version = permissions.bump_version(conn.cursor(), user_id)
             conn.commit()
-            
-            # 如果修改的是当前登录用户的权限,立即刷新session中的权限
-            immediate_effect = False
-            if session.get('user_id') == user_id:
-                # 重新加载权限到session
-                cursor = conn.cursor(); cursor.execute("""
-                    SELECT page_name, can_view, can_edit, can_delete
-                    FROM user_permissions
-                    WHERE user_id = ?
-                """, (user_id,))
-                
-                # 更新session中的权限
-                session_permissions = {}
-                for row in cursor.fetchall():
-                    page_name, can_view, can_edit, can_delete = row
-                    session_permissions[page_name] = {
-                        'can_view': bool(can_view),
-                        'can_edit': bool(can_edit),
-                        'can_delete': bool(can_delete)
-                    }
-                
-                # 将权限存储到session中(如果需要的话)
-                # 注意:当前实现中权限是实时从数据库查询的,这里只是示例
-                immediate_effect = True
-            
             conn.close()
+            permissions.publish_change(user_id, version)
+            
+            # 修改的是当前登录用户的权限时提示已立即生效
+            immediate_effect = session.get('user_id') == user_id
             
             return jsonify({'success': True, 'immediate_effect': immediate_effect})
         except Exception as e:
@@ -3316,8 +3365,11 @@ def update_user(user_id):
         if is_active is not None:
             conn.cursor().execute("UPDATE users SET is_active = ? WHERE id = ?", (is_active, user_id))
         
+        # 角色和启用状态也在权限缓存中，同样递增版本号
+        version = permissions.bump_version(conn.cursor(), user_id)
         conn.commit()
         conn.close()
+        permissions.publish_change(user_id, version)
         
         return jsonify({'success': True})
     except Exception as e:
@@ -3339,9 +3391,12 @@ def delete_user(user_id):
     
     try:
         conn = get_db()
+        # 先递增版本号：其他 worker 删除前读到的旧权限不会再放入缓存
+        version = permissions.bump_version(conn.cursor(), user_id)
         conn.cursor().execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
         conn.close()
+        permissions.publish_change(user_id, version)
         
         return jsonify({'success': True})
     except Exception as e:
@@ -3378,6 +3433,9 @@ def set_pickup_forecast():
         conn.commit()
         conn.close()
         
+        # 预估数据变化，使所有 worker 的对比缓存失效
+        broadcast_update('forecast_updated', {'date': forecast_date})
+        
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -3407,14 +3465,12 @@ def get_pickup_forecast():
 
 # 模块级别初始化 - Gunicorn 导入模块时会执行
 # 这确保数据库在应用启动时被初始化
-print("[模块加载] 开始初始化应用...")
+log.info("模块加载: 开始初始化应用...")
 try:
     initialize_app()
-    print("[模块加载] 应用初始化成功")
+    log.info("模块加载: 应用初始化成功")
 except Exception as e:
-    print(f"[模块加载] 警告: 初始化失败 - {e}")
-    import traceback
-    traceback.print_exc()
+    log.exception("模块加载: 初始化失败")
 
 if __name__ == "__main__":
     init_db()
@@ -3428,5 +3484,5 @@ if __name__ == "__main__":
     host = os.environ.get('HOST', HOST)
     port = int(os.environ.get('PORT', PORT))
     
-    print(f"Starting server on {host}:{port}")
+    log.info("Starting server on %s:%s", host, port)
     app.run(debug=True, host=host, port=port)
\ No newline at end of file
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+SSE 推送中心 - 按变更日志 (outbox) 的 seq 顺序推送, 有界客户端缓冲区、Last-Event-ID 断线续传
+
+- 事件来自 change_outbox: 每个 worker 一个推送线程按 seq 顺序读取新的变更, 由 set_event_builder()
+  登记的函数转为事件后推送给本进程的客户端. 事件 ID 就是 seq, 所有 worker 的同一变更 ID 相同,
+  顺序与提交顺序一致 (outbox.begin_write), 重连到任何 worker 都能按 ID 续传
+- 写接口提交后通过 wake() (其他 worker 经事件总线) 唤醒推送线程; 另外每隔 SSE_POLL_INTERVAL 秒
+  检查一次, 事件总线丢失通知时也不会漏推
+- 客户端带 Last-Event-ID (请求头或 ?last_event_id= 参数, 页面首次连接时为 /api/stats 返回的 seq)
+  连接时从 change_outbox 补发之后的事件; 没有时从当前最新的 seq 开始
+- 每个客户端一个固定长度的缓冲区, 满了丢弃最旧的事件, 并在下次发送前补发一条 resync 事件
+  通知客户端整体刷新; 需要补发的事件超过缓冲区或已被清理时同样发送 resync
+- 不对应变更的事件 (预测更新等) 由 publish() 直接推送, 不带 ID
+- 生产环境使用 gunicorn gevent worker (Dockerfile), 每条 SSE 连接是一个协程, 不占用请求线程;
+  线程模式 (开发服务器、gthread worker) 下每条连接占用一个线程, 连接上限默认为 2, 超出返回 503.
+  每条连接最长保持 SSE_MAX_STREAM_SECONDS 秒后关闭, 客户端续传重连
+- 只使用 threading 原语, gevent worker 下由 gevent 打补丁
+
+环境变量:
+- SSE_MAX_CLIENTS         每个 worker 的 SSE 连接上限 (gevent worker 默认 1000; 线程模式默认 2, 需小于 --threads)
+- SSE_CLIENT_BUFFER       每个客户端缓冲的事件数 (默认 64)
+- SSE_POLL_INTERVAL       有客户端时检查新变更的间隔 (秒, 默认 5)
+- SSE_MAX_STREAM_SECONDS  单条连接最长时间 (默认 300)
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import outbox
+from app_logging import get_logger
+from database import get_db_connection
+
+log = get_logger(__name__)
+
+
+def is_cooperative():
+    """是否运行在 gevent 下 (gunicorn gevent worker 已对 threading/socket 打补丁)"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 1000 if is_cooperative() else 2))
+SSE_CLIENT_BUFFER = int(os.environ.get('SSE_CLIENT_BUFFER', 64))
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', 5))
+SSE_MAX_STREAM_SECONDS = float(os.environ.get('SSE_MAX_STREAM_SECONDS', 300))
+SSE_HEARTBEAT_SECONDS = 30
+# 建议客户端重连间隔 (毫秒)
+SSE_RETRY_MS = 5000
+# 每次从 change_outbox 读取的变更数
+OUTBOX_READ_BATCH = 500
+
+
+def format_event(payload, event_id=None):
+    """按 SSE 格式编码一条事件"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {payload}")
+    return "\n".join(lines) + "\n\n"
+
+
+def resync_event():
+    return json.dumps({'type': 'refresh_stats', 'data': {'action': 'resync'}})
+
+
+class SSEClient:
+    __slots__ = ('buffer', 'overflowed', 'position')
+
+    def __init__(self, buffer_size):
+        self.buffer = deque(maxlen=buffer_size)
+        self.overflowed = False
+        # 已放入缓冲区的最大 seq, 之后只推送 seq 更大的事件
+        self.position = 0
+
+
+class SSEHub:
+    def __init__(self, max_clients=SSE_MAX_CLIENTS, buffer_size=SSE_CLIENT_BUFFER,
+                 poll_interval=SSE_POLL_INTERVAL):
+        self.max_clients = max_clients
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._clients = set()
+        # 读取 change_outbox 与登记客户端互斥: 新客户端的起点不小于推送线程已读到的位置
+        self._feed_lock = threading.Lock()
+        # 推送线程已读到的 seq; 没有客户端时为 None, 不读数据库
+        self._feed_seq = None
+        self._wake = threading.Event()
+        self._build_event = None
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def set_event_builder(self, build_event):
+        """登记变更转事件的函数: build_event(change) 返回事件字典, 不推送的变更返回 None"""
+        self._build_event = build_event
+
+    def start(self):
+        """启动推送线程; 每个进程一个 (gunicorn fork 之后启动)"""
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self._run, name='sse-feed', daemon=True).start()
+
+    def wake(self):
+        """有新的变更已提交, 唤醒推送线程"""
+        self._wake.set()
+
+    def publish(self, message):
+        """直接推送一条不对应变更的事件 (不带 ID, 不参与续传)"""
+        payload = json.dumps(message, ensure_ascii=False, default=str)
+        with self._cond:
+            for client in self._clients:
+                self._append(client, None, payload)
+            self.published += 1
+            self._cond.notify_all()
+
+    def _append(self, client, event_id, payload):
+        if len(client.buffer) == client.buffer.maxlen:
+            client.overflowed = True
+            self.dropped += 1
+        client.buffer.append((event_id, payload))
+
+    def _read_events(self, cursor, after_seq, max_events=None):
+        """
+        读取 seq 大于 after_seq 的变更并转为事件, 返回 ([(seq, 事件), ...], 读到的最大 seq)
+        事件数超过 max_events 时提前返回
+        """
+        events = []
+        while True:
+            changes = outbox.fetch_changes(cursor, after_seq, OUTBOX_READ_BATCH)
+            for change in changes:
+                after_seq = change['seq']
+                message = self._build_event(change) if self._build_event else None
+                if message is not None:
+                    events.append((change['seq'], json.dumps(message, ensure_ascii=False, default=str)))
+            if len(changes) < OUTBOX_READ_BATCH or (max_events is not None and len(events) > max_events):
+                return events, after_seq
+
+    def poll(self):
+        """读取新的变更并推送给客户端, 返回推送的事件数; 没有客户端时不读数据库"""
+        with self._feed_lock:
+            with self._cond:
+                if not self._clients:
+                    self._feed_seq = None
+                    return 0
+            with get_db_connection() as conn:
+                events, self._feed_seq = self._read_events(conn.cursor(), self._feed_seq)
+            with self._cond:
+                for event_id, payload in events:
+                    for client in self._clients:
+                        if event_id > client.position:
+                            self._append(client, event_id, payload)
+                            client.position = event_id
+                    self.published += 1
+                if events:
+                    self._cond.notify_all()
+            return len(events)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                log.warning("读取变更日志推送 SSE 事件出错: %s", e)
+
+    def _is_full(self):
+        with self._cond:
+            if len(self._clients) >= self.max_clients:
+                self.rejected += 1
+                return True
+            return False
+
+    def connect(self, last_event_id=None):
+        """
+        登记一个客户端, 补发 seq 大于 last_event_id 的事件; 超过连接上限时返回 None
+        没有 last_event_id 时只接收之后的新事件
+        """
+        if self._is_full():
+            return None
+        client = SSEClient(self.buffer_size)
+        with self._feed_lock:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                min_seq, max_seq = outbox.get_seq_range(cursor)
+                max_seq = max_seq or 0
+                position = max_seq
+                if last_event_id is not None and last_event_id != max_seq:
+                    if last_event_id > max_seq or (min_seq is not None and last_event_id < min_seq - 1):
+                        # 数据库已重建或断线期间的变更已被清理, 让客户端整体刷新
+                        client.overflowed = True
+                    else:
+                        events, last_seq = self._read_events(cursor, last_event_id, self.buffer_size)
+                        if len(events) > self.buffer_size:
+                            client.overflowed = True
+                        else:
+                            client.buffer.extend(events)
+                            position = max(last_seq, max_seq)
+            with self._cond:
+                if len(self._clients) >= self.max_clients:
+                    self.rejected += 1
+                    return None
+                # 起点不小于推送线程已读到的位置 (都在 _feed_lock 内读取), 之后的事件由推送线程补上
+                client.position = position
+                if self._feed_seq is None:
+                    self._feed_seq = position
+                self._clients.add(client)
+        return client
+
+    def disconnect(self, client):
+        with self._cond:
+            self._clients.discard(client)
+
+    def stream(self, client, heartbeat=SSE_HEARTBEAT_SECONDS, max_seconds=SSE_MAX_STREAM_SECONDS):
+        """客户端事件流 (生成器); 连接结束时自动注销"""
+        deadline = time.monotonic() + max_seconds
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            yield format_event(json.dumps({'type': 'connected', 'message': 'SSE connection established'}))
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                with self._cond:
+                    if not client.buffer and not client.overflowed:
+                        self._cond.wait(timeout=min(heartbeat, remaining))
+                    events = list(client.buffer)
+                    client.buffer.clear()
+                    overflowed = client.overflowed
+                    client.overflowed = False
+
+                if overflowed:
+                    # 客户端重新请求 /api/stats 后从其返回的 seq 重新连接, 缓冲区中的事件不再发送
+                    yield format_event(resync_event())
+                    return
+                for event_id, payload in events:
+                    yield format_event(payload, event_id)
+                if not events:
+                    # 超时，发送心跳保持连接
+                    yield format_event(json.dumps({'type': 'heartbeat', 'timestamp': time.time()}))
+        finally:
+            self.disconnect(client)
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'clients': len(self._clients),
+                'max_clients': self.max_clients,
+                'cooperative': is_cooperative(),
+                'feed_seq': self._feed_seq,
+                'published': self.published,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+            }
+
+
+sse_hub = SSEHub()
@@ -70,8 +70,9 @@ class OfflineManager {
             const transaction = this.db.transaction(['pendingRecords'], 'readwrite');
             const store = transaction.objectStore('pendingRecords');
 
+            // 在线提交失败时沿用已生成的请求 ID, 服务器已写入的记录补交时不会重复
             const record = {
-                id: this.generateUUID(),
+                id: data.client_request_id || this.generateUUID(),
                 type: type,
                 data: data,
                 timestamp: new Date().toISOString(),
@@ -186,7 +187,7 @@ class OfflineManager {
      * 同步单条记录到服务器
      */
     async syncRecord(record) {
-        const endpoint = record.type === 'inbound' ? '/api/record' : '/api/sorting_record';
+        const endpoint = record.type === 'inbound' ? '/api/record' : '/api/sorting';
 
         try {
             const response = await fetch(endpoint, {
@@ -194,7 +195,7 @@ class OfflineManager {
                 headers: {
                     'Content-Type': 'application/json'
                 },
-                body: JSON.stringify(record.data)
+                body: JSON.stringify(Object.assign({}, record.data, { client_request_id: record.id }))
             });
 
             if (!response.ok) {
@@ -220,8 +221,51 @@ class OfflineManager {
         }
     }
 
+    /**
+     * 批量同步入库记录 (POST /api/records/bulk)
+     * 本地记录的 id 作为 client_request_id, 服务器据此去重, 重复提交是安全的
+     */
+    async syncInboundBatch(records) {
+        try {
+            const response = await fetch('/api/records/bulk', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    records: records.map(record => Object.assign({}, record.data, {
+                        client_request_id: record.id,
+                        created_at: record.data.created_at || record.timestamp
+                    }))
+                })
+            });
+
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+
+            const result = await response.json();
+            if (!result.success) {
+                throw new Error(result.error || '同步失败');
+            }
+
+            // 新建和重复 (之前已提交过) 的记录都已在服务器上
+            for (const record of records) {
+                await this.deleteRecord(record.id);
+            }
+            return { success: true };
+        } catch (error) {
+            console.error('批量同步失败:', error);
+            for (const record of records) {
+                await this.updateRetryCount(record.id, record.retryCount + 1);
+            }
+            return { success: false, error: error.message };
+        }
+    }
+
     /**
      * 同步所有待同步记录到服务器
+     * 入库记录按批一次提交, 其他记录逐条提交
      * @param {function} progressCallback - 进度回调函数
      */
     async syncToServer(progressCallback) {
@@ -246,13 +290,41 @@ class OfflineManager {
             let failedCount = 0;
             const failedRecords = [];
 
-            for (let i = 0; i < pendingRecords.length; i++) {
-                const record = pendingRecords[i];
+            const inboundRecords = pendingRecords.filter(record => record.type === 'inbound');
+            const otherRecords = pendingRecords.filter(record => record.type !== 'inbound');
+            const batchSize = 200;
+
+            for (let i = 0; i < inboundRecords.length; i += batchSize) {
+                const batch = inboundRecords.slice(i, i + batchSize);
+
+                if (progressCallback) {
+                    progressCallback({
+                        current: i + batch.length,
+                        total: pendingRecords.length,
+                        record: batch[batch.length - 1]
+                    });
+                }
+
+                const result = await this.syncInboundBatch(batch);
+
+                if (result.success) {
+                    syncedCount += batch.length;
+                } else {
+                    failedCount += batch.length;
+                    batch.forEach(record => failedRecords.push({
+                        record: record,
+                        error: result.error
+                    }));
+                }
+            }
+
+            for (let i = 0; i < otherRecords.length; i++) {
+                const record = otherRecords[i];
 
                 // 调用进度回调
                 if (progressCallback) {
                     progressCallback({
-                        current: i + 1,
+                        current: inboundRecords.length + i + 1,
                         total: pendingRecords.length,
                         record: record
                     });
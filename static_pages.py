@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+静态页面缓存 - 页面 HTML 只读取和压缩一次, 之后直接从内存返回
+
+index、sorting、history、statistics、logs、admin、no_permission 页面原来每次请求都重新读取文件,
+并且不压缩、没有缓存头 (statistics.html 约 140 KB). 这里按文件名缓存:
+- 原文、gzip、brotli (安装了 brotli 包时) 三种内容, 按请求的 Accept-Encoding 选择
+- 强 ETag (内容的 SHA-1, 每种编码各不相同); 浏览器带 If-None-Match 再次请求时返回 304
+- Cache-Control: private, no-cache - 每次使用前都要验证, 页面的登录和权限检查仍然在路由中执行
+- 开发环境监视文件修改时间, 修改后下次请求重新加载
+
+环境变量:
+- STATIC_PAGE_WATCH   是否检查文件修改时间 (1/0); 默认 ENVIRONMENT=production 时关闭, 其他情况开启
+"""
+import gzip
+import hashlib
+import os
+import threading
+
+from flask import current_app, request
+
+from compression import brotli, choose_encoding
+
+STATIC_PAGE_WATCH = os.environ.get(
+    'STATIC_PAGE_WATCH', '0' if os.environ.get('ENVIRONMENT') == 'production' else '1') == '1'
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+class StaticPage:
+    """一个页面文件的原文与压缩后的内容: variants = {编码: (内容, ETag)}, 原文的编码为 identity"""
+    __slots__ = ('path', 'mtime', 'variants')
+
+    def __init__(self, path, mtime, body):
+        self.path = path
+        self.mtime = mtime
+        digest = hashlib.sha1(body).hexdigest()
+        self.variants = {'identity': (body, digest)}
+        # 页面只在加载时压缩一次, 使用最高压缩级别
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = (compressed, f'{digest}-gzip')
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+            if len(compressed) < len(body):
+                self.variants['br'] = (compressed, f'{digest}-br')
+
+
+class StaticPageCache:
+    """线程安全的静态页面缓存"""
+
+    def __init__(self, static_dir, watch=STATIC_PAGE_WATCH):
+        self.static_dir = static_dir
+        self.watch = watch
+        self._pages = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.not_modified = 0
+
+    def get(self, filename):
+        """返回缓存的页面, 未加载或 (监视修改时) 文件已修改时重新加载; 文件不存在时返回 None"""
+        page = self._pages.get(filename)
+        if page is not None and not self.watch:
+            self.hits += 1
+            return page
+        path = os.path.join(self.static_dir, filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            with self._lock:
+                self._pages.pop(filename, None)
+            return None
+        if page is not None and page.mtime == mtime:
+            self.hits += 1
+            return page
+        with open(path, 'rb') as f:
+            page = StaticPage(path, mtime, f.read())
+        with self._lock:
+            self._pages[filename] = page
+            self.loads += 1
+        return page
+
+    def serve(self, filename):
+        """按 Accept-Encoding 返回页面, ETag 匹配时返回 304"""
+        page = self.get(filename)
+        if page is None:
+            return f"File not found: {os.path.join(self.static_dir, filename)}", 404
+
+        encoding = choose_encoding([encoding for encoding in ('br', 'gzip') if encoding in page.variants])
+        body, etag = page.variants[encoding]
+        response = current_app.response_class(body, mimetype='text/html')
+        response.set_etag(etag)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            self.not_modified += 1
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'pages': {filename: {encoding: len(body) for encoding, (body, _) in page.variants.items()}
+                          for filename, page in self._pages.items()},
+                'watch': self.watch,
+                'brotli': brotli is not None,
+                'hits': self.hits,
+                'loads': self.loads,
+                'not_modified': self.not_modified,
+            }
+
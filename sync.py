@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+后台同步 - 本地 SQLite 的变更持续复制到远程 PostgreSQL (如 Neon)
+
+后台线程按 seq 顺序读取 change_outbox (outbox.py), 每批:
+- 同一条记录的多次变更只保留最后一次
+- 通过一个长连接用 execute_values 批量 upsert, 批量删除
+- 远程提交成功后再在本地记录已同步的 seq (outbox_offsets), 失败的批次下次重试
+- 连接失败或写入出错时按指数退避重试
+多个 gunicorn worker 中只有拿到文件锁的一个执行同步, 该进程退出后其他进程接替.
+
+远程表结构需与本地一致 (用 DATABASE_URL 启动一次 single_app.py 或运行 migrate_to_postgres.py 创建).
+
+环境变量:
+- SYNC_DATABASE_URL   远程 PostgreSQL 连接串; 未设置时不启用 (本身使用 PostgreSQL 时也不启用)
+- SYNC_BATCH_SIZE     每批同步的变更数 (默认 500)
+- SYNC_INTERVAL       没有新变更时的轮询间隔 (秒, 默认 2)
+- SYNC_MAX_BACKOFF    出错重试的最长间隔 (秒, 默认 300)
+
+命令行:
+    python sync.py status    查看同步积压
+    python sync.py once      立即同步一批
+"""
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import outbox
+from app_logging import get_logger
+from database import USE_POSTGRES, get_db_connection, get_sqlite_db_path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = get_logger(__name__)
+
+SYNC_DATABASE_URL = os.environ.get('SYNC_DATABASE_URL', '')
+SYNC_BATCH_SIZE = int(os.environ.get('SYNC_BATCH_SIZE', 500))
+SYNC_INTERVAL = float(os.environ.get('SYNC_INTERVAL', 2))
+SYNC_MAX_BACKOFF = float(os.environ.get('SYNC_MAX_BACKOFF', 300))
+SYNC_CONSUMER = 'pg_sync'
+# 同步到远程的表
+SYNC_TABLES = ('inbound_records', 'sorting_records')
+# 只在本地有意义的列, 不同步
+SYNC_EXCLUDED_COLUMNS = {'is_synced'}
+
+
+def _parse_time(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def collapse_changes(changes):
+    """同一条记录只保留最后一次变更, 返回 {表名: ([upsert 行], [删除的主键])}"""
+    latest = {}
+    for change in changes:
+        latest[(change['table_name'], change['pk'])] = change
+    grouped = {}
+    for (table_name, pk), change in latest.items():
+        upserts, deletes = grouped.setdefault(table_name, ([], []))
+        if change['op'] == 'delete':
+            deletes.append(pk)
+        elif change['row']:
+            upserts.append(change['row'])
+    return grouped
+
+
+class SyncWorker:
+    def __init__(self, dsn, batch_size=SYNC_BATCH_SIZE, interval=SYNC_INTERVAL,
+                 max_backoff=SYNC_MAX_BACKOFF):
+        self.dsn = dsn
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._lock_file = None
+        self._remote = None
+        self._remote_columns = {}
+        # 运行指标
+        self.batches = 0
+        self.rows_synced = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_success_at = None
+        self.next_retry_at = None
+
+    @property
+    def enabled(self):
+        return bool(self.dsn) and not USE_POSTGRES
+
+    def start(self):
+        """启动同步线程, 每个进程只启动一次"""
+        if not self.enabled or self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self._run, name='outbox-sync', daemon=True).start()
+
+    def _try_lock(self):
+        """只有一个进程执行同步: 非阻塞文件锁, 进程退出时自动释放"""
+        if self._lock_file is not None:
+            return True
+        if fcntl is None:
+            self._lock_file = True
+            return True
+        db_path = os.environ.get('DATABASE_PATH') or get_sqlite_db_path()
+        path = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'sync.lock')
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        log.info("进程 %s 负责同步到远程 PostgreSQL", os.getpid())
+        return True
+
+    def _run(self):
+        while True:
+            if not self._try_lock():
+                time.sleep(self.interval * 5)
+                continue
+            try:
+                synced = self.sync_once()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {e}"
+                self._close_remote()
+                delay = min(self.interval * (2 ** self.failures), self.max_backoff)
+                self.next_retry_at = time.time() + delay
+                log.warning("第 %s 次失败: %s, %.1f 秒后重试", self.failures, e, delay)
+                time.sleep(delay)
+                continue
+            self.failures = 0
+            self.next_retry_at = None
+            # 积压未清空时立即处理下一批
+            if synced < self.batch_size:
+                time.sleep(self.interval)
+
+    def _connection(self):
+        if self._remote is None or self._remote.closed:
+            import psycopg2
+            self._remote = psycopg2.connect(self.dsn, connect_timeout=10)
+            self._remote_columns = {}
+        return self._remote
+
+    def _close_remote(self):
+        if self._remote is not None:
+            try:
+                self._remote.close()
+            except Exception:
+                pass
+        self._remote = None
+
+    def _columns(self, cursor, table_name):
+        """远程表的列 (每个连接查询一次)"""
+        if table_name not in self._remote_columns:
+            cursor.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
+                (table_name,))
+            self._remote_columns[table_name] = [row[0] for row in cursor.fetchall()]
+        return self._remote_columns[table_name]
+
+    def sync_once(self):
+        """同步一批变更, 返回本批处理的变更数"""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            last_seq = outbox.get_offset(cursor, SYNC_CONSUMER)
+            changes = outbox.fetch_changes(cursor, last_seq, self.batch_size)
+        if not changes:
+            return 0
+
+        remote = self._connection()
+        try:
+            with remote.cursor() as cursor:
+                for table_name, (upserts, deletes) in collapse_changes(changes).items():
+                    self._apply(cursor, table_name, upserts, deletes)
+            remote.commit()
+        except Exception:
+            try:
+                remote.rollback()
+            except Exception:
+                pass
+            raise
+
+        # 远程已提交, 记录进度 (此处失败时下次重放本批, upsert/delete 可重复执行)
+        with get_db_connection() as conn:
+            outbox.set_offset(conn.cursor(), SYNC_CONSUMER, changes[-1]['seq'])
+        self.batches += 1
+        self.rows_synced += len(changes)
+        self.last_success_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return len(changes)
+
+    def _apply(self, cursor, table_name, upserts, deletes):
+        from psycopg2.extras import execute_values
+
+        if table_name not in SYNC_TABLES:
+            return
+        remote_columns = self._columns(cursor, table_name)
+        if not remote_columns:
+            raise RuntimeError(f"远程数据库缺少表 {table_name}")
+
+        if upserts:
+            # 只写入每行快照都有、远程也有的列, 避免把缺失的列覆盖为 NULL
+            common = set(upserts[0])
+            for row in upserts[1:]:
+                common &= set(row)
+            columns = [c for c in remote_columns if c in common and c not in SYNC_EXCLUDED_COLUMNS]
+            updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in columns if c != 'id')
+            execute_values(cursor, f"""
+                INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s
+                ON CONFLICT (id) DO UPDATE SET {updates}
+            """, [tuple(row[c] for c in columns) for row in upserts], page_size=self.batch_size)
+            # 远程序列跟上本地 ID, 避免远程直接写入时主键冲突
+            cursor.execute(f"""
+                SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST((SELECT MAX(id) FROM {table_name}), 1))
+            """, (table_name,))
+
+        if deletes:
+            cursor.execute(f"DELETE FROM {table_name} WHERE id = ANY(%s)", (deletes,))
+
+    def get_stats(self):
+        """同步指标: 积压条数、最早积压的时长、最近一次成功/失败"""
+        stats = {'enabled': self.enabled}
+        if not self.enabled:
+            return stats
+        with get_db_connection() as conn:
+            last_seq, pending, oldest = outbox.get_lag(conn.cursor(), SYNC_CONSUMER)
+        oldest = _parse_time(oldest)
+        stats.update({
+            'leader': self._lock_file is not None,
+            'last_seq': last_seq,
+            'pending': pending,
+            'oldest_pending_at': oldest.strftime('%Y-%m-%d %H:%M:%S') if oldest else None,
+            'oldest_pending_age_seconds': int((datetime.now() - oldest).total_seconds()) if oldest else 0,
+            'batches': self.batches,
+            'rows_synced': self.rows_synced,
+            'consecutive_failures': self.failures,
+            'last_success_at': self.last_success_at,
+            'last_error': self.last_error,
+            'next_retry_in': max(0, int(self.next_retry_at - time.time())) if self.next_retry_at else None,
+        })
+        return stats
+
+
+sync_worker = SyncWorker(SYNC_DATABASE_URL)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    if not sync_worker.enabled:
+        print("未启用同步: 需要设置 SYNC_DATABASE_URL, 且本地使用 SQLite")
+        sys.exit(1)
+    if command == 'once':
+        print(f"同步了 {sync_worker.sync_once()} 条变更")
+    elif command == 'status':
+        for key, value in sync_worker.get_stats().items():
+            print(f"{key}: {value}")
+    else:
+        print("用法: python sync.py [status|once]")
+        sys.exit(1)